@@ -36,6 +36,8 @@ from rag.utils.storage_factory import STORAGE_IMPL, STORAGE_IMPL_TYPE
 from timeit import default_timer as timer
 
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.llm_cache import LLM_CACHE
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 
 @manager.route("/version", methods=["GET"])  # noqa: F821
 @login_required
@@ -85,6 +87,9 @@ def status():
             database:
               type: object
               description: Database status.
+            retrieval_cache:
+              type: object
+              description: Retrieval result cache hits, misses and hit ratio of this server.
       503:
         description: Service unavailable.
         schema:
@@ -165,6 +170,8 @@ def status():
     except Exception:
         logging.exception("get task executor heartbeats failed!")
     res["task_executor_heartbeats"] = task_executor_heartbeats
+    res["retrieval_cache"] = RETRIEVAL_CACHE.stats()
+    res["llm_cache"] = LLM_CACHE.stats()
 
     return get_json_result(data=res)
 
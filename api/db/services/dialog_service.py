@@ -15,8 +15,11 @@
 #
 import binascii
 import logging
+import os
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
@@ -41,6 +44,13 @@ from rag.prompts import chunks_format, citation_prompt, cross_languages, full_qu
 from rag.utils import num_tokens_from_string, rmSpace
 from rag.utils.tavily_conn import Tavily
 
+# 各检索源的截止时间（秒，从开始执行算起，0表示不限）：知识图谱和联网搜索超时则不计入结果，知识库检索超时则报错
+RETRIEVAL_KB_DEADLINE = float(os.environ.get("RETRIEVAL_KB_DEADLINE", 0))
+RETRIEVAL_KG_DEADLINE = float(os.environ.get("RETRIEVAL_KG_DEADLINE", 20))
+RETRIEVAL_WEB_DEADLINE = float(os.environ.get("RETRIEVAL_WEB_DEADLINE", 10))
+# 问题精化期间先用原始问题检索知识库，精化结果与原始问题相同时直接采用
+RETRIEVAL_SPECULATE = int(os.environ.get("RETRIEVAL_SPECULATE", "1"))
+
 
 class DialogService(CommonService):
     model = Dialog
@@ -200,6 +210,140 @@ def repair_bad_citation_formats(answer: str, kbinfos: dict, idx: set):
     return answer, idx
 
 
+def _timed(started, fn, *args, **kwargs):
+    # 记录开始执行的时间，截止时间从这里算起，而不是从提交算起
+    start = started[0] = timer()
+    res = fn(*args, **kwargs)
+    return res, (timer() - start) * 1000
+
+
+class RetrievalFanout:
+    """
+       标准检索模式的多源并发检索：知识库、知识图谱和联网搜索同时进行，各自有截止时间。
+       知识图谱或联网搜索失败、超时时跳过该来源；知识库检索失败或超时则报错。
+       结果按固定顺序合并（知识图谱、知识库、联网搜索），与完成先后无关。
+       每个请求使用自己的线程池，检索不会因为其他请求占满线程而排队超时。
+       """
+
+    SOURCES = [("kg", "Knowledge graph", RETRIEVAL_KG_DEADLINE), ("kb", "Knowledge base", RETRIEVAL_KB_DEADLINE),
+               ("web", "Web search", RETRIEVAL_WEB_DEADLINE)]
+
+    def __init__(self, dialog, kbs, embd_mdl, rerank_mdl, attachments):
+        self.dialog = dialog
+        self.kbs = kbs
+        self.embd_mdl = embd_mdl
+        self.rerank_mdl = rerank_mdl
+        self.attachments = attachments
+        self.tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+        self.timings = {}
+        # 每个来源一个线程，另加一个给被放弃的投机检索
+        self._pool = ThreadPoolExecutor(max_workers=len(self.SOURCES) + 1, thread_name_prefix="retrieval")
+
+    def _kb(self, question):
+        return settings.retrievaler.retrieval(
+            question,
+            self.embd_mdl,
+            self.tenant_ids,
+            self.dialog.kb_ids,
+            1,
+            self.dialog.top_n,
+            self.dialog.similarity_threshold,
+            self.dialog.vector_similarity_weight,
+            doc_ids=self.attachments,
+            top=self.dialog.top_k,
+            aggs=False,
+            rerank_mdl=self.rerank_mdl,
+            rank_feature=label_question(question, self.kbs),
+        )
+
+    def _kg(self, question):
+        return settings.kg_retrievaler.retrieval(question, self.tenant_ids, self.dialog.kb_ids, self.embd_mdl,
+                                                 LLMBundle(self.dialog.tenant_id, LLMType.CHAT))
+
+    def _submit(self, fn, question):
+        started = [None]
+        return self._pool.submit(_timed, started, fn, question), started
+
+    def start(self, question, sources=None, started=None):
+        """
+        提交问题在各启用来源（可用sources限定）上的检索，返回(问题, {来源: (future, 开始时间)})。
+        started为同一问题已提交的检索，其中的来源不再重复提交。
+        """
+        prompt_config = self.dialog.prompt_config
+        futures = dict(started[1]) if started else {}
+
+        def wanted(src):
+            return src not in futures and (sources is None or src in sources)
+
+        if self.embd_mdl and wanted("kb"):
+            futures["kb"] = self._submit(self._kb, question)
+        if prompt_config.get("use_kg") and wanted("kg"):
+            futures["kg"] = self._submit(self._kg, question)
+        if prompt_config.get("tavily_api_key") and wanted("web"):
+            tav = Tavily(prompt_config["tavily_api_key"])
+            futures["web"] = self._submit(tav.retrieve_chunks, question)
+        return question, futures
+
+    @staticmethod
+    def cancel(started):
+        for future, _ in started[1].values():
+            future.cancel()
+
+    def close(self):
+        # 不等待已超时、已放弃的检索结束
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _wait(future, start, deadline):
+        """等待检索结果；截止时间从检索真正开始执行时算起，排队等待的时间不计"""
+        if deadline <= 0:
+            return future.result()
+        while True:
+            begun = start[0]
+            if begun is not None:
+                return future.result(timeout=max(0.0, begun + deadline - timer()))
+            try:
+                return future.result(timeout=0.05)
+            except FutureTimeoutError:
+                continue
+
+    def collect(self, started):
+        """等待各来源在截止时间内返回并合并结果；知识库检索的异常和超时照常抛出"""
+        _, futures = started
+        results = {}
+        try:
+            for source, name, deadline in self.SOURCES:
+                if source not in futures:
+                    continue
+                future, start = futures[source]
+                try:
+                    results[source], cost = self._wait(future, start, deadline)
+                    self.timings[name] = f"{cost:.1f}ms"
+                except FutureTimeoutError:
+                    future.cancel()
+                    self.timings[name] = f"timeout after {deadline:g}s"
+                    if source == "kb":
+                        raise TimeoutError(f"{name} retrieval missed its {deadline:g}s deadline")
+                    logging.warning(f"RetrievalFanout: {name} missed its {deadline}s deadline")
+                except Exception:
+                    if source == "kb":
+                        self.timings.setdefault(name, "failed")
+                        raise
+                    self.timings[name] = "failed"
+                    logging.exception(f"RetrievalFanout: {name} got exception")
+        finally:
+            self.close()
+
+        kbinfos = results.get("kb") or {"total": 0, "chunks": [], "doc_aggs": []}
+        if results.get("kg") and results["kg"]["content_with_weight"]:
+            # 知识图谱的结果通常更准确，插入到最前面
+            kbinfos["chunks"].insert(0, results["kg"])
+        if results.get("web"):
+            kbinfos["chunks"].extend(results["web"]["chunks"])
+            kbinfos["doc_aggs"].extend(results["web"]["doc_aggs"])
+        return kbinfos
+
+
 def chat(dialog, messages, stream=True, **kwargs):
     """
        实现完整的RAG对话流程
@@ -310,6 +454,15 @@ def chat(dialog, messages, stream=True, **kwargs):
 
     # ===== 阶段6: 问题精化 =====
     logging.info(" [阶段6] 开始 - 问题精化")
+    # 标准检索模式下，多轮问题精化期间先用原始问题投机检索：最新问题本身完整时，精化结果往往与之相同。
+    # 跨语言扩展和关键词提取总会改写问题，启用时不做投机检索
+    fanout, speculative = None, None
+    if "knowledge" in [p["key"] for p in prompt_config["parameters"]] and not prompt_config.get("reasoning", False):
+        fanout = RetrievalFanout(dialog, kbs, embd_mdl, rerank_mdl, attachments)
+        if RETRIEVAL_SPECULATE and len(questions) > 1 and prompt_config.get("refine_multiturn") \
+                and not prompt_config.get("cross_languages") and not prompt_config.get("keyword", False):
+            # 只投机检索知识库：知识图谱检索要调用大模型，未命中时浪费较大
+            speculative = fanout.start(questions[-1], sources=["kb"])
     #  处理多轮对话的问题精化
     if len(questions) > 1 and prompt_config.get("refine_multiturn"):
         # 多轮对话模式：将历史对话上下文合并为一个完整、独立的问题
@@ -363,6 +516,10 @@ def chat(dialog, messages, stream=True, **kwargs):
                 #   similarity_threshold:相似度阈值（0.2较低，召回更多）; vector_similarity_weight:向量相似度权重
                 partial(retriever.retrieval, embd_mdl=embd_mdl, tenant_ids=tenant_ids, kb_ids=dialog.kb_ids, page=1,
                         page_size=dialog.top_n, similarity_threshold=0.2, vector_similarity_weight=0.3),
+                # 同一推理步骤产生的多个子查询一次批量检索
+                kb_retrieve_many=partial(retriever.retrieval_many, embd_mdl=embd_mdl, tenant_ids=tenant_ids,
+                                         kb_ids=dialog.kb_ids, page=1, page_size=dialog.top_n,
+                                         similarity_threshold=0.2, vector_similarity_weight=0.3),
             )
             # 执行推理思考循环
             for think in reasoner.thinking(kbinfos, " ".join(questions)):
@@ -375,49 +532,21 @@ def chat(dialog, messages, stream=True, **kwargs):
                     yield think
         else:
             # === 标准检索模式 ===
-            # 传统的向量检索 + 可选的多源检索增强
-            # 1. 向量检索（核心检索）
-            if embd_mdl:
-                # 执行语义向量检索(向量召回)
-                kbinfos = retriever.retrieval(
-                    " ".join(questions),  # 合并后的查询文本
-                    embd_mdl,  # 嵌入模型（将文本转为向量）
-                    tenant_ids,  # 租户范围限制
-                    dialog.kb_ids,  # 知识库范围限制
-                    1,  # 分页：第1页
-                    dialog.top_n,  # 返回片段数量（如50个片段）
-                    dialog.similarity_threshold,  # 相似度阈值（如0.7，过滤不相关内容）
-                    dialog.vector_similarity_weight,  # 向量vs关键词权重平衡（如0.7表示70%向量+30%关键词）
-                    doc_ids=attachments,  # 如果用户上传了特定文档，优先检索这些文档
-                    top=dialog.top_k,  # 重排序后保留的最终结果数（如10个）
-                    aggs=False,  # 不进行聚合统计
-                    rerank_mdl=rerank_mdl,  # 重排序模型（提升检索精度）
-                    rank_feature=label_question(" ".join(questions), kbs),  # 问题分类特征，辅助排序
-                )
-            # 2. 网络搜索增强（可选）
-            if prompt_config.get("tavily_api_key"):
-                # 使用Tavily进行实时网络搜索，获取最新信息, 适用于需要最新数据的问题（如"今天的股价"、"最新新闻"等）
-                tav = Tavily(prompt_config["tavily_api_key"])
-                tav_res = tav.retrieve_chunks(" ".join(questions))  # 检索网络内容块
-                # 将网络搜索结果合并到知识库结果中
-                kbinfos["chunks"].extend(tav_res["chunks"])  # 添加内容片段
-                kbinfos["doc_aggs"].extend(tav_res["doc_aggs"])  # 添加文档统计
-
-            # 3. 知识图谱检索增强（可选）
-            if prompt_config.get("use_kg"):
-                # 使用知识图谱进行结构化知识检索, 知识图谱适合处理实体关系、概念层次等结构化问题
-                ck = settings.kg_retrievaler.retrieval(
-                    " ".join(questions),  # 查询文本
-                    tenant_ids,  # 租户范围
-                    dialog.kb_ids,  # 知识库范围
-                    embd_mdl,  # 嵌入模型
-                    LLMBundle(dialog.tenant_id, LLMType.CHAT))  # LLM模型束
-                if ck["content_with_weight"]:
-                    # 如果知识图谱检索到了加权内容，插入到结果最前面
-                    # 知识图谱的结果通常更准确，所以优先级更高
-                    kbinfos["chunks"].insert(0, ck)
+            # 向量检索（核心检索）、联网搜索和知识图谱检索（可选）并发进行，见RetrievalFanout
+            # 精化后的问题与投机检索的问题相同时直接采用投机检索的结果
+            query = " ".join(questions)
+            if speculative and speculative[0] == query:
+                # 投机检索只覆盖知识库，其余来源现在才提交
+                started = fanout.start(query, started=speculative)
+                fanout.timings["Speculative retrieval"] = "hit"
+            else:
+                if speculative:
+                    RetrievalFanout.cancel(speculative)
+                    fanout.timings["Speculative retrieval"] = "miss"
+                started = fanout.start(query)
+            kbinfos = fanout.collect(started)
 
-            # 4. 生成最终的知识提示文本
+            # 生成最终的知识提示文本
             # 将检索到的所有知识片段格式化为LLM可理解的提示文本
             # 同时考虑token限制，避免超出模型的上下文长度
             knowledges = kb_prompt(kbinfos, max_tokens)
@@ -471,7 +600,7 @@ def chat(dialog, messages, stream=True, **kwargs):
             2. 生成性能报告。（计算各阶段耗时、构建报告文本 prompt += ...  注意这个prompt是给展示给用户的调试信息，不是给LLM的提示）
             3. 返回完整的调试信息
         """
-        nonlocal embd_mdl, prompt_config, knowledges, kwargs, kbinfos, prompt, retrieval_ts, questions, langfuse_tracer
+        nonlocal embd_mdl, prompt_config, knowledges, kwargs, kbinfos, prompt, retrieval_ts, questions, langfuse_tracer, fanout
         # 初始化引用列表
         refs = []
         # 分离思考过程和答案
@@ -527,6 +656,7 @@ def chat(dialog, messages, stream=True, **kwargs):
         bind_embedding_time_cost = (bind_models_ts - check_langfuse_tracer_ts) * 1000
         refine_question_time_cost = (refine_question_ts - bind_models_ts) * 1000
         retrieval_time_cost = (retrieval_ts - refine_question_ts) * 1000
+        retrieval_sources = "".join(f"    - {name}: {cost}\n" for name, cost in fanout.timings.items()) if fanout else ""
         generate_result_time_cost = (finish_chat_ts - retrieval_ts) * 1000
         # 计算生成的token数量
         tk_num = num_tokens_from_string(think + answer)
@@ -541,6 +671,7 @@ def chat(dialog, messages, stream=True, **kwargs):
             f"  - Bind models: {bind_embedding_time_cost:.1f}ms\n"
             f"  - Query refinement(LLM): {refine_question_time_cost:.1f}ms\n"
             f"  - Retrieval: {retrieval_time_cost:.1f}ms\n"
+            f"{retrieval_sources}"
             f"  - Generate answer: {generate_result_time_cost:.1f}ms\n\n"
             "## Token usage:\n"
             f"  - Generated tokens(approximately): {tk_num}\n"
@@ -35,7 +35,7 @@ from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.utils import current_timestamp, get_format_time, get_uuid
 from rag.nlp import rag_tokenizer, search
-from rag.settings import get_svr_queue_name, SVR_CONSUMER_GROUP_NAME
+from rag.settings import get_svr_queue_name, SVR_CONSUMER_GROUP_NAME, CHUNK_REUSE_ENABLED, CHUNK_REUSE_TTL
 from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.doc_store_conn import OrderByExpr
@@ -504,6 +504,8 @@ class DocumentService(CommonService):
                         prg = 0.98 * len(tsks) / (len(tsks) + 1)
                     else:
                         status = TaskStatus.DONE.value
+                if finished:
+                    drop_stale_chunks(d["id"], tsks)
 
                 msg = "\n".join(sorted(msg))
                 info = {
@@ -538,6 +540,85 @@ class DocumentService(CommonService):
             pass
         return False
 
+    @classmethod
+    @DB.connection_context()
+    def get_canceled_ids(cls, doc_ids):
+        """The documents among `doc_ids` whose tasks should stop, by the same rule as do_cancel."""
+        if not doc_ids:
+            return []
+        docs = cls.model.select(cls.model.id).where(
+            cls.model.id.in_(doc_ids),
+            (cls.model.run == TaskStatus.CANCEL.value) | (cls.model.progress < 0))
+        return [d.id for d in docs]
+
+
+TASK_CANCEL_CHANNEL = "task_cancel"
+
+
+def doc_cancel_key(doc_id):
+    return f"doc_cancel_{doc_id}"
+
+
+def publish_doc_cancel(doc_id):
+    """Tell the task executors to stop the tasks of a document, see rag.svr.progress.ProgressReporter."""
+    REDIS_CONN.set(doc_cancel_key(doc_id), "1", 24 * 3600)
+    REDIS_CONN.publish(TASK_CANCEL_CHANNEL, doc_id)
+
+
+def reusable_chunks_key(doc_id):
+    return f"chunk_reuse_{doc_id}"
+
+
+def keep_chunks_for_reuse(doc_id, tenant_id, kb_id, chunk_ids):
+    """
+    Keep the chunks of the previous parsing of a document while it is parsed again, instead of deleting
+    them up front: the task executor copies the vectors and LLM enrichments of the chunks whose content
+    did not change, see ChunkReuser. The kept chunks are hidden from retrieval meanwhile, a chunk produced
+    again replaces its old version, and those left over are deleted once every task of the document has finished.
+    """
+    key = reusable_chunks_key(doc_id)
+    prev = REDIS_CONN.get(key)
+    if prev:
+        # The previous parsing was never finished: its leftovers still have to be dropped.
+        chunk_ids = list(set(chunk_ids) | set(json.loads(prev)["ids"]))
+    REDIS_CONN.set(key, json.dumps({"tenant_id": tenant_id, "kb_id": kb_id, "ids": chunk_ids}), CHUNK_REUSE_TTL)
+    settings.docStoreConn.update({"id": chunk_ids}, {"available_int": 0}, search.index_name(tenant_id), kb_id)
+
+
+def clear_chunks_for_reparse(doc_id, tenant_id, kb_id):
+    """
+    Clear the chunks of a document about to be parsed again from scratch, its tasks, and with them the ids
+    of its chunks, being dropped: they are kept for reuse, see keep_chunks_for_reuse, unless CHUNK_REUSE_ENABLED=0.
+    """
+    idxnm = search.index_name(tenant_id)
+    if not settings.docStoreConn.indexExist(idxnm, kb_id):
+        return
+    if not CHUNK_REUSE_ENABLED:
+        settings.docStoreConn.delete({"doc_id": doc_id}, idxnm, kb_id)
+        return
+    chunk_ids = []
+    for rows in settings.docStoreConn.scan(["doc_id"], {"doc_id": doc_id}, idxnm, [kb_id]):
+        chunk_ids.extend(rows.keys())
+    if chunk_ids:
+        keep_chunks_for_reuse(doc_id, tenant_id, kb_id, chunk_ids)
+
+
+def drop_stale_chunks(doc_id, tasks):
+    """Delete the chunks kept by keep_chunks_for_reuse that none of the tasks of the document produced again."""
+    key = reusable_chunks_key(doc_id)
+    v = REDIS_CONN.get(key)
+    if not v:
+        return
+    kept = json.loads(v)
+    produced = set()
+    for t in tasks:
+        produced.update((t.chunk_ids or "").split())
+    stale = [i for i in kept["ids"] if i not in produced]
+    if stale:
+        settings.docStoreConn.delete({"id": stale}, search.index_name(kept["tenant_id"]), kept["kb_id"])
+    REDIS_CONN.delete(key)
+    logging.info(f"Dropped {len(stale)} chunks of document {doc_id} not reused by its new parsing")
+
 
 def queue_raptor_o_graphrag_tasks(doc, ty, priority):
     chunking_config = DocumentService.get_chunking_config(doc["id"])
@@ -655,7 +736,6 @@ def doc_upload_and_parse(conversation_id, file_objs, user_id):
     docids = [d["id"] for d, _ in files]
     chunk_counts = {id: 0 for id in docids}
     token_counts = {id: 0 for id in docids}
-    es_bulk_size = 64
 
     def embedding(doc_id, cnts, batch_size=16):
         nonlocal embd_mdl, chunk_counts, token_counts
@@ -701,12 +781,11 @@ def doc_upload_and_parse(conversation_id, file_objs, user_id):
         for i, d in enumerate(cks):
             v = vects[i]
             d["q_%d_vec" % len(v)] = v
-        for b in range(0, len(cks), es_bulk_size):
-            if try_create_idx:
-                if not settings.docStoreConn.indexExist(idxnm, kb_id):
-                    settings.docStoreConn.createIdx(idxnm, kb_id, len(vects[0]))
-                try_create_idx = False
-            settings.docStoreConn.insert(cks[b:b + es_bulk_size], idxnm, kb_id)
+        if try_create_idx:
+            if not settings.docStoreConn.indexExist(idxnm, kb_id):
+                settings.docStoreConn.createIdx(idxnm, kb_id, len(vects[0]))
+            try_create_idx = False
+        settings.docStoreConn.insert_stream(cks, idxnm, kb_id)
 
         DocumentService.increment_chunk_num(
             doc_id, kb.id, token_counts[doc_id], chunk_counts[doc_id], 0)
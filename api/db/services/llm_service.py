@@ -24,7 +24,11 @@ LLM服务管理系统
 4. 使用量统计和Langfuse监控集成
 5. 支持多种类型的AI模型（聊天、嵌入、重排序、语音转文本、文本转语音、图像识别等）
 """
+import copy
 import logging
+import os
+import threading
+import time
 
 from langfuse import Langfuse
 
@@ -35,6 +39,10 @@ from api.db.services.common_service import CommonService
 from api.db.services.langfuse_service import TenantLangfuseService
 from api.db.services.user_service import TenantService
 from rag.llm import ChatModel, CvModel, EmbeddingModel, RerankModel, Seq2txtModel, TTSModel
+from rag.utils.embedding_cache import cached_encode
+from rag.utils.redis_conn import REDIS_CONN
+
+MODEL_REGISTRY_TTL = int(os.environ.get("MODEL_REGISTRY_TTL", 600))
 
 
 class LLMFactoriesService(CommonService):
@@ -369,6 +377,82 @@ class TenantLLMService(CommonService):
         return list(objs)
 
 
+def model_registry_version_key(tenant_id):
+    return f"model_registry_version:{tenant_id}"
+
+
+def tenant_langfuse(tenant_id):
+    langfuse_keys = TenantLangfuseService.filter_by_tenant(tenant_id=tenant_id)
+    if not langfuse_keys:
+        return None
+    langfuse = Langfuse(public_key=langfuse_keys.public_key, secret_key=langfuse_keys.secret_key, host=langfuse_keys.host)
+    return langfuse if langfuse.auth_check() else None
+
+
+class ModelRegistry:
+    """
+        概述：进程级的租户模型注册表，缓存构造LLMBundle所需的模型配置、模型实例、Langfuse客户端和向量维度
+
+        处理步骤：
+        - 条目按租户划分，存活MODEL_REGISTRY_TTL秒
+        - 模型实例在请求之间复用，从而复用rag/llm下模型类的HTTP客户端和连接池
+        - 租户的模型设置变更时调用invalidate，递增Redis中该租户的版本号，各进程据此丢弃旧条目
+        """
+    def __init__(self, ttl=MODEL_REGISTRY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._vector_sizes = {}
+
+    @staticmethod
+    def _version(tenant_id):
+        return REDIS_CONN.get(model_registry_version_key(tenant_id)) or "0"
+
+    def get(self, tenant_id, key, build):
+        """
+               概述：返回租户的缓存条目，不存在、过期或版本过时时调用build重新构造
+
+               输入：
+               - tenant_id: 租户ID
+               - key: 条目在租户内的键（元组）
+               - build: 构造条目的无参函数，异常不缓存
+
+               输出：
+               - 条目的值
+               """
+        version = self._version(tenant_id)
+        k = (tenant_id,) + key
+        now = time.time()
+        with self._lock:
+            hit = self._entries.get(k)
+            if hit and hit[0] > now and hit[1] == version:
+                return hit[2]
+        value = build()
+        with self._lock:
+            self._entries = {e: v for e, v in self._entries.items() if v[0] > now}
+            self._entries[k] = (now + self.ttl, version, value)
+        return value
+
+    def invalidate(self, tenant_id):
+        """租户的模型设置（API密钥、默认模型、Langfuse密钥）变更后调用，使所有进程中该租户的条目失效"""
+        REDIS_CONN.incr(model_registry_version_key(tenant_id))
+        with self._lock:
+            self._entries = {e: v for e, v in self._entries.items() if e[0] != tenant_id}
+
+    def vector_size(self, model_key, probe):
+        """按模型身份（工厂/模型名/服务地址）缓存向量维度，首次调用probe编码得到"""
+        with self._lock:
+            size = self._vector_sizes.get(model_key)
+        if size is None:
+            size = probe()
+            with self._lock:
+                self._vector_sizes[model_key] = size
+        return size
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
 class LLMBundle:
     """
        概述：LLM捆绑类，提供统一的LLM调用接口和监控功能
@@ -406,22 +490,20 @@ class LLMBundle:
         self.tenant_id = tenant_id
         self.llm_type = llm_type
         self.llm_name = llm_name
-        self.mdl = TenantLLMService.model_instance(tenant_id, llm_type, llm_name, lang=lang)
+        # 模型实例、配置和Langfuse客户端取自MODEL_REGISTRY，跨请求复用
+        self.mdl = MODEL_REGISTRY.get(tenant_id, ("model", llm_type, llm_name, lang), lambda: TenantLLMService.model_instance(tenant_id, llm_type, llm_name, lang=lang))
         assert self.mdl, "Can't find model for {}/{}/{}".format(tenant_id, llm_type, llm_name)
-        model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+        model_config = MODEL_REGISTRY.get(tenant_id, ("config", llm_type, llm_name), lambda: TenantLLMService.get_model_config(tenant_id, llm_type, llm_name))
         self.max_length = model_config.get("max_tokens", 8192)
+        # 嵌入缓存按模型身份（工厂/模型名/服务地址）寻址，跨租户共享
+        self.cache_model_key = "{}/{}@{}".format(model_config.get("llm_factory", ""), model_config.get("llm_name", llm_name), model_config.get("api_base", ""))
 
         self.is_tools = model_config.get("is_tools", False)
 
         # 初始化Langfuse监控
-        langfuse_keys = TenantLangfuseService.filter_by_tenant(tenant_id=tenant_id)
-        if langfuse_keys:
-            langfuse = Langfuse(public_key=langfuse_keys.public_key, secret_key=langfuse_keys.secret_key, host=langfuse_keys.host)
-            if langfuse.auth_check():
-                self.langfuse = langfuse
-                self.trace = self.langfuse.trace(name=f"{self.llm_type}-{self.llm_name}")
-        else:
-            self.langfuse = None
+        self.langfuse = MODEL_REGISTRY.get(tenant_id, ("langfuse",), lambda: tenant_langfuse(tenant_id))
+        if self.langfuse:
+            self.trace = self.langfuse.trace(name=f"{self.llm_type}-{self.llm_name}")
 
     def bind_tools(self, toolcall_session, tools):
         """
@@ -441,6 +523,8 @@ class LLMBundle:
         if not self.is_tools:
             logging.warning(f"Model {self.llm_name} does not support tool call, but you have assigned one or more tools to it!")
             return
+        # 模型实例由MODEL_REGISTRY共享，工具只绑定到本实例的浅拷贝上（HTTP客户端仍然共享）
+        self.mdl = copy.copy(self.mdl)
         self.mdl.bind_tools(toolcall_session, tools)
 
     def encode(self, texts: list):
@@ -449,7 +533,7 @@ class LLMBundle:
 
                 处理步骤：
                 1. 创建Langfuse生成记录（如果启用）
-                2. 调用模型的encode方法
+                2. 查询嵌入缓存，仅将未命中的文本交给模型的encode方法
                 3. 更新使用量统计
                 4. 记录监控信息
                 5. 返回编码结果
@@ -463,7 +547,7 @@ class LLMBundle:
         if self.langfuse:
             generation = self.trace.generation(name="encode", model=self.llm_name, input={"texts": texts})
 
-        embeddings, used_tokens = self.mdl.encode(texts)
+        embeddings, used_tokens = cached_encode(self.cache_model_key, texts, self.mdl.encode)
         llm_name = getattr(self, "llm_name", None)
         if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
             logging.error("LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -473,13 +557,22 @@ class LLMBundle:
 
         return embeddings, used_tokens
 
+    def vector_size(self):
+        """
+                概述：嵌入向量的维度，每个进程每个模型只编码一次探测文本
+
+                输出：
+                - 向量维度
+                """
+        return MODEL_REGISTRY.vector_size(self.cache_model_key, lambda: len(self.encode(["ok"])[0][0]))
+
     def encode_queries(self, query: str):
         """
                 概述：查询文本编码为向量
 
                 处理步骤：
                 1. 创建Langfuse生成记录（如果启用）
-                2. 调用模型的encode_queries方法
+                2. 查询嵌入缓存，未命中时调用模型的encode_queries方法
                 3. 更新使用量统计
                 4. 记录监控信息
                 5. 返回编码结果
@@ -493,7 +586,12 @@ class LLMBundle:
         if self.langfuse:
             generation = self.trace.generation(name="encode_queries", model=self.llm_name, input={"query": query})
 
-        emd, used_tokens = self.mdl.encode_queries(query)
+        def encode_queries(queries):
+            emd, used_tokens = self.mdl.encode_queries(queries[0])
+            return [emd], used_tokens
+
+        emds, used_tokens = cached_encode(self.cache_model_key, [query], encode_queries, kind="query")
+        emd = emds[0]
         llm_name = getattr(self, "llm_name", None)
         if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
             logging.error("LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
@@ -503,6 +601,36 @@ class LLMBundle:
 
         return emd, used_tokens
 
+    def encode_queries_many(self, queries: list):
+        """
+                概述：批量将多个查询文本编码为向量
+
+                处理步骤：
+                1. 创建Langfuse生成记录（如果启用）
+                2. 查询嵌入缓存，未命中的查询通过一次批量请求编码
+                3. 更新使用量统计
+                4. 记录监控信息
+                5. 返回编码结果
+
+                输入：
+                - queries: 待编码的查询文本列表
+
+                输出：
+                - (embeddings, used_tokens) 元组
+                """
+        if self.langfuse:
+            generation = self.trace.generation(name="encode_queries_many", model=self.llm_name, input={"queries": queries})
+
+        emds, used_tokens = cached_encode(self.cache_model_key, queries, self.mdl.encode_queries_batch, kind="query")
+        llm_name = getattr(self, "llm_name", None)
+        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, llm_name):
+            logging.error("LLMBundle.encode_queries_many can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
+
+        if self.langfuse:
+            generation.end(usage_details={"total_tokens": used_tokens})
+
+        return emds, used_tokens
+
     def similarity(self, query: str, texts: list):
         """
                 概述：计算查询与文本列表的相似度
@@ -13,29 +13,107 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
 import logging
+import math
 import os
 import random
+import re
+import zipfile
 import xxhash
+from io import BytesIO
 from datetime import datetime
 
 from api.db.db_utils import bulk_insert_into_db
 from deepdoc.parser import PdfParser
-from peewee import JOIN
+from peewee import JOIN, Case
 from api.db.db_models import DB, File2Document, File
 from api.db import StatusEnum, FileType, TaskStatus
 from api.db.db_models import Task, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
-from api.db.services.document_service import DocumentService
+from api.db.services.document_service import DocumentService, doc_cancel_key, keep_chunks_for_reuse
 from api.utils import current_timestamp, get_uuid
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
-from rag.settings import get_svr_queue_name
+from rag.settings import get_svr_queue_name, get_svr_queue_names, CHUNK_REUSE_ENABLED, SVR_CONSUMER_GROUP_NAME
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.redis_conn import REDIS_CONN
 from api import settings
 from rag.nlp import search
 
 
+# Task sizing: the parsing seconds a task is cut for, the estimated seconds per unit of each kind of
+# document (PDF page, Excel row, docx page, text line) and the fewest units worth a task of their own
+TASK_TARGET_SECONDS = float(os.environ.get("TASK_TARGET_SECONDS", 120))
+TASK_UNIT_SECONDS = {"pdf": 8.0, "table": 0.03, "docx": 1.0, "text": 0.002, "markdown": 0.004}
+TASK_MIN_UNITS = {"pdf": 1, "table": 500, "docx": 4, "text": 5000, "markdown": 5000}
+# Files smaller than that are never split
+TASK_SPLIT_MIN_BYTES = int(os.environ.get("TASK_SPLIT_MIN_BYTES", 2 * 1024 * 1024))
+# to_page of a task covering the rest of a document
+OPEN_END = 100000000
+# Heartbeats of task executors older than that are not trusted to tell whether they are idle
+TASK_SPLIT_HEARTBEAT_AGE = int(os.environ.get("TASK_SPLIT_HEARTBEAT_AGE", 90))
+
+
+def split_kind(doc_name: str, parser_id: str) -> str | None:
+    """The unit the tasks of a document can be cut along, if any, besides PDF pages and table rows."""
+    if parser_id != "naive":
+        return None
+    if re.search(r"\.docx$", doc_name, re.IGNORECASE):
+        return "docx"
+    if re.search(r"\.(md|markdown)$", doc_name, re.IGNORECASE):
+        return "markdown"
+    if re.search(r"\.(txt|py|js|java|c|cpp|h|php|go|ts|sh|cs|kt|sql)$", doc_name, re.IGNORECASE):
+        return "text"
+    return None
+
+
+def count_units(kind: str, binary: bytes) -> int:
+    """
+    Number of units of a document: lines of a text, or pages of a docx as its parser numbers them, from
+    the rendered and explicit page breaks. 0 when that can't be trusted: no break at all, or far fewer
+    pages than the docProps <Pages> of the last save, as in documents not laid out by the editor that
+    wrote them. The parser would then put most of the text in the first range.
+    """
+    if kind == "docx":
+        try:
+            with zipfile.ZipFile(BytesIO(binary)) as z:
+                xml = z.read("word/document.xml")
+                try:
+                    m = re.search(rb"<Pages>(\d+)</Pages>", z.read("docProps/app.xml"))
+                except KeyError:
+                    m = None
+        except Exception:
+            return 0
+        pages = len(re.findall(rb"<w:lastRenderedPageBreak\s*/>|<w:br\s[^>]*w:type=\"page\"", xml)) + 1
+        if pages < 2 or (m and pages < int(m.group(1)) / 2):
+            return 0
+        return pages
+    return binary.count(b"\n") + 1
+
+
+def unit_ranges(kind: str, units: int) -> list[tuple[int, int]]:
+    """Balanced [from, to) ranges of about TASK_TARGET_SECONDS each, the last one open ended."""
+    per_task = max(TASK_MIN_UNITS[kind], int(TASK_TARGET_SECONDS / TASK_UNIT_SECONDS[kind]))
+    n = max(1, math.ceil(units / per_task))
+    size = math.ceil(units / n) if units else OPEN_END
+    ranges = [(i * size, (i + 1) * size) for i in range(n)]
+    ranges[-1] = (ranges[-1][0], OPEN_END)
+    return ranges
+
+
+def task_digest(chunking_config: dict, task: dict) -> str:
+    hasher = xxhash.xxh64()
+    for field in sorted(chunking_config.keys()):
+        if field == "parser_config":
+            for k in ["raptor", "graphrag"]:
+                if k in chunking_config[field]:
+                    del chunking_config[field][k]
+        hasher.update(str(chunking_config[field]).encode("utf-8"))
+    for field in ["doc_id", "from_page", "to_page"]:
+        hasher.update(str(task.get(field, "")).encode("utf-8"))
+    return hasher.hexdigest()
+
+
 def trim_header_by_lines(text: str, max_length) -> str:
     # Trim header text to maximum length while preserving line breaks
     # Args:
@@ -89,6 +167,7 @@ class TaskService(CommonService):
             cls.model.doc_id,
             cls.model.from_page,
             cls.model.to_page,
+            cls.model.priority,
             cls.model.retry_count,
             Document.kb_id,
             Document.parser_id,
@@ -309,6 +388,42 @@ class TaskService(CommonService):
                 ).execute()
 
 
+    @classmethod
+    @DB.connection_context()
+    def update_progress_batch(cls, updates: dict):
+        """Apply the progress updates of several tasks at once, following the rules of update_progress.
+
+        The progress messages of the tasks are read in one query, then both columns are written in one
+        UPDATE built from CASE expressions.
+
+        Args:
+            updates (dict): Task id to dictionary with the same keys as the `info` of update_progress.
+        """
+        if not updates:
+            return
+        with DB.lock("update_progress", -1):
+            msgs = {t.id: t.progress_msg for t in cls.model.select(cls.model.id, cls.model.progress_msg).where(cls.model.id.in_(list(updates.keys())))}
+            msg_cases, prog_cases = [], []
+            for id, info in updates.items():
+                if id not in msgs:
+                    continue
+                if info.get("progress_msg"):
+                    msg_cases.append((cls.model.id == id, trim_header_by_lines(msgs[id] + "\n" + info["progress_msg"], 3000)))
+                if "progress" in info:
+                    prog = info["progress"]
+                    cond = (cls.model.id == id) & (cls.model.progress != -1)
+                    if prog != -1:
+                        cond &= cls.model.progress < prog
+                    prog_cases.append((cond, prog))
+            fields = {}
+            if msg_cases:
+                fields[cls.model.progress_msg] = Case(None, msg_cases, cls.model.progress_msg)
+            if prog_cases:
+                fields[cls.model.progress] = Case(None, prog_cases, cls.model.progress)
+            if fields:
+                cls.model.update(fields).where(cls.model.id.in_(list(msgs.keys()))).execute()
+
+
 def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
     """Create and queue document processing tasks.
     
@@ -362,25 +477,23 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
             task["from_page"] = i
             task["to_page"] = min(i + 3000, rn)
             parse_task_array.append(task)
+    elif split_kind(doc["name"], doc["parser_id"]) and doc["size"] >= TASK_SPLIT_MIN_BYTES:
+        kind = split_kind(doc["name"], doc["parser_id"])
+        for s, e in unit_ranges(kind, count_units(kind, STORAGE_IMPL.get(bucket, name))):
+            task = new_task()
+            task["from_page"] = s
+            task["to_page"] = e
+            parse_task_array.append(task)
     else:
         parse_task_array.append(new_task())
 
     chunking_config = DocumentService.get_chunking_config(doc["id"])
     for task in parse_task_array:
-        hasher = xxhash.xxh64()
-        for field in sorted(chunking_config.keys()):
-            if field == "parser_config":
-                for k in ["raptor", "graphrag"]:
-                    if k in chunking_config[field]:
-                        del chunking_config[field][k]
-            hasher.update(str(chunking_config[field]).encode("utf-8"))
-        for field in ["doc_id", "from_page", "to_page"]:
-            hasher.update(str(task.get(field, "")).encode("utf-8"))
-        task_digest = hasher.hexdigest()
-        task["digest"] = task_digest
+        task["digest"] = task_digest(chunking_config, task)
         task["progress"] = 0.0
         task["priority"] = priority
 
+    REDIS_CONN.delete(doc_cancel_key(doc["id"]))
     prev_tasks = TaskService.get_tasks(doc["id"])
     ck_num = 0
     if prev_tasks:
@@ -391,7 +504,9 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
         for task in prev_tasks:
             if task["chunk_ids"]:
                 chunk_ids.extend(task["chunk_ids"].split())
-        if chunk_ids:
+        if chunk_ids and CHUNK_REUSE_ENABLED:
+            keep_chunks_for_reuse(doc["id"], chunking_config["tenant_id"], chunking_config["kb_id"], chunk_ids)
+        elif chunk_ids:
             settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(chunking_config["tenant_id"]),
                                          chunking_config["kb_id"])
     DocumentService.update_by_id(doc["id"], {"chunk_num": ck_num})
@@ -406,6 +521,75 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
         ), "Can't access Redis. Please check the Redis' status."
 
 
+def idle_task_executors(exclude: str | None = None) -> list[str]:
+    """Task executors whose last heartbeat shows a free task slot: fewer tasks running and fetched ahead than they can run."""
+    idle = []
+    now = datetime.now().timestamp()
+    for name in REDIS_CONN.smembers("TASKEXE") or []:
+        if name == exclude:
+            continue
+        heartbeats = REDIS_CONN.zrangebyscore(name, now - TASK_SPLIT_HEARTBEAT_AGE, now + 10)
+        if not heartbeats:
+            continue
+        try:
+            heartbeat = json.loads(heartbeats[-1])
+        except Exception:
+            continue
+        if "max_tasks" not in heartbeat:
+            # Executor of an older version, its load is unknown.
+            continue
+        if len(heartbeat.get("current") or {}) + int(heartbeat.get("fetched", 0)) < int(heartbeat["max_tasks"]):
+            idle.append(name)
+    return idle
+
+
+def split_task_for_idle_peers(task: dict, consumer_name: str | None = None) -> dict | None:
+    """Cut the rest of a task's range off into a new queued task, when another executor sits idle.
+
+    The executor that picks a task up calls it, so that a large range is shared with idle executors
+    instead of keeping the others waiting; the new task can be cut again by whoever picks it up.
+    Executors fetch tasks ahead of running them, so an empty queue does not mean anybody is idle:
+    the heartbeats of the executors tell, see idle_task_executors.
+
+    Args:
+        task (dict): Task as returned by TaskService.get_task, updated in place.
+        consumer_name (str | None): The calling executor, which does not count as idle.
+
+    Returns:
+        dict | None: The new task, or None if the task was not split.
+    """
+    if task.get("task_type"):
+        return None
+    if task["type"] == FileType.PDF.value:
+        # Parsers reading page ranges, not whole-document ones
+        paged = task["parser_id"] in ["naive", "paper", "book", "laws", "manual"] and task["parser_config"].get("layout_recognize", "DeepDOC") == "DeepDOC"
+        kind = "pdf" if paged else None
+    else:
+        kind = "table" if task["parser_id"] == "table" else split_kind(task["name"], task["parser_id"])
+    span = task["to_page"] - task["from_page"]
+    if not kind or task["to_page"] >= OPEN_END or span < 2 * TASK_MIN_UNITS[kind]:
+        return None
+    if span * TASK_UNIT_SECONDS[kind] < TASK_TARGET_SECONDS:
+        return None
+    for queue_name in get_svr_queue_names():
+        info = REDIS_CONN.queue_info(queue_name, SVR_CONSUMER_GROUP_NAME)
+        if info is None or int(info.get("lag") or 0) > 0:
+            return None
+    if not idle_task_executors(consumer_name):
+        return None
+
+    mid = task["from_page"] + span // 2
+    chunking_config = DocumentService.get_chunking_config(task["doc_id"])
+    rest = {"id": get_uuid(), "doc_id": task["doc_id"], "progress": 0.0, "from_page": mid, "to_page": task["to_page"],
+            "priority": task.get("priority", 0)}
+    rest["digest"] = task_digest(chunking_config, rest)
+    task["to_page"] = mid
+    TaskService.update_by_id(task["id"], {"to_page": mid, "digest": task_digest(chunking_config, task)})
+    bulk_insert_into_db(Task, [rest], True)
+    assert REDIS_CONN.queue_product(get_svr_queue_name(rest["priority"]), message=rest), "Can't access Redis. Please check the Redis' status."
+    return rest
+
+
 def reuse_prev_task_chunks(task: dict, prev_tasks: list[dict], chunking_config: dict):
     """Attempt to reuse chunks from previous tasks for optimization.
     
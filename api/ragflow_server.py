@@ -44,6 +44,7 @@ from api.versions import get_ragflow_version
 from api.utils import show_configs
 from rag.settings import print_rag_settings
 from rag.utils.redis_conn import RedisDistributedLock
+from rag.utils.startup_report import log_startup_report
 
 stop_event = threading.Event()
 
@@ -135,6 +136,8 @@ if __name__ == '__main__':
     else:
         threading.Timer(1.0, delayed_start_update_progress).start()
 
+    log_startup_report("RAGFlow HTTP server")
+
     # start http server
     try:
         logging.info("RAGFlow HTTP server start...")
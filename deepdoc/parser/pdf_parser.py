@@ -19,7 +19,9 @@ import os
 import random
 import re
 import sys
+import tempfile
 import threading
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 from io import BytesIO
 from timeit import default_timer as timer
@@ -38,13 +40,140 @@ from deepdoc.vision import OCR, LayoutRecognizer, Recognizer, TableStructureReco
 from rag.app.picture import vision_llm_chunk as picture_vision_llm_chunk
 from rag.nlp import rag_tokenizer
 from rag.prompts import vision_llm_describe_prompt
-from rag.settings import PARALLEL_DEVICES
+from rag.settings import PARALLEL_DEVICES, PDF_PARSER_PROCESSES, PDF_PARSER_PAGES_PER_SHARD, OCR_PAGE_CONCURRENCY
 
 LOCK_KEY_pdfplumber = "global_shared_lock_pdfplumber"
 if LOCK_KEY_pdfplumber not in sys.modules:
     sys.modules[LOCK_KEY_pdfplumber] = threading.Lock()
 
 
+def _space_chars(chars):
+    # Insert the spaces pdfplumber drops between latin words.
+    j = 0
+    while j + 1 < len(chars):
+        if chars[j]["text"] and chars[j + 1]["text"] \
+                and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                               chars[j]["width"]) / 2:
+            chars[j]["text"] += " "
+        j += 1
+    return chars
+
+
+def _ocr_page(ocr, pagenum, img, chars, mean_height, ZM=3, device_id: int | None = None):
+    """
+    OCR one page and fill its text boxes with the PDF characters they cover.
+    Returns (boxes, characters outside of any box, mean character height of the page).
+    """
+    start = timer()
+    bxs = ocr.detect(np.array(img), device_id)
+    logging.info(f"__ocr detecting boxes of a image cost ({timer() - start}s)")
+
+    start = timer()
+    if not bxs:
+        return [], [], mean_height
+    lefted_chars = []
+    bxs = [(line[0], line[1][0]) for line in bxs]
+    bxs = Recognizer.sort_Y_firstly(
+        [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
+          "top": b[0][1] / ZM, "text": "", "txt": t,
+          "bottom": b[-1][1] / ZM,
+          "chars": [],
+          "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
+        mean_height / 3
+    )
+
+    # merge chars in the same rect
+    for c in chars:
+        ii = Recognizer.find_overlapped(c, bxs)
+        if ii is None:
+            lefted_chars.append(c)
+            continue
+        ch = c["bottom"] - c["top"]
+        bh = bxs[ii]["bottom"] - bxs[ii]["top"]
+        if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
+            lefted_chars.append(c)
+            continue
+        bxs[ii]["chars"].append(c)
+
+    for b in bxs:
+        if not b["chars"]:
+            del b["chars"]
+            continue
+        m_ht = np.mean([c["height"] for c in b["chars"]])
+        for c in Recognizer.sort_Y_firstly(b["chars"], m_ht):
+            if c["text"] == " " and b["text"]:
+                if re.match(r"[0-9a-zA-Zа-яА-Я,.?;:!%%]", b["text"][-1]):
+                    b["text"] += " "
+            else:
+                b["text"] += c["text"]
+        del b["chars"]
+
+    logging.info(f"__ocr sorting {len(chars)} chars cost {timer() - start}s")
+    start = timer()
+    boxes_to_reg = []
+    img_np = np.array(img)
+    for b in bxs:
+        if not b["text"]:
+            left, right, top, bott = b["x0"] * ZM, b["x1"] * \
+                                     ZM, b["top"] * ZM, b["bottom"] * ZM
+            b["box_image"] = ocr.get_rotate_crop_image(img_np, np.array([[left, top], [right, top], [right, bott], [left, bott]], dtype=np.float32))
+            boxes_to_reg.append(b)
+        del b["txt"]
+    texts = ocr.recognize_batch([b["box_image"] for b in boxes_to_reg], device_id)
+    for i in range(len(boxes_to_reg)):
+        boxes_to_reg[i]["text"] = texts[i]
+        del boxes_to_reg[i]["box_image"]
+    logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s")
+    bxs = [b for b in bxs if b["text"]]
+    if mean_height == 0:
+        mean_height = np.median([b["bottom"] - b["top"]
+                                 for b in bxs])
+    return bxs, lefted_chars, mean_height
+
+
+# Page-sharded parsing: each worker process keeps its own OCR, layout and table models.
+_page_pool = None
+_page_pool_lock = threading.Lock()
+_worker_models = {}
+
+
+def _get_page_pool():
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            import multiprocessing
+            _page_pool = ProcessPoolExecutor(max_workers=PDF_PARSER_PROCESSES,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return _page_pool
+
+
+def _worker_model(name, domain=None):
+    if name not in _worker_models:
+        if name == "ocr":
+            _worker_models[name] = OCR()
+        elif name == "tbl_det":
+            _worker_models[name] = TableStructureRecognizer()
+        else:
+            _worker_models[name] = LayoutRecognizer(domain)
+    return _worker_models[name]
+
+
+def _parse_page_shard(fnm, page_from, page_to, rel_from, zoomin, page_chars, mean_heights, layout_domain):
+    """Render, OCR and detect the layouts of the pages [page_from, page_to) of a PDF file."""
+    with pdfplumber.open(fnm) as pdf:
+        images = [p.to_image(resolution=72 * zoomin, antialias=True).annotated for p in pdf.pages[page_from:page_to]]
+    ocr = _worker_model("ocr")
+    pages = [_ocr_page(ocr, rel_from + i + 1, img, chars, mh, zoomin)
+             for i, (img, chars, mh) in enumerate(zip(images, page_chars, mean_heights))]
+    layouts = _worker_model("layout:" + layout_domain, layout_domain).detect(images)
+    return images, pages, layouts
+
+
+def _detect_table_shard(imgs):
+    return _worker_model("tbl_det")(imgs)
+
+
 class RAGFlowPdfParser:
     def __init__(self, **kwargs):
         """
@@ -65,9 +194,10 @@ class RAGFlowPdfParser:
             self.parallel_limiter = [trio.CapacityLimiter(1) for _ in range(PARALLEL_DEVICES)]
 
         if hasattr(self, "model_speciess"):
-            self.layouter = LayoutRecognizer("layout." + self.model_speciess)
+            self.layout_domain = "layout." + self.model_speciess
         else:
-            self.layouter = LayoutRecognizer("layout")
+            self.layout_domain = "layout"
+        self.layouter = LayoutRecognizer(self.layout_domain)
         self.tbl_det = TableStructureRecognizer()
 
         self.updown_cnt_mdl = xgb.Booster()
@@ -227,7 +357,7 @@ class RAGFlowPdfParser:
         assert len(self.page_images) == len(tbcnt) - 1
         if not imgs:
             return
-        recos = self.tbl_det(imgs)
+        recos = self._detect_tables(imgs)
         tbcnt = np.cumsum(tbcnt)
         for i in range(len(tbcnt) - 1):  # for page
             pg = []
@@ -294,76 +424,14 @@ class RAGFlowPdfParser:
                 b["SP"] = ii
 
     def __ocr(self, pagenum, img, chars, ZM=3, device_id: int | None = None):
-        start = timer()
-        bxs = self.ocr.detect(np.array(img), device_id)
-        logging.info(f"__ocr detecting boxes of a image cost ({timer() - start}s)")
-
-        start = timer()
-        if not bxs:
-            self.boxes.append([])
-            return
-        bxs = [(line[0], line[1][0]) for line in bxs]
-        bxs = Recognizer.sort_Y_firstly(
-            [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
-              "top": b[0][1] / ZM, "text": "", "txt": t,
-              "bottom": b[-1][1] / ZM,
-              "chars": [],
-              "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[pagenum-1] / 3
-        )
-
-        # merge chars in the same rect
-        for c in chars:
-            ii = Recognizer.find_overlapped(c, bxs)
-            if ii is None:
-                self.lefted_chars.append(c)
-                continue
-            ch = c["bottom"] - c["top"]
-            bh = bxs[ii]["bottom"] - bxs[ii]["top"]
-            if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
-                self.lefted_chars.append(c)
-                continue
-            bxs[ii]["chars"].append(c)
-
-        for b in bxs:
-            if not b["chars"]:
-                del b["chars"]
-                continue
-            m_ht = np.mean([c["height"] for c in b["chars"]])
-            for c in Recognizer.sort_Y_firstly(b["chars"], m_ht):
-                if c["text"] == " " and b["text"]:
-                    if re.match(r"[0-9a-zA-Zа-яА-Я,.?;:!%%]", b["text"][-1]):
-                        b["text"] += " "
-                else:
-                    b["text"] += c["text"]
-            del b["chars"]
-
-        logging.info(f"__ocr sorting {len(chars)} chars cost {timer() - start}s")
-        start = timer()
-        boxes_to_reg = []
-        img_np = np.array(img)
-        for b in bxs:
-            if not b["text"]:
-                left, right, top, bott = b["x0"] * ZM, b["x1"] * \
-                                         ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["box_image"] = self.ocr.get_rotate_crop_image(img_np, np.array([[left, top], [right, top], [right, bott], [left, bott]], dtype=np.float32))
-                boxes_to_reg.append(b)
-            del b["txt"]
-        texts = self.ocr.recognize_batch([b["box_image"] for b in boxes_to_reg], device_id)
-        for i in range(len(boxes_to_reg)):
-            boxes_to_reg[i]["text"] = texts[i]
-            del boxes_to_reg[i]["box_image"]
-        logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s")
-        bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[pagenum-1] == 0:
-            self.mean_height[pagenum-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+        bxs, lefted_chars, self.mean_height[pagenum - 1] = _ocr_page(self.ocr, pagenum, img, chars,
+                                                                     self.mean_height[pagenum - 1], ZM, device_id)
+        return bxs, lefted_chars
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
         self.boxes, self.page_layout = self.layouter(
-            self.page_images, self.boxes, ZM, drop=drop)
+            self.page_images, self.boxes, ZM, drop=drop, layouts=getattr(self, "page_layout_dets", None))
         # cumlative Y
         for i in range(len(self.boxes)):
             self.boxes[i]["top"] += \
@@ -1009,14 +1077,21 @@ class RAGFlowPdfParser:
         self.garbages = {}
         self.page_cum_height = [0]
         self.page_layout = []
+        self.page_layout_dets = None
         self.page_from = page_from
+        self.page_images = []
+        page_cnt = 0
+        sharded = self._page_sharded()
         start = timer()
         try:
             with sys.modules[LOCK_KEY_pdfplumber]:
                 with (pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm))) as pdf:
                     self.pdf = pdf
-                    self.page_images = [p.to_image(resolution=72 * zoomin, antialias=True).annotated for i, p in
-                                        enumerate(self.pdf.pages[page_from:page_to])]
+                    page_cnt = len(self.pdf.pages[page_from:page_to])
+                    # In page-sharded mode the worker processes render the pages.
+                    if not sharded:
+                        self.page_images = [p.to_image(resolution=72 * zoomin, antialias=True).annotated for i, p in
+                                            enumerate(self.pdf.pages[page_from:page_to])]
 
                     try:
                         self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in self.pdf.pages[page_from:page_to]]
@@ -1056,27 +1131,23 @@ class RAGFlowPdfParser:
         self.is_english = [re.search(r"[a-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}", "".join(
             random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
             range(len(self.page_chars))]
-        if sum([1 if e else 0 for e in self.is_english]) > len(
-                self.page_images) / 2:
+        if sum([1 if e else 0 for e in self.is_english]) > page_cnt / 2:
             self.is_english = True
         else:
             self.is_english = False
 
+        # Pages are OCRed concurrently so that their model inferences get batched together; their
+        # results are collected in page order.
+        page_results = [None] * len(self.page_images)
+
         async def __img_ocr(i, id, img, chars, limiter):
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
+            _space_chars(chars)
 
             if limiter:
                 async with limiter:
-                    await trio.to_thread.run_sync(lambda: self.__ocr(i + 1, img, chars, zoomin, id))
+                    page_results[i] = await trio.to_thread.run_sync(lambda: self.__ocr(i + 1, img, chars, zoomin, id))
             else:
-                self.__ocr(i + 1, img, chars, zoomin, id)
+                page_results[i] = self.__ocr(i + 1, img, chars, zoomin, id)
 
             if callback and i % 6 == 5:
                 callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
@@ -1101,6 +1172,12 @@ class RAGFlowPdfParser:
                         nursery.start_soon(__img_ocr, i, i % PARALLEL_DEVICES, img, chars,
                                            self.parallel_limiter[i % PARALLEL_DEVICES])
                         await trio.sleep(0.1)
+            elif OCR_PAGE_CONCURRENCY > 1:
+                limiter = trio.CapacityLimiter(OCR_PAGE_CONCURRENCY)
+                async with trio.open_nursery() as nursery:
+                    for i, img in enumerate(self.page_images):
+                        chars = __ocr_preprocess()
+                        nursery.start_soon(__img_ocr, i, 0, img, chars, limiter)
             else:
                 for i, img in enumerate(self.page_images):
                     chars = __ocr_preprocess()
@@ -1108,7 +1185,13 @@ class RAGFlowPdfParser:
 
         start = timer()
 
-        trio.run(__img_ocr_launcher)
+        if sharded:
+            self._parse_pages_sharded(fnm, zoomin, page_from, page_cnt, callback)
+        else:
+            trio.run(__img_ocr_launcher)
+            for bxs, lefted_chars in page_results:
+                self.lefted_chars.extend(lefted_chars)
+                self.boxes.append(bxs)
 
         logging.info(f"__images__ {len(self.page_images)} pages cost {timer() - start}s")
 
@@ -1125,6 +1208,61 @@ class RAGFlowPdfParser:
         if len(self.boxes) == 0 and zoomin < 9:
             self.__images__(fnm, zoomin * 3, page_from, page_to, callback)
 
+    def _page_sharded(self):
+        # GPUs are shared through the per-device limiters instead.
+        return PDF_PARSER_PROCESSES > 1 and not self.parallel_limiter
+
+    def _parse_pages_sharded(self, fnm, zoomin, page_from, page_cnt, callback=None):
+        """
+        Render, OCR and detect the layouts of the pages in the process pool, PDF_PARSER_PAGES_PER_SHARD
+        pages per job. The results are merged in page order, so the outcome doesn't depend on which
+        worker finishes first.
+        """
+        page_chars = []
+        for i in range(page_cnt):
+            chars = self.page_chars[i] if not self.is_english else []
+            self.mean_height.append(
+                np.median(sorted([c["height"] for c in chars])) if chars else 0
+            )
+            self.mean_width.append(
+                np.median(sorted([c["width"] for c in chars])) if chars else 8
+            )
+            page_chars.append(_space_chars(chars))
+
+        path, tmp = fnm, None
+        if not isinstance(fnm, str):
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+                f.write(fnm)
+                path = tmp = f.name
+        try:
+            pool = _get_page_pool()
+            futures = []
+            for s in range(0, page_cnt, PDF_PARSER_PAGES_PER_SHARD):
+                e = min(s + PDF_PARSER_PAGES_PER_SHARD, page_cnt)
+                futures.append(pool.submit(_parse_page_shard, path, page_from + s, page_from + e, s, zoomin,
+                                           page_chars[s:e], self.mean_height[s:e], self.layout_domain))
+            self.page_layout_dets = []
+            for fut in futures:
+                images, pages, layouts = fut.result()
+                for img, (bxs, lefted_chars, mean_height) in zip(images, pages):
+                    self.mean_height[len(self.page_images)] = mean_height
+                    self.page_images.append(img)
+                    self.page_cum_height.append(img.size[1] / zoomin)
+                    self.lefted_chars.extend(lefted_chars)
+                    self.boxes.append(bxs)
+                self.page_layout_dets.extend(layouts)
+                if callback:
+                    callback(prog=len(self.page_images) * 0.6 / page_cnt, msg="")
+        finally:
+            if tmp:
+                os.remove(tmp)
+
+    def _detect_tables(self, imgs):
+        if not self._page_sharded() or len(imgs) <= PDF_PARSER_PAGES_PER_SHARD:
+            return self.tbl_det(imgs)
+        shards = [imgs[i:i + PDF_PARSER_PAGES_PER_SHARD] for i in range(0, len(imgs), PDF_PARSER_PAGES_PER_SHARD)]
+        return [r for rs in _get_page_pool().map(_detect_table_shard, shards) for r in rs]
+
     def __call__(self, fnm, need_image=True, zoomin=3, return_html=False):
         self.__images__(fnm, zoomin)
         self._layouts_rec(zoomin)
@@ -30,3 +30,23 @@ def get_text(fnm: str, binary=None) -> str:
                     break
                 txt += line
     return txt
+
+
+def line_range(binary: bytes, from_line: int, to_line: int, snap=200) -> bytes:
+    """
+    Lines [from_line, to_line) of a text. Both bounds move forward to just after a blank line, if one comes
+    within `snap` lines, so that adjacent ranges neither cut a paragraph nor overlap.
+    """
+    lines = binary.split(b"\n")
+
+    def bound(i):
+        if i <= 0:
+            return 0
+        if i >= len(lines):
+            return len(lines)
+        for j in range(i, min(i + snap, len(lines))):
+            if not lines[j - 1].strip():
+                return j
+        return i
+
+    return b"\n".join(lines[bound(from_line):bound(to_line)])
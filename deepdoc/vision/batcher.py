@@ -0,0 +1,124 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import threading
+import time
+
+from rag.settings import ONNX_BATCH_WAIT_MS
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+class _Request:
+    def __init__(self, items):
+        self.items = items
+        self.since = time.monotonic()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class InferenceBatcher:
+    """
+    Coalesces the inference requests made on one ONNX session by concurrent callers (pages OCRed at the
+    same time, parsing tasks of the same executor) into larger batches.
+
+    Requests are bucketed by `key`, typically the input tensor shape, so that only inputs which can be
+    stacked together are batched. A bucket is run as soon as it holds `batch_size` items or its oldest
+    request has waited `max_wait` seconds. `run(items)` gets the items of every request in the bucket
+    and must return one result per item; it is expected to split them into batches of `batch_size`.
+    """
+
+    def __init__(self, name, run, batch_size, max_wait=ONNX_BATCH_WAIT_MS / 1000):
+        self.name = name
+        self.run = run
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._thread = None
+
+    def __call__(self, items, key=None):
+        if not items:
+            return []
+        if self.max_wait <= 0:
+            return self.run(items)
+        req = _Request(items)
+        with self._cond:
+            self._pending.setdefault(key, []).append(req)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=f"batcher-{self.name}", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.results
+
+    def _next_bucket(self):
+        # Called with the lock held: the bucket to run now, or None and how long to wait for one.
+        now = time.monotonic()
+        wait = self.max_wait
+        for key, reqs in self._pending.items():
+            left = reqs[0].since + self.max_wait - now
+            if left <= 0 or sum(len(r.items) for r in reqs) >= self.batch_size:
+                return key, 0
+            wait = min(wait, left)
+        return None, wait
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                key, wait = self._next_bucket()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                reqs = self._pending.pop(key)
+            self._run(reqs)
+
+    def _run(self, reqs):
+        items = [it for r in reqs for it in r.items]
+        try:
+            results = self.run(items)
+            logging.debug(f"{self.name}: ran {len(items)} items of {len(reqs)} requests")
+            s = 0
+            for r in reqs:
+                r.results = results[s:s + len(r.items)]
+                s += len(r.items)
+        except Exception as e:
+            for r in reqs:
+                r.error = e
+        finally:
+            for r in reqs:
+                r.done.set()
+
+
+def get_batcher(sess, name, run, batch_size):
+    """The batcher of the ONNX session `sess`, which load_model shares between the models using it."""
+    with _batchers_lock:
+        key = (id(sess), name)
+        if key not in _batchers:
+            _batchers[key] = InferenceBatcher(name, run, batch_size)
+        return _batchers[key]
+
+
+def dynamic_batch(sess):
+    """Whether the first input of the ONNX session takes any batch size."""
+    dim = sess.get_inputs()[0].shape[0]
+    return not isinstance(dim, int) or dim <= 0
@@ -61,7 +61,13 @@ class LayoutRecognizer(Recognizer):
             from deepdoc.vision.dla_cli import DLAClient
             self.client = DLAClient(os.environ["TENSORRT_DLA_SVR"])
 
-    def __call__(self, image_list, ocr_res, scale_factor=3, thr=0.2, batch_size=16, drop=True):
+    def detect(self, image_list, thr=0.2, batch_size=16):
+        """Raw layout detection of every page, the part of __call__ that doesn't depend on the other pages."""
+        if self.client:
+            return self.client.predict(image_list)
+        return super().__call__(image_list, thr, batch_size)
+
+    def __call__(self, image_list, ocr_res, scale_factor=3, thr=0.2, batch_size=16, drop=True, layouts=None):
         def __is_garbage(b):
             patt = [r"^•+$", "^[0-9]{1,2} / ?[0-9]{1,2}$",
                     r"^[0-9]{1,2} of [0-9]{1,2}$", "^http://[^ ]{12,}",
@@ -69,10 +75,8 @@ class LayoutRecognizer(Recognizer):
                     ]
             return any([re.search(p, b["text"]) for p in patt])
 
-        if self.client:
-            layouts = self.client.predict(image_list)
-        else:
-            layouts = super().__call__(image_list, thr, batch_size)
+        if layouts is None:
+            layouts = self.detect(image_list, thr, batch_size)
         # save_results(image_list, layouts, self.labels, output_dir='output/', threshold=0.7)
         assert len(image_list) == len(ocr_res)
         # Tag layout type
@@ -22,7 +22,7 @@ import os
 from huggingface_hub import snapshot_download
 
 from api.utils.file_utils import get_project_base_directory
-from rag.settings import PARALLEL_DEVICES
+from rag.settings import PARALLEL_DEVICES, ONNX_BATCH_SIZE, OCR_DET_BATCH_SIZE
 from .operators import *  # noqa: F403
 from . import operators
 import math
@@ -31,6 +31,7 @@ import cv2
 import onnxruntime as ort
 
 from .postprocess import build_post_process
+from .batcher import get_batcher, dynamic_batch
 
 loaded_models = {}
 
@@ -128,7 +129,7 @@ def load_model(model_dir, nm, device_id: int | None = None):
 class TextRecognizer:
     def __init__(self, model_dir, device_id: int | None = None):
         self.rec_image_shape = [int(v) for v in "3, 48, 320".split(",")]
-        self.rec_batch_num = 16
+        self.rec_batch_num = ONNX_BATCH_SIZE
         postprocess_params = {
             'name': 'CTCLabelDecode',
             "character_dict_path": os.path.join(model_dir, "ocr.res"),
@@ -137,6 +138,8 @@ class TextRecognizer:
         self.postprocess_op = build_post_process(postprocess_params)
         self.predictor, self.run_options = load_model(model_dir, 'rec', device_id)
         self.input_tensor = self.predictor.get_inputs()[0]
+        # Crops of all the pages being recognized at the same time are sorted and batched together.
+        self.batcher = get_batcher(self.predictor, "rec", self._recognize, self.rec_batch_num)
 
     def resize_norm_img(self, img, max_wh_ratio):
         imgC, imgH, imgW = self.rec_image_shape
@@ -349,6 +352,10 @@ class TextRecognizer:
         return img
 
     def __call__(self, img_list):
+        st = time.time()
+        return self.batcher(img_list), time.time() - st
+
+    def _recognize(self, img_list):
         img_num = len(img_list)
         # Calculate the aspect ratio of all text bars
         width_list = []
@@ -358,7 +365,6 @@ class TextRecognizer:
         indices = np.argsort(np.array(width_list))
         rec_res = [['', 0.0]] * img_num
         batch_num = self.rec_batch_num
-        st = time.time()
 
         for beg_img_no in range(0, img_num, batch_num):
             end_img_no = min(img_num, beg_img_no + batch_num)
@@ -393,7 +399,7 @@ class TextRecognizer:
             for rno in range(len(rec_result)):
                 rec_res[indices[beg_img_no + rno]] = rec_result[rno]
 
-        return rec_res, time.time() - st
+        return rec_res
 
 
 class TextDetector:
@@ -434,6 +440,10 @@ class TextDetector:
                 }
             }
         self.preprocess_op = create_operators(pre_process_list)
+        # Pages resized to the same shape are detected together, if the model takes a batch of them.
+        self.batcher = None
+        if dynamic_batch(self.predictor):
+            self.batcher = get_batcher(self.predictor, "det", self._detect, OCR_DET_BATCH_SIZE)
 
     def order_points_clockwise(self, pts):
         rect = np.zeros((4, 2), dtype="float32")
@@ -491,23 +501,32 @@ class TextDetector:
         img = np.expand_dims(img, axis=0)
         shape_list = np.expand_dims(shape_list, axis=0)
         img = img.copy()
-        input_dict = {}
-        input_dict[self.input_tensor.name] = img
-        for i in range(100000):
-            try:
-                outputs = self.predictor.run(None, input_dict, self.run_options)
-                break
-            except Exception as e:
-                if i >= 3:
-                    raise e
-                time.sleep(5)
-
-        post_result = self.postprocess_op({"maps": outputs[0]}, shape_list)
+        if self.batcher:
+            maps = self.batcher([img], key=img.shape)[0]
+        else:
+            maps = self._detect([img])[0]
+
+        post_result = self.postprocess_op({"maps": maps}, shape_list)
         dt_boxes = post_result[0]['points']
         dt_boxes = self.filter_tag_det_res(dt_boxes, ori_im.shape)
 
         return dt_boxes, time.time() - st
 
+    def _detect(self, imgs):
+        maps = []
+        for s in range(0, len(imgs), OCR_DET_BATCH_SIZE):
+            input_dict = {self.input_tensor.name: np.concatenate(imgs[s:s + OCR_DET_BATCH_SIZE])}
+            for i in range(100000):
+                try:
+                    outputs = self.predictor.run(None, input_dict, self.run_options)
+                    break
+                except Exception as e:
+                    if i >= 3:
+                        raise e
+                    time.sleep(5)
+            maps.extend(outputs[0][j:j + 1] for j in range(len(outputs[0])))
+        return maps
+
 
 class OCR:
     def __init__(self, model_dir=None):
@@ -588,26 +607,13 @@ class OCR:
             flags=cv2.INTER_CUBIC)
         dst_img_height, dst_img_width = dst_img.shape[0:2]
         if dst_img_height * 1.0 / dst_img_width >= 1.5:
-            # Try original orientation
-            rec_result = self.text_recognizer[0]([dst_img])
-            text, score = rec_result[0][0]
-            best_score = score
-            best_img = dst_img
-
-            # Try clockwise 90° rotation
-            rotated_cw = np.rot90(dst_img, k=3)
-            rec_result = self.text_recognizer[0]([rotated_cw])
-            rotated_cw_text, rotated_cw_score = rec_result[0][0]
-            if rotated_cw_score > best_score:
-                best_score = rotated_cw_score
-                best_img = rotated_cw
-
-            # Try counter-clockwise 90° rotation
-            rotated_ccw = np.rot90(dst_img, k=1)
-            rec_result = self.text_recognizer[0]([rotated_ccw])
-            rotated_ccw_text, rotated_ccw_score = rec_result[0][0]
-            if rotated_ccw_score > best_score:
-                best_img = rotated_ccw
+            # Try the original orientation and the clockwise and counter-clockwise 90° rotations in one batch
+            candidates = [dst_img, np.rot90(dst_img, k=3), np.rot90(dst_img, k=1)]
+            rec_result, _ = self.text_recognizer[0](candidates)
+            best_img, best_score = dst_img, rec_result[0][1]
+            for cand, (_, score) in zip(candidates[1:], rec_result[1:]):
+                if score > best_score:
+                    best_img, best_score = cand, score
 
             # Use the best image
             dst_img = best_img
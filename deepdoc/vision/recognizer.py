@@ -27,6 +27,8 @@ from .operators import *  # noqa: F403
 from .operators import preprocess
 from . import operators
 from .ocr import load_model
+from .batcher import get_batcher, dynamic_batch
+from rag.settings import ONNX_BATCH_SIZE
 
 class Recognizer:
     def __init__(self, label_list, task_name, model_dir=None):
@@ -50,6 +52,10 @@ class Recognizer:
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
         self.label_list = label_list
+        # Models taking a single image tensor of a fixed size run the pages of every caller in batches.
+        self.batcher = None
+        if len(self.input_names) == 1 and dynamic_batch(self.ort_sess):
+            self.batcher = get_batcher(self.ort_sess, task_name, self._run_batch, ONNX_BATCH_SIZE)
 
     @staticmethod
     def sort_Y_firstly(arr, threshold):
@@ -406,6 +412,24 @@ class Recognizer:
             "score": float(scores[i])
         } for i in indices]
 
+    def _run_batch(self, imgs):
+        outputs = []
+        for s in range(0, len(imgs), ONNX_BATCH_SIZE):
+            out = self.ort_sess.run(None, {self.input_names[0]: np.concatenate(imgs[s:s + ONNX_BATCH_SIZE])}, self.run_options)[0]
+            outputs.extend(out[j:j + 1] for j in range(len(out)))
+        return outputs
+
+    def _batched(self, inputs):
+        # One request per input shape, as only tensors of the same shape can be stacked.
+        by_shape = {}
+        for i, ins in enumerate(inputs):
+            by_shape.setdefault(ins[self.input_names[0]].shape, []).append(i)
+        outputs = [None] * len(inputs)
+        for shape, idx in by_shape.items():
+            for i, out in zip(idx, self.batcher([inputs[i][self.input_names[0]] for i in idx], key=shape)):
+                outputs[i] = out
+        return outputs
+
     def __call__(self, image_list, thr=0.7, batch_size=16):
         res = []
         images = []
@@ -422,6 +446,9 @@ class Recognizer:
             batch_image_list = images[start_index:end_index]
             inputs = self.preprocess(batch_image_list)
             logging.debug("preprocess")
+            if self.batcher:
+                res.extend(self.postprocess(out, ins, thr) for out, ins in zip(self._batched(inputs), inputs))
+                continue
             for ins in inputs:
                 bb = self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names}, self.run_options)[0], ins, thr)
                 res.append(bb)
@@ -15,6 +15,7 @@
 #
 import logging
 import itertools
+import os
 import re
 from dataclasses import dataclass
 from typing import Any, Callable
@@ -23,15 +24,16 @@ import networkx as nx
 import trio
 
 from graphrag.general.extractor import Extractor
-from rag.nlp import is_english
-import editdistance
 from graphrag.entity_resolution_prompt import ENTITY_RESOLUTION_PROMPT
+from graphrag.entity_blocking import EntityBlocker, is_similarity
 from rag.llm.chat_model import Base as CompletionLLM
 from graphrag.utils import perform_variable_replacements, chat_limiter, GraphChange
 
 DEFAULT_RECORD_DELIMITER = "##"
 DEFAULT_ENTITY_INDEX_DELIMITER = "<|>"
 DEFAULT_RESOLUTION_RESULT_DELIMITER = "&&"
+# Entity types with more nodes than this get their candidate pairs from an EntityBlocker rather than from every pair
+ENTITY_BLOCKING_MIN_NODES = int(os.environ.get("ENTITY_BLOCKING_MIN_NODES", 1000))
 
 
 @dataclass
@@ -66,8 +68,9 @@ class EntityResolution(Extractor):
     async def __call__(self, graph: nx.Graph,
                        subgraph_nodes: set[str],
                        prompt_variables: dict[str, Any] | None = None,
-                       callback: Callable | None = None) -> EntityResolutionResult:
-        """Call method definition."""
+                       callback: Callable | None = None,
+                       embeddings: dict[str, Any] | None = None) -> EntityResolutionResult:
+        """Call method definition. `embeddings` optionally maps entity names to their vectors, for blocking."""
         if prompt_variables is None:
             prompt_variables = {}
 
@@ -90,8 +93,13 @@ class EntityResolution(Extractor):
             node_clusters[graph.nodes[node].get('entity_type', '-')].append(node)
 
         candidate_resolution = {entity_type: [] for entity_type in entity_types}
+        blocker = EntityBlocker()
         for k, v in node_clusters.items():
-            candidate_resolution[k] = [(a, b) for a, b in itertools.combinations(v, 2) if (a in subgraph_nodes or b in subgraph_nodes) and self.is_similarity(a, b)]
+            if len(v) > ENTITY_BLOCKING_MIN_NODES:
+                pairs = sorted(blocker.candidates(v, subgraph_nodes, embeddings))
+            else:
+                pairs = itertools.combinations(v, 2)
+            candidate_resolution[k] = [(a, b) for a, b in pairs if (a in subgraph_nodes or b in subgraph_nodes) and self.is_similarity(a, b)]
         num_candidates = sum([len(candidates) for _, candidates in candidate_resolution.items()])
         callback(msg=f"Identified {num_candidates} candidate pairs")
         remain_candidates_to_resolve = num_candidates
@@ -218,13 +226,6 @@ class EntityResolution(Extractor):
 
         return ans_list
 
-    def is_similarity(self, a, b):
-        if is_english(a) and is_english(b):
-            if editdistance.eval(a, b) <= min(len(a), len(b)) // 2:
-                return True
-            return False
-
-        if len(set(a) & set(b)) > 1:
-            return True
-
-        return False
+    @staticmethod
+    def is_similarity(a, b):
+        return is_similarity(a, b)
@@ -7,7 +7,9 @@ Reference:
 
 import logging
 import json
+import os
 import re
+from collections import defaultdict
 from typing import Callable
 from dataclasses import dataclass
 import networkx as nx
@@ -21,6 +23,10 @@ from graphrag.utils import perform_variable_replacements, dict_has_keys_with_typ
 from rag.utils import num_tokens_from_string
 import trio
 
+# A community keeps its previous report while its members differ from the previous community's by at most
+# this share (Jaccard distance)
+COMMUNITY_CHANGE_THRESHOLD = float(os.environ.get("COMMUNITY_CHANGE_THRESHOLD", 0.1))
+
 
 @dataclass
 class CommunityReportsResult:
@@ -48,22 +54,65 @@ class CommunityReportsExtractor(Extractor):
         self._extraction_prompt = COMMUNITY_REPORT_PROMPT
         self._max_report_length = max_report_length or 1500
 
-    async def __call__(self, graph: nx.Graph, callback: Callable | None = None):
+    async def __call__(self, graph: nx.Graph, callback: Callable | None = None, previous_reports: list[dict] | None = None):
+        """
+        With the `previous_reports` of the graph (structured outputs of a former run), Leiden starts from
+        their partition, and only the communities whose members changed by more than
+        COMMUNITY_CHANGE_THRESHOLD get a new report from the LLM, the others keeping theirs.
+        """
         for node_degree in graph.degree:
             graph.nodes[str(node_degree[0])]["rank"] = int(node_degree[1])
 
-        communities: dict[str, dict[str, list]] = leiden.run(graph, {})
+        previous_reports = [r for r in previous_reports or [] if "level" in r and "community" in r]
+        starting_communities = {}
+        for r in previous_reports:
+            if r["level"] == 0:
+                for n in r["entities"]:
+                    starting_communities[n] = int(r["community"])
+        communities: dict[str, dict[str, list]] = leiden.run(graph, {"starting_communities": starting_communities})
         total = sum([len(comm.items()) for _, comm in communities.items()])
         res_str = []
         res_dict = []
-        over, token_count = 0, 0
-        async def extract_community_report(community):
-            nonlocal res_str, res_dict, over, token_count
+        over, reused, token_count = 0, 0, 0
+
+        # Entity -> previous reports of each level, to find the one with the closest members.
+        previous_by_entity = defaultdict(list)
+        for r in previous_reports:
+            for n in r["entities"]:
+                previous_by_entity[(r["level"], n)].append(r)
+
+        def previous_report(level, ents):
+            overlaps, candidates = defaultdict(int), {}
+            for n in ents:
+                for r in previous_by_entity[(level, n)]:
+                    overlaps[id(r)] += 1
+                    candidates[id(r)] = r
+            best, best_similarity = None, 0
+            for k, r in candidates.items():
+                similarity = overlaps[k] / (len(ents) + len(r["entities"]) - overlaps[k])
+                if similarity > best_similarity:
+                    best, best_similarity = r, similarity
+            if best is not None and 1 - best_similarity <= COMMUNITY_CHANGE_THRESHOLD:
+                return best
+            return None
+
+        async def extract_community_report(level, community):
+            nonlocal res_str, res_dict, over, reused, token_count
             cm_id, cm = community
             weight = cm["weight"]
             ents = cm["nodes"]
             if len(ents) < 2:
                 return
+            prev = previous_report(level, ents)
+            if prev is not None:
+                response = {k: prev[k] for k in ["title", "summary", "findings", "rating", "rating_explanation"]}
+                response.update({"weight": weight, "entities": ents, "level": level, "community": cm_id})
+                add_community_info2graph(graph, ents, response["title"])
+                res_str.append(self._get_text_output(response))
+                res_dict.append(response)
+                over += 1
+                reused += 1
+                return
             ent_list = [{"entity": ent, "description": graph.nodes[ent]["description"]} for ent in ents]
             ent_df = pd.DataFrame(ent_list)
 
@@ -120,6 +169,8 @@ class CommunityReportsExtractor(Extractor):
                 return
             response["weight"] = weight
             response["entities"] = ents
+            response["level"] = level
+            response["community"] = cm_id
             add_community_info2graph(graph, ents, response["title"])
             res_str.append(self._get_text_output(response))
             res_dict.append(response)
@@ -132,9 +183,9 @@ class CommunityReportsExtractor(Extractor):
             for level, comm in communities.items():
                 logging.info(f"Level {level}: Community: {len(comm.keys())}")
                 for community in comm.items():
-                    nursery.start_soon(extract_community_report, community)
+                    nursery.start_soon(extract_community_report, level, community)
         if callback:
-            callback(msg=f"Community reports done in {trio.current_time() - st:.2f}s, used tokens: {token_count}")
+            callback(msg=f"Community reports done in {trio.current_time() - st:.2f}s, {reused} reused, used tokens: {token_count}")
 
         return CommunityReportsResult(
             structured_output=res_dict,
@@ -14,6 +14,7 @@
 #  limitations under the License.
 #
 import logging
+import os
 import re
 from collections import defaultdict, Counter
 from copy import deepcopy
@@ -26,11 +27,13 @@ from graphrag.utils import get_llm_cache, set_llm_cache, handle_single_entity_ex
     handle_single_relationship_extraction, split_string_by_multi_markers, flat_uniq_list, chat_limiter, get_from_to, GraphChange
 from rag.llm.chat_model import Base as CompletionLLM
 from rag.prompts import message_fit_in
-from rag.utils import truncate
+from rag.utils import truncate, num_tokens_from_string
 
 GRAPH_FIELD_SEP = "<SEP>"
 DEFAULT_ENTITY_TYPES = ["organization", "person", "geo", "event", "category"]
 ENTITY_EXTRACTION_MAX_GLEANINGS = 2
+# Chunks are packed into one extraction prompt up to this many tokens of text (0 extracts chunk by chunk)
+ENTITY_EXTRACTION_PACK_TOKENS = int(os.environ.get("ENTITY_EXTRACTION_PACK_TOKENS", 0))
 
 
 class Extractor:
@@ -45,20 +48,30 @@ class Extractor:
         self._llm = llm_invoker
         self._language = language
         self._entity_types = entity_types or DEFAULT_ENTITY_TYPES
+        self.pack_tokens = ENTITY_EXTRACTION_PACK_TOKENS
+        # LLM cache namespace of the answers, None to always ask the LLM
+        self.llm_cache_namespace = "graphrag"
+        # Requests actually sent to the LLM and their tokens, cache hits excluded
+        self.llm_requests = 0
+        self.llm_tokens = 0
 
     def _chat(self, system, history, gen_conf):
         hist = deepcopy(history)
         conf = deepcopy(gen_conf)
-        response = get_llm_cache(self._llm.llm_name, system, hist, conf)
-        if response:
-            return response
+        if self.llm_cache_namespace:
+            response = get_llm_cache(self._llm.llm_name, system, hist, conf, namespace=self.llm_cache_namespace)
+            if response:
+                return response
         _, system_msg = message_fit_in([{"role": "system", "content": system}], int(self._llm.max_length * 0.92))
+        self.llm_requests += 1
         response = self._llm.chat(system_msg[0]["content"], hist, conf)
+        self.llm_tokens += num_tokens_from_string(system_msg[0]["content"] + "".join(m["content"] for m in history) + response)
         response = re.sub(r"^.*</think>", "", response, flags=re.DOTALL)
         if response.find("**ERROR**") >= 0:
             logging.warning(f"Extractor._chat got error. response: {response}")
             return ""
-        set_llm_cache(self._llm.llm_name, system, response, history, gen_conf)
+        if self.llm_cache_namespace:
+            set_llm_cache(self._llm.llm_name, system, response, history, gen_conf, namespace=self.llm_cache_namespace)
         return response
 
     def _entities_and_relations(self, chunk_key: str, records: list, tuple_delimiter: str):
@@ -94,10 +107,14 @@ class Extractor:
         self.callback = callback
         start_ts = trio.current_time()
         out_results = []
+        items = [(doc_id, truncate(ck, int(self._llm.max_length*0.8))) for ck in chunks]
+        packs = self._pack(items) if self.pack_tokens > 0 else [[it] for it in items]
         async with trio.open_nursery() as nursery:
-            for i, ck in enumerate(chunks):
-                ck = truncate(ck, int(self._llm.max_length*0.8))
-                nursery.start_soon(self._process_single_content, (doc_id, ck), i, len(chunks), out_results)
+            for i, pack in enumerate(packs):
+                if len(pack) == 1:
+                    nursery.start_soon(self._process_single_content, pack[0], i, len(packs), out_results)
+                else:
+                    nursery.start_soon(self._process_packed_content, pack, i, len(packs), out_results)
 
         maybe_nodes = defaultdict(list)
         maybe_edges = defaultdict(list)
@@ -108,9 +125,10 @@ class Extractor:
             for k, v in m_edges.items():
                 maybe_edges[tuple(sorted(k))].extend(v)
             sum_token_count += token_count
+        self.token_count = sum_token_count
         now = trio.current_time()
         if callback:
-            callback(msg = f"Entities and relationships extraction done, {len(maybe_nodes)} nodes, {len(maybe_edges)} edges, {sum_token_count} tokens, {now-start_ts:.2f}s.")
+            callback(msg = f"Entities and relationships extraction done, {len(maybe_nodes)} nodes, {len(maybe_edges)} edges, {len(packs)} prompts, {sum_token_count} tokens, {now-start_ts:.2f}s.")
         start_ts = now
         logging.info("Entities merging...")
         all_entities_data = []
@@ -143,6 +161,35 @@ class Extractor:
 
         return all_entities_data, all_relationships_data
 
+    def _pack(self, items: list[tuple[str, str]]) -> list[list[tuple[str, str]]]:
+        """Consecutive chunks grouped up to `pack_tokens` tokens, a longer chunk making a group of its own."""
+        packs, size = [], 0
+        for key, ck in items:
+            n = num_tokens_from_string(ck)
+            if not packs or size + n > self.pack_tokens:
+                packs.append([])
+                size = 0
+            packs[-1].append((key, ck))
+            size += n
+        return packs
+
+    async def _process_packed_content(self, pack: list[tuple[str, str]], chunk_seq: int, num_chunks: int, out_results):
+        """
+        Extract from the chunks of `pack` with one prompt. Chunks are keyed by their document, so are the
+        records of the pack. If nothing could be parsed from the answer, the chunks are extracted one by one.
+        """
+        text = "\n\n".join(f"-----Text {i + 1}-----\n{ck}" for i, (_, ck) in enumerate(pack))
+        results = []
+        await self._process_single_content((pack[0][0], text), chunk_seq, num_chunks, results)
+        m_nodes, m_edges, _ = results[0]
+        if m_nodes or m_edges:
+            out_results.extend(results)
+            return
+        logging.warning(f"Nothing parsed from the extraction of {len(pack)} packed chunks, extracting them one by one")
+        out_results.append(({}, {}, results[0][2]))
+        for key, ck in pack:
+            await self._process_single_content((key, ck), chunk_seq, num_chunks, out_results)
+
     async def _merge_nodes(self, entity_name: str, entities: list[dict], all_relationships_data):
         if not entities:
             return
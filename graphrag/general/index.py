@@ -15,6 +15,8 @@
 #
 import json
 import logging
+import os
+import time
 import networkx as nx
 import trio
 
@@ -23,19 +25,29 @@ from api.utils import get_uuid
 from graphrag.light.graph_extractor import GraphExtractor as LightKGExt
 from graphrag.general.graph_extractor import GraphExtractor as GeneralKGExt
 from graphrag.general.community_reports_extractor import CommunityReportsExtractor
-from graphrag.entity_resolution import EntityResolution
+from graphrag.entity_resolution import EntityResolution, ENTITY_BLOCKING_MIN_NODES
 from graphrag.general.extractor import Extractor
 from graphrag.utils import (
     graph_merge,
     get_graph,
+    get_graph_meta,
+    get_graph_neighborhood,
+    graph_row_id,
     set_graph,
     chunk_id,
     does_graph_contains,
     tidy_graph,
     GraphChange,
+    provisional_pagerank,
+    get_embed_cache_many,
 )
 from rag.nlp import rag_tokenizer, search
-from rag.utils.redis_conn import RedisDistributedLock
+from rag.utils.doc_store_conn import OrderByExpr
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+
+# Subgraphs queued within this many seconds are merged into the graph of a knowledge base together
+GRAPHRAG_MERGE_WINDOW = float(os.environ.get("GRAPHRAG_MERGE_WINDOW", 3))
+GRAPHRAG_MERGE_BATCH = int(os.environ.get("GRAPHRAG_MERGE_BATCH", 64))
 
 
 async def run_graphrag(
@@ -72,55 +84,136 @@ async def run_graphrag(
     if not subgraph:
         return
 
+    # The subgraph waits in the queue of the knowledge base until a task holding the lock merges it along
+    # with the others queued meanwhile, possibly by another task executor.
+    REDIS_CONN.set(f"graphrag_subgraph_{kb_id}_{doc_id}", json.dumps(nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False), 24 * 3600)
+    REDIS_CONN.delete(f"graphrag_merged_{kb_id}_{doc_id}")
+    REDIS_CONN.zadd(f"graphrag_pending_{kb_id}", doc_id, time.time())
     graphrag_task_lock = RedisDistributedLock(f"graphrag_task_{kb_id}", lock_value=doc_id, timeout=1200)
-    await graphrag_task_lock.spin_acquire()
-    callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
+    while True:
+        state = REDIS_CONN.get(f"graphrag_merged_{kb_id}_{doc_id}")
+        if state:
+            break
+        # Not blocking: the loop polls, and a blocking acquire would stall every other task of the executor.
+        if graphrag_task_lock.acquire(blocking=False):
+            callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
+            try:
+                # A batch of documents may take longer to merge than the lock lives.
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(graphrag_task_lock.keep_alive)
+                    await merge_pending_subgraphs(
+                        tenant_id,
+                        kb_id,
+                        doc_id,
+                        subgraph,
+                        with_resolution,
+                        with_community,
+                        chat_model,
+                        embedding_model,
+                        callback,
+                    )
+                    nursery.cancel_scope.cancel()
+            finally:
+                graphrag_task_lock.release()
+            continue
+        await trio.sleep(1)
+    if state != "done":
+        raise Exception(f"Merging the subgraph of doc {doc_id} failed: {state}")
+    now = trio.current_time()
+    callback(msg=f"GraphRAG for doc {doc_id} done in {now - start:.2f} seconds.")
+    return
+
 
+async def merge_pending_subgraphs(
+    tenant_id: str,
+    kb_id: str,
+    doc_id: str,
+    subgraph: nx.Graph,
+    with_resolution: bool,
+    with_community: bool,
+    llm_bdl,
+    embed_bdl,
+    callback,
+):
+    """
+    Merge the subgraphs queued for the knowledge base, `subgraph` of `doc_id` included, in one pass, then
+    resolve entities and detect communities once for all of them. Each merged document is marked with the
+    outcome so that the tasks waiting for it can finish.
+    """
+    await trio.sleep(GRAPHRAG_MERGE_WINDOW)
+    doc_ids = [m for m, _ in REDIS_CONN.zpopmin(f"graphrag_pending_{kb_id}", GRAPHRAG_MERGE_BATCH) or []]
+    if doc_id not in doc_ids:
+        doc_ids.append(doc_id)
+    start = trio.current_time()
     try:
-        subgraph_nodes = set(subgraph.nodes())
-        new_graph = await merge_subgraph(
+        subgraphs = []
+        for d in doc_ids:
+            if d == doc_id:
+                subgraphs.append(subgraph)
+                continue
+            g = await load_pending_subgraph(tenant_id, kb_id, d)
+            if g is None:
+                logging.warning(f"The subgraph of doc {d} queued for kb {kb_id} is lost")
+                continue
+            subgraphs.append(g)
+        callback(msg=f"run_graphrag merging the subgraphs of {len(subgraphs)} documents together")
+
+        subgraph_nodes = set()
+        for g in subgraphs:
+            subgraph_nodes.update(g.nodes())
+        new_graph = await merge_subgraphs(
             tenant_id,
             kb_id,
-            doc_id,
-            subgraph,
-            embedding_model,
+            subgraphs,
+            embed_bdl,
             callback,
+            full_graph=with_resolution or with_community,
         )
-        assert new_graph is not None
-
-        if not with_resolution and not with_community:
-            return
-
-        if with_resolution:
-            await graphrag_task_lock.spin_acquire()
-            callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
+        if new_graph is not None and with_resolution:
             await resolve_entities(
                 new_graph,
                 subgraph_nodes,
                 tenant_id,
                 kb_id,
                 doc_id,
-                chat_model,
-                embedding_model,
+                llm_bdl,
+                embed_bdl,
                 callback,
             )
-        if with_community:
-            await graphrag_task_lock.spin_acquire()
-            callback(msg=f"run_graphrag {doc_id} graphrag_task_lock acquired")
+        if new_graph is not None and with_community:
             await extract_community(
                 new_graph,
                 tenant_id,
                 kb_id,
                 doc_id,
-                chat_model,
-                embedding_model,
+                llm_bdl,
+                embed_bdl,
                 callback,
             )
-    finally:
-        graphrag_task_lock.release()
+    except Exception as e:
+        for d in doc_ids:
+            REDIS_CONN.set(f"graphrag_merged_{kb_id}_{d}", str(e) or e.__class__.__name__, 3600)
+        raise
+    for d in doc_ids:
+        REDIS_CONN.set(f"graphrag_merged_{kb_id}_{d}", "done", 3600)
+        REDIS_CONN.delete(f"graphrag_subgraph_{kb_id}_{d}")
     now = trio.current_time()
-    callback(msg=f"GraphRAG for doc {doc_id} done in {now - start:.2f} seconds.")
-    return
+    callback(msg=f"run_graphrag merged the subgraphs of {len(doc_ids)} documents in {now - start:.2f}s.")
+
+
+async def load_pending_subgraph(tenant_id: str, kb_id: str, doc_id: str):
+    """The subgraph queued by the task of `doc_id`, from Redis or else the subgraph row generate_subgraph wrote."""
+    obj = REDIS_CONN.get(f"graphrag_subgraph_{kb_id}_{doc_id}")
+    if not obj:
+        fields = ["content_with_weight"]
+        res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(fields, [], {"knowledge_graph_kwd": ["subgraph"], "source_id": [doc_id]}, [], OrderByExpr(), 0, 1, search.index_name(tenant_id), [kb_id]))
+        for d in settings.docStoreConn.getFields(res, fields).values():
+            obj = d["content_with_weight"]
+    if not obj:
+        return None
+    g = nx.node_link_graph(json.loads(obj), edges="edges")
+    g.graph["source_id"] = [doc_id]
+    return g
 
 
 async def generate_subgraph(
@@ -194,33 +287,55 @@ async def generate_subgraph(
     callback(msg=f"generated subgraph for doc {doc_id} in {now - start:.2f} seconds.")
     return subgraph
 
-async def merge_subgraph(
+async def merge_subgraphs(
     tenant_id: str,
     kb_id: str,
-    doc_id: str,
-    subgraph: nx.Graph,
+    subgraphs: list[nx.Graph],
     embedding_model,
     callback,
+    full_graph: bool = True,
 ):
+    """
+    Merge the subgraphs of documents into the graph of the knowledge base, in order, with a single write.
+    Once the graph has a snapshot, only the rows of the changed entities and relations are written, and
+    unless `full_graph` is needed by the caller only the neighborhood of the subgraphs is loaded. Pagerank
+    is then refreshed by the snapshots, new entities get a provisional one meanwhile. Returns None when every document is already in the graph.
+    """
     start = trio.current_time()
     change = GraphChange()
-    old_graph = await get_graph(tenant_id, kb_id, subgraph.graph["source_id"])
+    meta = await get_graph_meta(tenant_id, kb_id)
+    if meta is not None and meta["removed_kwd"] == "N":
+        subgraphs = [g for g in subgraphs if g.graph["source_id"][0] not in meta["source_id"]]
+    if not subgraphs:
+        return None
+    doc_ids = [g.graph["source_id"][0] for g in subgraphs]
+    delta = meta is not None and meta["id"] == graph_row_id(kb_id) and meta["removed_kwd"] == "N"
+    if delta and not full_graph:
+        old_graph = await get_graph_neighborhood(tenant_id, kb_id, {n for g in subgraphs for n in g.nodes()})
+        old_graph.graph["source_id"] = meta["source_id"]
+        callback(msg=f"loaded the neighborhood of {len(doc_ids)} docs: {old_graph.number_of_nodes()} nodes, {old_graph.number_of_edges()} edges.")
+    else:
+        old_graph = await get_graph(tenant_id, kb_id, doc_ids)
     if old_graph is not None:
         logging.info("Merge with an exiting graph...................")
         tidy_graph(old_graph, callback)
-        new_graph = graph_merge(old_graph, subgraph, change)
+        new_graph = old_graph
+    else:
+        delta = False
+        new_graph = nx.Graph()
+    for subgraph in subgraphs:
+        new_graph = graph_merge(new_graph, subgraph, change)
+    if not delta:
+        pr = nx.pagerank(new_graph)
+        for node_name, pagerank in pr.items():
+            new_graph.nodes[node_name]["pagerank"] = pagerank
     else:
-        new_graph = subgraph
-        change.added_updated_nodes = set(new_graph.nodes())
-        change.added_updated_edges = set(new_graph.edges())
-    pr = nx.pagerank(new_graph)
-    for node_name, pagerank in pr.items():
-        new_graph.nodes[node_name]["pagerank"] = pagerank
+        provisional_pagerank(new_graph, change.added_updated_nodes)
 
-    await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback)
+    await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback, snapshot=not delta)
     now = trio.current_time()
     callback(
-        msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
+        msg=f"merging subgraphs for docs {', '.join(doc_ids)} into the global graph done in {now - start:.2f} seconds."
     )
     return new_graph
 
@@ -239,7 +354,13 @@ async def resolve_entities(
     er = EntityResolution(
         llm_bdl,
     )
-    reso = await er(graph, subgraph_nodes, callback=callback)
+    embeddings = None
+    if graph.number_of_nodes() > ENTITY_BLOCKING_MIN_NODES:
+        # The vectors cached when the entities were indexed add their nearest neighbors to the blocks.
+        names = list(graph.nodes())
+        vectors = await trio.to_thread.run_sync(lambda: get_embed_cache_many(embed_bdl.llm_name, names))
+        embeddings = {n: v for n, v in zip(names, vectors) if v is not None}
+    reso = await er(graph, subgraph_nodes, callback=callback, embeddings=embeddings)
     graph = reso.graph
     change = reso.change
     callback(msg=f"Graph resolution removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges.")
@@ -250,6 +371,26 @@ async def resolve_entities(
     callback(msg=f"Graph resolution done in {now - start:.2f}s.")
 
 
+async def get_community_reports(tenant_id: str, kb_id: str, bs=1024) -> list[dict]:
+    """The structured outputs of the community reports of the knowledge base, as CommunityReportsExtractor returns them."""
+    fields = ["content_with_weight", "entities_kwd"]
+    reports = []
+    for i in range(0, 1024 * bs, bs):
+        res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(fields, [], {"knowledge_graph_kwd": ["community_report"]}, [], OrderByExpr(), i, bs, search.index_name(tenant_id), [kb_id]))
+        res = settings.docStoreConn.getFields(res, fields)
+        for d in res.values():
+            try:
+                stru = json.loads(d["content_with_weight"]).get("community")
+            except Exception:
+                continue
+            if stru:
+                stru["entities"] = d.get("entities_kwd") or []
+                reports.append(stru)
+        if len(res) < bs:
+            break
+    return reports
+
+
 async def extract_community(
     graph,
     tenant_id: str,
@@ -263,7 +404,8 @@ async def extract_community(
     ext = CommunityReportsExtractor(
         llm_bdl,
     )
-    cr = await ext(graph, callback=callback)
+    previous_reports = await get_community_reports(tenant_id, kb_id)
+    cr = await ext(graph, callback=callback, previous_reports=previous_reports)
     community_structure = cr.structured_output
     community_reports = cr.output
     doc_ids = graph.graph["source_id"]
@@ -278,6 +420,8 @@ async def extract_community(
         obj = {
             "report": rep,
             "evidences": "\n".join([f.get("explanation", "") for f in stru["findings"]]),
+            # What the next run needs to seed Leiden and reuse the report if the community didn't change
+            "community": {k: stru[k] for k in ["level", "community", "title", "summary", "findings", "rating", "rating_explanation"]},
         }
         chunk = {
             "id": get_uuid(),
@@ -307,12 +451,10 @@ async def extract_community(
             kb_id,
         )
     )
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(tenant_id), kb_id))
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            raise Exception(error_message)
+    doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert_stream(chunks, search.index_name(tenant_id), kb_id))
+    if doc_store_result:
+        error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
+        raise Exception(error_message)
 
     now = trio.current_time()
     callback(
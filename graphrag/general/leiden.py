@@ -74,6 +74,7 @@ def _compute_leiden_communities(
         max_cluster_size: int,
         use_lcc: bool,
         seed=0xDEADBEEF,
+        starting_communities: dict[str, int] | None = None,
 ) -> dict[int, dict[str, int]]:
     """Return Leiden root communities."""
     results: dict[int, dict[str, int]] = {}
@@ -81,9 +82,11 @@ def _compute_leiden_communities(
         return results
     if use_lcc:
         graph = stable_largest_connected_component(graph)
+    if starting_communities:
+        starting_communities = {n: c for n, c in starting_communities.items() if graph.has_node(n)} or None
 
     community_mapping = hierarchical_leiden(
-        graph, max_cluster_size=max_cluster_size, random_seed=seed
+        graph, max_cluster_size=max_cluster_size, starting_communities=starting_communities, random_seed=seed
     )
     for partition in community_mapping:
         results[partition.level] = results.get(partition.level, {})
@@ -109,6 +112,7 @@ def run(graph: nx.Graph, args: dict[str, Any]) -> dict[int, dict[str, dict]]:
         max_cluster_size=max_cluster_size,
         use_lcc=use_lcc,
         seed=args.get("seed", 0xDEADBEEF),
+        starting_communities=args.get("starting_communities"),
     )
     levels = args.get("levels")
 
@@ -0,0 +1,274 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from rag.utils import get_float
+from rag.utils.redis_conn import REDIS_CONN
+
+# In-memory graph indexes for KGSearch: how many knowledge bases are kept, how often the version of a
+# knowledge base is checked, and how long an index is used at most without being reloaded
+KG_INDEX_ENABLED = os.environ.get("KG_INDEX_ENABLED", "1") == "1"
+KG_INDEX_CACHE_SIZE = int(os.environ.get("KG_INDEX_CACHE_SIZE", 8))
+KG_INDEX_REFRESH_SECONDS = float(os.environ.get("KG_INDEX_REFRESH_SECONDS", 10))
+KG_INDEX_TTL = float(os.environ.get("KG_INDEX_TTL", 600))
+# Seconds during which a knowledge base whose index failed to load is answered by the doc store instead
+KG_INDEX_FAILURE_BACKOFF = float(os.environ.get("KG_INDEX_FAILURE_BACKOFF", 60))
+
+
+def graph_version_key(kb_id):
+    return f"graphrag_version_{kb_id}"
+
+
+def bump_graph_version(kb_id):
+    """Make the in-memory indexes of the knowledge base reload, after its entities or relations changed."""
+    REDIS_CONN.incr(graph_version_key(kb_id))
+
+
+def _normalize(mat):
+    return mat / np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+
+
+class GraphIndex:
+    """
+    The entities and relations of one knowledge base, held in arrays: the entity vectors and relation
+    vectors as normalized matrices, the graph as CSR adjacency (indptr/indices/weights) over entity
+    positions, and entity positions by type in pagerank order. Answers what KGSearch otherwise asks the
+    doc store for, in the same shape as KGSearch._ent_info_from_ and _relation_info_from_. Similarities are
+    given as (1 + cosine) / 2, the _score of an Elasticsearch/OpenSearch cosine kNN search, so that the same
+    thresholds apply to both.
+    """
+
+    def __init__(self, entities: dict, relations: dict, dim: int):
+        self.names = sorted(entities.keys())
+        self.pos = {n: i for i, n in enumerate(self.names)}
+        self.descriptions = [entities[n]["content_with_weight"] for n in self.names]
+        self.pagerank = np.array([entities[n]["pagerank"] for n in self.names], dtype=np.float32)
+        self.ent_vecs = self._matrix([entities[n].get("vector") for n in self.names], dim)
+
+        by_type = defaultdict(list)
+        for i, n in enumerate(self.names):
+            by_type[entities[n]["entity_type"]].append(i)
+        self.types = {ty: sorted(idx, key=lambda i: -self.pagerank[i]) for ty, idx in by_type.items()}
+
+        rels = [(f, t, r) for (f, t), r in relations.items() if f in self.pos and t in self.pos]
+        self.rel_pairs = [(f, t) for f, t, _ in rels]
+        self.rel_weights = np.array([r["weight"] for _, _, r in rels], dtype=np.float32)
+        self.rel_descriptions = [r["content_with_weight"] for _, _, r in rels]
+        self.rel_vecs = self._matrix([r.get("vector") for _, _, r in rels], dim)
+
+        # Both directions of every relation, sorted by source position.
+        src = np.array([self.pos[f] for f, _ in self.rel_pairs] + [self.pos[t] for _, t in self.rel_pairs], dtype=np.int64)
+        dst = np.array([self.pos[t] for _, t in self.rel_pairs] + [self.pos[f] for f, _ in self.rel_pairs], dtype=np.int64)
+        wts = np.concatenate([self.rel_weights, self.rel_weights]) if rels else np.zeros(0, dtype=np.float32)
+        order = np.argsort(src, kind="stable")
+        self.indices = dst[order]
+        self.weights = wts[order]
+        self.indptr = np.zeros(len(self.names) + 1, dtype=np.int64)
+        np.add.at(self.indptr, src + 1, 1)
+        self.indptr = np.cumsum(self.indptr)
+        self.loaded_at = time.time()
+
+    @staticmethod
+    def _matrix(vectors, dim):
+        mat = np.zeros((len(vectors), dim), dtype=np.float32)
+        for i, v in enumerate(vectors):
+            if v is not None and len(v) == dim:
+                mat[i] = v
+        return _normalize(mat)
+
+    @staticmethod
+    def _similarity(mat, qv):
+        # Rows without a vector never match, as they would not in a kNN search.
+        return np.where(np.any(mat != 0, axis=1), (1 + mat @ qv) / 2, 0)
+
+    @classmethod
+    def load(cls, data_store, idxnms, kb_id, dim, bs=1024):
+        vec_field = f"q_{dim}_vec"
+
+        def scan(kwd, fields):
+            for rows in data_store.scan(fields, {"kb_id": kb_id, "knowledge_graph_kwd": kwd}, idxnms, [kb_id], bs):
+                yield from rows.values()
+
+        entities = {}
+        for d in scan("entity", ["entity_kwd", "entity_type_kwd", "rank_flt", "content_with_weight", vec_field]):
+            name = d.get("entity_kwd")
+            if isinstance(name, list):
+                name = name[0]
+            if not name:
+                continue
+            pagerank = d.get("rank_flt")
+            if pagerank is None:
+                try:
+                    pagerank = json.loads(d.get("content_with_weight") or "{}").get("pagerank", 0)
+                except Exception:
+                    pagerank = 0
+            entities[name] = {
+                "entity_type": d.get("entity_type_kwd") or "",
+                "pagerank": get_float(pagerank),
+                "content_with_weight": d.get("content_with_weight", "{}"),
+                "vector": d.get(vec_field),
+            }
+
+        relations = {}
+        for d in scan("relation", ["from_entity_kwd", "to_entity_kwd", "weight_int", "content_with_weight", vec_field]):
+            f, t = d.get("from_entity_kwd"), d.get("to_entity_kwd")
+            if isinstance(f, list):
+                f = f[0]
+            if isinstance(t, list):
+                t = t[0]
+            if not f or not t:
+                continue
+            relations[tuple(sorted([f, t]))] = {
+                "weight": get_float(d.get("weight_int", 0)),
+                "content_with_weight": d.get("content_with_weight", ""),
+                "vector": d.get(vec_field),
+            }
+        return cls(entities, relations, dim)
+
+    def n_hop_ents(self, i, hops=2, max_paths=32):
+        """Paths of up to `hops` relations from the entity at `i`, with the weights of their relations."""
+        paths = []
+        frontier = [([i], [])]
+        for _ in range(hops):
+            nxt = []
+            for path, wts in frontier:
+                s, e = self.indptr[path[-1]], self.indptr[path[-1] + 1]
+                for j, w in zip(self.indices[s:e], self.weights[s:e]):
+                    if j in path:
+                        continue
+                    nxt.append((path + [int(j)], wts + [float(w)]))
+            nxt.sort(key=lambda p: -sum(p[1]))
+            frontier = nxt[:max_paths]
+            paths.extend(frontier)
+        return [{"path": [self.names[j] for j in path], "weights": wts} for path, wts in paths[:max_paths]]
+
+    def ents_by_vector(self, qv, sim_thr=0.3, N=56):
+        if not self.names:
+            return {}
+        sims = self._similarity(self.ent_vecs, qv)
+        top = np.argsort(-sims)[:N]
+        return {
+            self.names[i]: {
+                "sim": float(sims[i]),
+                "pagerank": float(self.pagerank[i]),
+                "n_hop_ents": self.n_hop_ents(i),
+                "description": self.descriptions[i],
+            }
+            for i in top if sims[i] >= sim_thr
+        }
+
+    def ents_by_types(self, types, N=10000):
+        res = {}
+        for ty in types:
+            for i in self.types.get(ty, []):
+                if len(res) >= N:
+                    return res
+                res[self.names[i]] = {"sim": 0.0, "pagerank": float(self.pagerank[i]), "n_hop_ents": [], "description": self.descriptions[i]}
+        return res
+
+    def rels_by_vector(self, qv, sim_thr=0.3, N=56):
+        if not self.rel_pairs:
+            return {}
+        sims = self._similarity(self.rel_vecs, qv)
+        top = np.argsort(-sims)[:N]
+        return {
+            self.rel_pairs[i]: {
+                "sim": float(sims[i]),
+                "pagerank": float(self.rel_weights[i]),
+                "description": self.rel_descriptions[i],
+            }
+            for i in top if sims[i] >= sim_thr
+        }
+
+
+class GraphIndexCache:
+    """
+    Least recently used GraphIndex of each (knowledge base, vector size). An index is reloaded when the
+    version of its knowledge base, checked at most every KG_INDEX_REFRESH_SECONDS, changed or when it is
+    older than KG_INDEX_TTL. Meanwhile the index in hand keeps answering. A failed load is not retried for
+    KG_INDEX_FAILURE_BACKOFF seconds: the index in hand, if any, keeps answering, else get raises right away.
+    """
+
+    def __init__(self, size=KG_INDEX_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._failed = {}
+        self._indexes = OrderedDict()
+
+    def get(self, data_store, idxnms, kb_id, dim) -> GraphIndex:
+        key = (kb_id, dim)
+        now = time.time()
+        with self._lock:
+            entry = self._indexes.get(key)
+            if entry is not None:
+                self._indexes.move_to_end(key)
+                if now - entry["checked"] < KG_INDEX_REFRESH_SECONDS:
+                    return entry["index"]
+                entry["checked"] = now
+            failed = self._failed.get(key)
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        version = REDIS_CONN.get(graph_version_key(kb_id))
+        if entry is not None and entry["version"] == version and now - entry["index"].loaded_at < KG_INDEX_TTL:
+            return entry["index"]
+        if failed is not None and now - failed < KG_INDEX_FAILURE_BACKOFF:
+            if entry is not None:
+                return entry["index"]
+            raise Exception(f"Graph index of kb {kb_id} failed to load {now - failed:.0f}s ago")
+
+        with load_lock:
+            with self._lock:
+                current = self._indexes.get(key)
+            if current is not None and current is not entry:
+                return current["index"]
+            with self._lock:
+                failed = self._failed.get(key)
+            if failed is not None and failed >= now:
+                # Failed while this call waited for the load lock.
+                if entry is not None:
+                    return entry["index"]
+                raise Exception(f"Graph index of kb {kb_id} failed to load")
+            start = time.perf_counter()
+            try:
+                index = GraphIndex.load(data_store, idxnms, kb_id, dim)
+            except Exception:
+                with self._lock:
+                    self._failed[key] = time.time()
+                if entry is not None:
+                    # Keep answering with the index in hand until the backoff ends.
+                    logging.exception(f"Reloading the graph index of kb {kb_id} failed")
+                    return entry["index"]
+                raise
+            logging.info(f"Loaded graph index of kb {kb_id}: {len(index.names)} entities, "
+                         f"{len(index.rel_pairs)} relations in {time.perf_counter() - start:.2f}s")
+            with self._lock:
+                self._failed.pop(key, None)
+                self._indexes[key] = {"index": index, "version": version, "checked": time.time()}
+                self._indexes.move_to_end(key)
+                while len(self._indexes) > self.size:
+                    self._indexes.popitem(last=False)
+            return index
+
+
+GRAPH_INDEXES = GraphIndexCache()
@@ -18,10 +18,12 @@ import logging
 from collections import defaultdict
 from copy import deepcopy
 import json_repair
+import numpy as np
 import pandas as pd
 import trio
 
 from api.utils import get_uuid
+from graphrag.graph_index import GRAPH_INDEXES, KG_INDEX_ENABLED
 from graphrag.query_analyze_prompt import PROMPTS
 from graphrag.utils import get_entity_type2sampels, get_llm_cache, set_llm_cache, get_relation
 from rag.utils import num_tokens_from_string, get_float
@@ -32,13 +34,13 @@ from rag.nlp.search import Dealer, index_name
 
 class KGSearch(Dealer):
     def _chat(self, llm_bdl, system, history, gen_conf):
-        response = get_llm_cache(llm_bdl.llm_name, system, history, gen_conf)
+        response = get_llm_cache(llm_bdl.llm_name, system, history, gen_conf, namespace="graphrag")
         if response:
             return response
         response = llm_bdl.chat(system, history, gen_conf)
         if response.find("**ERROR**") >= 0:
             raise Exception(response)
-        set_llm_cache(llm_bdl.llm_name, system, response, history, gen_conf)
+        set_llm_cache(llm_bdl.llm_name, system, response, history, gen_conf, namespace="graphrag")
         return response
 
     def query_rewrite(self, llm, question, idxnms, kb_ids):
@@ -137,6 +139,94 @@ class KGSearch(Dealer):
                                        idxnms, kb_ids)
         return self._ent_info_from_(es_res, 0)
 
+    @staticmethod
+    def _encode_graph_queries(keywords, txt, emb_mdl):
+        txts = {"ents": ", ".join(keywords) if keywords else "", "rels": txt or ""}
+        dense = [k for k, t in txts.items() if t]
+        qvs = []
+        if dense:
+            if hasattr(emb_mdl, "encode_queries_many"):
+                qvs, _ = emb_mdl.encode_queries_many([txts[k] for k in dense])
+            else:
+                qvs = [emb_mdl.encode_queries(txts[k])[0] for k in dense]
+        return dict(zip(dense, qvs))
+
+    def get_relevant_graph_in_memory(self, keywords, types, txt, idxnms, kb_ids, emb_mdl,
+                                     ent_sim_thr=0.3, rel_sim_thr=0.3, N=56):
+        """
+        Same as get_relevant_graph, answered by the in-memory GraphIndex of each knowledge base, which also
+        gives the n-hop paths of the entities found.
+        """
+        qvs = self._encode_graph_queries(keywords, txt, emb_mdl)
+        if not qvs:
+            return self.get_relevant_graph(keywords, types, txt, self.get_filters({"kb_ids": kb_ids}), idxnms, kb_ids,
+                                           emb_mdl, ent_sim_thr, rel_sim_thr, N)
+        qvs = {k: np.array(v, dtype=np.float32) / max(np.linalg.norm(v), 1e-12) for k, v in qvs.items()}
+        dim = len(next(iter(qvs.values())))
+        ents, ents_by_types, rels = {}, {}, {}
+        for kb_id in kb_ids:
+            index = GRAPH_INDEXES.get(self.dataStore, idxnms, kb_id, dim)
+            if "ents" in qvs:
+                for n, ent in index.ents_by_vector(qvs["ents"], ent_sim_thr, N).items():
+                    if n not in ents or ents[n]["sim"] < ent["sim"]:
+                        ents[n] = ent
+            if types:
+                ents_by_types.update(index.ents_by_types(types))
+            if "rels" in qvs:
+                for pair, rel in index.rels_by_vector(qvs["rels"], rel_sim_thr, N).items():
+                    if pair not in rels or rels[pair]["sim"] < rel["sim"]:
+                        rels[pair] = rel
+        ents = dict(sorted(ents.items(), key=lambda x: -x[1]["sim"])[:N])
+        rels = dict(sorted(rels.items(), key=lambda x: -x[1]["sim"])[:N])
+        return ents, ents_by_types, rels
+
+    def get_relevant_graph(self, keywords, types, txt, filters, idxnms, kb_ids, emb_mdl,
+                           ent_sim_thr=0.3, rel_sim_thr=0.3, N=56):
+        """
+        Same as get_relevant_ents_by_keywords, get_relevant_ents_by_types and get_relevant_relations_by_txt together:
+        the two texts are embedded in one batch and the three searches are sent in one multi-search.
+        """
+        qvs = self._encode_graph_queries(keywords, txt, emb_mdl)
+
+        searches, names = [], []
+        if "ents" in qvs:
+            fltr = deepcopy(filters)
+            fltr["knowledge_graph_kwd"] = "entity"
+            searches.append({"selectFields": ["content_with_weight", "entity_kwd", "rank_flt"], "highlightFields": [],
+                             "condition": fltr, "matchExprs": [self.dense_expr(qvs["ents"], 1024, ent_sim_thr)],
+                             "orderBy": OrderByExpr(), "offset": 0, "limit": N,
+                             "indexNames": idxnms, "knowledgebaseIds": kb_ids})
+            names.append("ents")
+        if types:
+            fltr = deepcopy(filters)
+            fltr["knowledge_graph_kwd"] = "entity"
+            fltr["entity_type_kwd"] = types
+            ordr = OrderByExpr()
+            ordr.desc("rank_flt")
+            searches.append({"selectFields": ["entity_kwd", "rank_flt"], "highlightFields": [],
+                             "condition": fltr, "matchExprs": [], "orderBy": ordr, "offset": 0, "limit": 10000,
+                             "indexNames": idxnms, "knowledgebaseIds": kb_ids})
+            names.append("types")
+        if "rels" in qvs:
+            fltr = deepcopy(filters)
+            fltr["knowledge_graph_kwd"] = "relation"
+            searches.append({"selectFields": ["content_with_weight", "_score", "from_entity_kwd", "to_entity_kwd", "weight_int"],
+                             "highlightFields": [], "condition": fltr,
+                             "matchExprs": [self.dense_expr(qvs["rels"], 1024, rel_sim_thr)],
+                             "orderBy": OrderByExpr(), "offset": 0, "limit": N,
+                             "indexNames": idxnms, "knowledgebaseIds": kb_ids})
+            names.append("rels")
+
+        res = {"ents": {}, "types": {}, "rels": {}}
+        for name, es_res in zip(names, self.dataStore.search_many(searches)):
+            if name == "ents":
+                res[name] = self._ent_info_from_(es_res, ent_sim_thr)
+            elif name == "types":
+                res[name] = self._ent_info_from_(es_res, 0)
+            else:
+                res[name] = self._relation_info_from_(es_res, rel_sim_thr)
+        return res["ents"], res["types"], res["rels"]
+
     def retrieval(self, question: str,
                tenant_ids: str | list[str],
                kb_ids: list[str],
@@ -164,9 +254,17 @@ class KGSearch(Dealer):
             ents = [qst]
             pass
 
-        ents_from_query = self.get_relevant_ents_by_keywords(ents, filters, idxnms, kb_ids, emb_mdl, ent_sim_threshold)
-        ents_from_types = self.get_relevant_ents_by_types(ty_kwds, filters, idxnms, kb_ids, 10000)
-        rels_from_txt = self.get_relevant_relations_by_txt(qst, filters, idxnms, kb_ids, emb_mdl, rel_sim_threshold)
+        graph = None
+        if KG_INDEX_ENABLED:
+            try:
+                graph = self.get_relevant_graph_in_memory(ents, ty_kwds, qst, idxnms, kb_ids, emb_mdl,
+                                                          ent_sim_threshold, rel_sim_threshold)
+            except Exception as e:
+                logging.exception(f"Fail to search the in-memory graph index: {e}")
+        if graph is None:
+            graph = self.get_relevant_graph(ents, ty_kwds, qst, filters, idxnms, kb_ids, emb_mdl, ent_sim_threshold,
+                                            rel_sim_threshold)
+        ents_from_query, ents_from_types, rels_from_txt = graph
         nhop_pathes = defaultdict(dict)
         for _, ent in ents_from_query.items():
             nhops = ent.get("n_hop_ents", [])
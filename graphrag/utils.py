@@ -19,15 +19,17 @@ import trio
 from typing import Set, Tuple
 
 import networkx as nx
-import numpy as np
 import xxhash
 from networkx.readwrite import json_graph
 import dataclasses
 
 from api import settings
 from api.utils import get_uuid
+from graphrag.graph_index import bump_graph_version
 from rag.nlp import search, rag_tokenizer
 from rag.utils.doc_store_conn import OrderByExpr
+from rag.utils.embedding_cache import EMBEDDING_CACHE
+from rag.utils.llm_cache import LLM_CACHE
 from rag.utils.redis_conn import REDIS_CONN
 
 GRAPH_FIELD_SEP = "<SEP>"
@@ -35,6 +37,8 @@ GRAPH_FIELD_SEP = "<SEP>"
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
 chat_limiter = trio.CapacityLimiter(int(os.environ.get('MAX_CONCURRENT_CHATS', 10)))
+# Merges persisted as entity/relation row deltas before the whole graph is written again as a snapshot
+GRAPH_SNAPSHOT_DELTAS = int(os.environ.get('GRAPH_SNAPSHOT_DELTAS', 16))
 
 @dataclasses.dataclass
 class GraphChange:
@@ -92,51 +96,24 @@ def dict_has_keys_with_types(
     return True
 
 
-def get_llm_cache(llmnm, txt, history, genconf):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-    hasher.update(str(history).encode("utf-8"))
-    hasher.update(str(genconf).encode("utf-8"))
+def get_llm_cache(llmnm, txt, history, genconf, namespace="default"):
+    return LLM_CACHE.get(namespace, llmnm, txt, history, genconf)
 
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return bin
 
-
-def set_llm_cache(llmnm, txt, v, history, genconf):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-    hasher.update(str(history).encode("utf-8"))
-    hasher.update(str(genconf).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    REDIS_CONN.set(k, v.encode("utf-8"), 24*3600)
+def set_llm_cache(llmnm, txt, v, history, genconf, namespace="default"):
+    LLM_CACHE.set(namespace, llmnm, txt, v, history, genconf)
 
 
 def get_embed_cache(llmnm, txt):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
+    return EMBEDDING_CACHE.get(llmnm, txt, kind="graphrag")
 
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return np.array(json.loads(bin))
 
+def get_embed_cache_many(llmnm, txts):
+    return EMBEDDING_CACHE.mget(llmnm, txts, kind="graphrag")
 
-def set_embed_cache(llmnm, txt, arr):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
 
-    k = hasher.hexdigest()
-    arr = json.dumps(arr.tolist() if isinstance(arr, np.ndarray) else arr)
-    REDIS_CONN.set(k, arr.encode("utf-8"), 24*3600)
+def set_embed_cache(llmnm, txt, arr):
+    EMBEDDING_CACHE.set(llmnm, txt, arr, kind="graphrag")
 
 
 def get_tags_from_cache(kb_ids):
@@ -301,9 +278,22 @@ def chunk_id(chunk):
     return xxhash.xxh64((chunk["content_with_weight"] + chunk["kb_id"]).encode("utf-8")).hexdigest()
 
 
+def graph_row_id(kb_id):
+    return xxhash.xxh64(f"graph:{kb_id}".encode("utf-8")).hexdigest()
+
+
+def entity_row_id(kb_id, ent_name):
+    return xxhash.xxh64(f"entity:{kb_id}:{ent_name}".encode("utf-8")).hexdigest()
+
+
+def relation_row_id(kb_id, from_ent_name, to_ent_name):
+    from_ent_name, to_ent_name = get_from_to(from_ent_name, to_ent_name)
+    return xxhash.xxh64(f"relation:{kb_id}:{from_ent_name}\x00{to_ent_name}".encode("utf-8")).hexdigest()
+
+
 async def graph_node_to_chunk(kb_id, embd_mdl, ent_name, meta, chunks):
     chunk = {
-        "id": get_uuid(),
+        "id": entity_row_id(kb_id, ent_name),
         "important_kwd": [ent_name],
         "title_tks": rag_tokenizer.tokenize(ent_name),
         "entity_kwd": ent_name,
@@ -355,7 +345,7 @@ def get_relation(tenant_id, kb_id, from_ent_name, to_ent_name, size=1):
 
 async def graph_edge_to_chunk(kb_id, embd_mdl, from_ent_name, to_ent_name, meta, chunks):
     chunk = {
-        "id": get_uuid(),
+        "id": relation_row_id(kb_id, from_ent_name, to_ent_name),
         "from_entity_kwd": from_ent_name,
         "to_entity_kwd": to_ent_name,
         "knowledge_graph_kwd": "relation",
@@ -408,6 +398,61 @@ async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
     return doc_ids
 
 
+GRAPH_ROW_FIELDS = ["knowledge_graph_kwd", "content_with_weight", "entity_kwd", "from_entity_kwd", "to_entity_kwd", "source_id"]
+
+
+def _search_graph_rows(tenant_id, kb_id, condition, bs=1024):
+    rows = {}
+    for batch in settings.docStoreConn.scan(GRAPH_ROW_FIELDS, {"kb_id": kb_id, **condition}, search.index_name(tenant_id), [kb_id], bs):
+        rows.update(batch)
+    return rows
+
+
+def _add_graph_rows(graph: nx.Graph, rows: dict):
+    # Rows of older versions may duplicate an entity or relation: the one from the most documents wins.
+    for d in sorted(rows.values(), key=lambda d: len(d.get("source_id") or [])):
+        try:
+            meta = json.loads(d["content_with_weight"])
+        except Exception:
+            continue
+        if d["knowledge_graph_kwd"] == "entity":
+            graph.add_node(d["entity_kwd"], **meta)
+        elif d["knowledge_graph_kwd"] == "relation":
+            graph.add_edge(d["from_entity_kwd"], d["to_entity_kwd"], **meta)
+
+
+async def get_graph_meta(tenant_id, kb_id):
+    """id, source_id and removed_kwd of the graph row of the knowledge base, None if it has no graph."""
+    fields = ["source_id", "removed_kwd"]
+    res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(fields, [], {"knowledge_graph_kwd": ["graph"]}, [], OrderByExpr(), 0, 1, search.index_name(tenant_id), [kb_id]))
+    for id, d in settings.docStoreConn.getFields(res, fields).items():
+        return {"id": id, "source_id": list(d.get("source_id") or []), "removed_kwd": d.get("removed_kwd", "N")}
+    return None
+
+
+async def get_graph_neighborhood(tenant_id, kb_id, ent_names, bs=512):
+    """
+    The entities `ent_names`, their relations and the entities at the other end of them, loaded from the
+    entity and relation rows. Merging a document only needs this part of the graph, whatever its size.
+    """
+    def load():
+        names = sorted(set(ent_names))
+        rows = {}
+        for i in range(0, len(names), bs):
+            rows.update(_search_graph_rows(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"], "entity_kwd": names[i:i + bs]}))
+            for fld in ["from_entity_kwd", "to_entity_kwd"]:
+                rows.update(_search_graph_rows(tenant_id, kb_id, {"knowledge_graph_kwd": ["relation"], fld: names[i:i + bs]}))
+        neighbors = {d[fld] for d in rows.values() if d["knowledge_graph_kwd"] == "relation" for fld in ["from_entity_kwd", "to_entity_kwd"]}
+        neighbors = sorted(neighbors - set(names))
+        for i in range(0, len(neighbors), bs):
+            rows.update(_search_graph_rows(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"], "entity_kwd": neighbors[i:i + bs]}))
+        graph = nx.Graph()
+        _add_graph_rows(graph, rows)
+        return graph
+
+    return await trio.to_thread.run_sync(load)
+
+
 async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
     conds = {
         "fields": ["content_with_weight", "removed_kwd", "source_id"],
@@ -420,8 +465,16 @@ async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
             try:
                 if res.field[id]["removed_kwd"] == "N":
                     g = json_graph.node_link_graph(json.loads(res.field[id]["content_with_weight"]), edges="edges")
-                    if "source_id" not in g.graph:
-                        g.graph["source_id"] = res.field[id]["source_id"]
+                    source_id = list(res.field[id]["source_id"])
+                    # Documents merged since the snapshot only have their entity and relation rows written.
+                    snapshot_docs = set(g.graph.get("source_id", source_id))
+                    delta_docs = [d for d in source_id if d not in snapshot_docs]
+                    if delta_docs:
+                        rows = {}
+                        for i in range(0, len(delta_docs), 256):
+                            rows.update(await trio.to_thread.run_sync(lambda: _search_graph_rows(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity", "relation"], "source_id": delta_docs[i:i + 256]})))
+                        _add_graph_rows(g, rows)
+                    g.graph["source_id"] = source_id
                 else:
                     g = await rebuild_graph(tenant_id, kb_id, exclude_rebuild)
                 return g
@@ -431,10 +484,50 @@ async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
     return result
 
 
-async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback):
+def provisional_pagerank(graph: nx.Graph, nodes):
+    """
+    Give the `nodes` of `graph` without a pagerank the mean pagerank of their neighbors having one, else the
+    lowest pagerank in `graph`. Delta merges only see a neighborhood, so the pagerank of the whole graph is
+    computed again by the next snapshot; meanwhile new entities rank among their neighbors instead of last.
+    """
+    known = [d["pagerank"] for _, d in graph.nodes(data=True) if "pagerank" in d]
+    lowest = min(known) if known else 0
+    for node in nodes:
+        if not graph.has_node(node) or "pagerank" in graph.nodes[node]:
+            continue
+        ranks = [graph.nodes[n]["pagerank"] for n in graph.neighbors(node) if "pagerank" in graph.nodes[n]]
+        graph.nodes[node]["pagerank"] = sum(ranks) / len(ranks) if ranks else lowest
+
+
+def apply_graph_change(graph: nx.Graph, partial: nx.Graph, change: GraphChange):
+    """Apply to `graph` the `change` made on `partial`, a part of it such as a neighborhood."""
+    graph.remove_nodes_from(change.removed_nodes)
+    graph.remove_edges_from(change.removed_edges)
+    for node in change.added_updated_nodes:
+        if partial.has_node(node):
+            graph.add_node(node, **partial.nodes[node])
+    for from_node, to_node in change.added_updated_edges:
+        edge_attrs = partial.get_edge_data(from_node, to_node)
+        if edge_attrs:
+            graph.add_edge(from_node, to_node, **edge_attrs)
+    graph.graph["source_id"] = list(partial.graph.get("source_id", graph.graph.get("source_id", [])))
+    return graph
+
+
+async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback, snapshot=True):
+    """
+    Write the entity and relation rows of `change`. With `snapshot`, `graph` is the whole graph and is also
+    written as the graph row and per-document subgraphs. Otherwise `graph` may be the neighborhood of the
+    change only: the graph row just gets the new document list, and get_graph applies the rows written
+    since the snapshot. Every GRAPH_SNAPSHOT_DELTAS such merges, the whole graph is compacted into a snapshot.
+    """
     start = trio.current_time()
 
-    await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph", "subgraph"]}, search.index_name(tenant_id), kb_id))
+    if snapshot:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph"]}, search.index_name(tenant_id), kb_id))
+        # Keep the subgraphs of the documents still queued for merging.
+        if graph.graph.get("source_id"):
+            await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["subgraph"], "source_id": graph.graph["source_id"]}, search.index_name(tenant_id), kb_id))
 
     if change.removed_nodes:
         await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(change.removed_nodes)}, search.index_name(tenant_id), kb_id))
@@ -443,37 +536,43 @@ async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, chang
         async with trio.open_nursery() as nursery:
             for from_node, to_node in change.removed_edges:
                  nursery.start_soon(lambda from_node=from_node, to_node=to_node: trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["relation"], "from_entity_kwd": from_node, "to_entity_kwd": to_node}, search.index_name(tenant_id), kb_id)))
+
+    if snapshot and change.added_updated_nodes:
+        # Entity rows used to get random ids: drop those duplicating the rows about to be upserted.
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(change.added_updated_nodes)}, search.index_name(tenant_id), kb_id))
     now = trio.current_time()
     if callback:
         callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
     start = now
 
-    chunks = [{
-        "id": get_uuid(),
-        "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False),
-        "knowledge_graph_kwd": "graph",
-        "kb_id": kb_id,
-        "source_id": graph.graph.get("source_id", []),
-        "available_int": 0,
-        "removed_kwd": "N"
-    }]
-    
-    # generate updated subgraphs
-    for source in graph.graph["source_id"]:
-        subgraph = graph.subgraph([n for n in graph.nodes if source in graph.nodes[n]["source_id"]]).copy()
-        subgraph.graph["source_id"] = [source]
-        for n in subgraph.nodes:
-            subgraph.nodes[n]["source_id"] = [source]
+    chunks = []
+    if snapshot:
         chunks.append({
-            "id": get_uuid(),
-            "content_with_weight": json.dumps(nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False),
-            "knowledge_graph_kwd": "subgraph",
+            "id": graph_row_id(kb_id),
+            "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False),
+            "knowledge_graph_kwd": "graph",
             "kb_id": kb_id,
-            "source_id": [source],
+            "source_id": graph.graph.get("source_id", []),
             "available_int": 0,
             "removed_kwd": "N"
         })
-    
+
+        # generate updated subgraphs
+        for source in graph.graph["source_id"]:
+            subgraph = graph.subgraph([n for n in graph.nodes if source in graph.nodes[n]["source_id"]]).copy()
+            subgraph.graph["source_id"] = [source]
+            for n in subgraph.nodes:
+                subgraph.nodes[n]["source_id"] = [source]
+            chunks.append({
+                "id": get_uuid(),
+                "content_with_weight": json.dumps(nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False),
+                "knowledge_graph_kwd": "subgraph",
+                "kb_id": kb_id,
+                "source_id": [source],
+                "available_int": 0,
+                "removed_kwd": "N"
+            })
+
     async with trio.open_nursery() as nursery:
         for node in change.added_updated_nodes:
             node_attrs = graph.nodes[node]
@@ -489,16 +588,35 @@ async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, chang
         callback(msg=f"set_graph converted graph change to {len(chunks)} chunks in {now - start:.2f}s.")
     start = now
 
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(tenant_id), kb_id))
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            raise Exception(error_message)
+    doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert_stream(chunks, search.index_name(tenant_id), kb_id))
+    if doc_store_result:
+        error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
+        raise Exception(error_message)
     now = trio.current_time()
     if callback:
         callback(msg=f"set_graph added/updated {len(change.added_updated_nodes)} nodes and {len(change.added_updated_edges)} edges from index in {now - start:.2f}s.")
 
+    bump_graph_version(kb_id)
+
+    deltas_key = f"graphrag_deltas_{kb_id}"
+    if snapshot:
+        REDIS_CONN.delete(deltas_key)
+        return
+    await trio.to_thread.run_sync(lambda: settings.docStoreConn.update({"id": graph_row_id(kb_id)}, {"source_id": graph.graph.get("source_id", [])}, search.index_name(tenant_id), kb_id))
+    deltas = REDIS_CONN.incr(deltas_key)
+    if deltas is None or deltas < GRAPH_SNAPSHOT_DELTAS:
+        return
+    # The rows just written may not be searchable yet: apply the change to the loaded graph in memory.
+    full_graph = await get_graph(tenant_id, kb_id)
+    if full_graph is None:
+        return
+    apply_graph_change(full_graph, graph, change)
+    for node_name, pagerank in nx.pagerank(full_graph).items():
+        full_graph.nodes[node_name]["pagerank"] = pagerank
+    await set_graph(tenant_id, kb_id, embd_mdl, full_graph, GraphChange(), callback)
+    if callback:
+        callback(msg=f"set_graph compacted {deltas} merges into a snapshot of {full_graph.number_of_nodes()} nodes in {trio.current_time() - now:.2f}s.")
+
 
 def is_continuous_subsequence(subseq, seq):
     def find_all_indexes(tup, value):
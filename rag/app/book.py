@@ -144,9 +144,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
     eng = lang.lower() == "english"
 
     res = tokenize_table(tbls, doc, eng)
-    res.extend(tokenize_chunks(chunks, doc, eng, pdf_parser))
-
-    return res
+    return tokenize_chunks(chunks, doc, eng, pdf_parser, head=res, lazy=kwargs.get("stream", False))
 
 
 if __name__ == "__main__":
@@ -205,7 +205,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         callback(0.99, "No chunk parsed out.")
 
     return tokenize_chunks(["\n".join(ck)
-                           for ck in chunks], doc, eng, pdf_parser)
+                           for ck in chunks], doc, eng, pdf_parser, lazy=kwargs.get("stream", False))
 
 
 if __name__ == "__main__":
@@ -255,8 +255,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
                 last_sid = sec_id
 
         res = tokenize_table(tbls, doc, eng)
-        res.extend(tokenize_chunks(chunks, doc, eng, pdf_parser))
-        return res
+        return tokenize_chunks(chunks, doc, eng, pdf_parser, head=res, lazy=kwargs.get("stream", False))
 
     elif re.search(r"\.docx?$", filename, re.IGNORECASE):
         docx_parser = Docx()
@@ -31,6 +31,7 @@ from api.db.services.llm_service import LLMBundle
 from deepdoc.parser import DocxParser, ExcelParser, HtmlParser, JsonParser, MarkdownParser, PdfParser, TxtParser
 from deepdoc.parser.figure_parser import VisionFigureParser, vision_figure_parser_figure_data_wrapper
 from deepdoc.parser.pdf_parser import PlainParser, VisionParser
+from deepdoc.parser.utils import line_range
 from rag.nlp import concat_img, find_codec, naive_merge, naive_merge_with_images, naive_merge_docx, rag_tokenizer, tokenize_chunks, tokenize_chunks_with_images, tokenize_table
 
 
@@ -376,7 +377,10 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         except Exception:
             vision_model = None
 
-        sections, tables = Docx()(filename, binary)
+        sections, tables = Docx()(filename, binary, from_page, to_page)
+        if from_page > 0:
+            # Tables are read from the whole document: the task starting it takes them.
+            tables = []
 
         if vision_model:
             figures_data = vision_figure_parser_figure_data_wrapper(sections)
@@ -457,6 +461,8 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
 
     elif re.search(r"\.(txt|py|js|java|c|cpp|h|php|go|ts|sh|cs|kt|sql)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
+        if kwargs.get("split_units") and binary:
+            binary = line_range(binary, from_page, to_page)
         sections = TxtParser()(filename, binary,
                                parser_config.get("chunk_token_num", 128),
                                parser_config.get("delimiter", "\n!?;。；！？"))
@@ -464,6 +470,8 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
 
     elif re.search(r"\.(md|markdown)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
+        if kwargs.get("split_units") and binary:
+            binary = line_range(binary, from_page, to_page)
         markdown_parser = Markdown(int(parser_config.get("chunk_token_num", 128)))
         sections, tables = markdown_parser(filename, binary)
         
@@ -534,7 +542,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         if kwargs.get("section_only", False):
             return chunks
 
-        res.extend(tokenize_chunks(chunks, doc, is_english, pdf_parser))
+        res = tokenize_chunks(chunks, doc, is_english, pdf_parser, head=res, lazy=kwargs.get("stream", False))
     
     logging.info("naive_merge({}): {}".format(filename, timer() - st))
     return res
@@ -204,8 +204,7 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
                 continue
         chunks.append(txt)
         last_sid = sec_id
-    res.extend(tokenize_chunks(chunks, doc, eng, pdf_parser))
-    return res
+    return tokenize_chunks(chunks, doc, eng, pdf_parser, head=res, lazy=kwargs.get("stream", False))
 
 
 """
@@ -47,6 +47,14 @@ class Base(ABC):
     def encode_queries(self, text: str):
         raise NotImplementedError("Please implement encode method!")
 
+    def encode_queries_batch(self, texts: list):
+        embds, total_tokens = [], 0
+        for text in texts:
+            embd, tks = self.encode_queries(text)
+            embds.append(embd)
+            total_tokens += tks
+        return np.array(embds), total_tokens
+
     def total_token_count(self, resp):
         try:
             return resp.usage.total_tokens
@@ -142,6 +150,9 @@ class OpenAIEmbed(Base):
                                             model=self.model_name)
         return np.array(res.data[0].embedding), self.total_token_count(res)
 
+    def encode_queries_batch(self, texts: list):
+        return self.encode(texts)
+
 
 class LocalAIEmbed(Base):
     def __init__(self, key, model_name, base_url):
@@ -255,8 +255,42 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
-def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
-    res = []
+def tokenize_batch(ds, ts):
+    """Same as tokenize(d, t, eng) on every pair, with all the texts tokenized in one batch."""
+    for d, t in zip(ds, ts):
+        d["content_with_weight"] = t
+    ts = [re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t) for t in ts]
+    for d, (ltks, sm_ltks) in zip(ds, rag_tokenizer.tokenize_batch(ts, fine_grained=True)):
+        d["content_ltks"] = ltks
+        d["content_sm_ltks"] = sm_ltks
+
+
+TOKENIZE_WINDOW = 64
+
+
+class LazyChunks:
+    """
+    Chunks of a chunker built window by window on iteration, `head` (e.g. the table chunks) first, so that
+    the caller can forward a window, and drop its cropped images, before the next one is built.
+    len() is known upfront, give or take the empty texts which are skipped.
+    """
+
+    def __init__(self, head, texts, build):
+        self.head = head
+        self.texts = texts
+        self.build = build
+
+    def __len__(self):
+        return len(self.head) + len(self.texts)
+
+    def __iter__(self):
+        head, self.head = self.head, []
+        yield from head
+        yield from self.build()
+
+
+def _tokenize_chunks(chunks, doc, eng, pdf_parser=None, window=None):
+    res, texts = [], []
     # wrap up as es documents
     for ii, ck in enumerate(chunks):
         if len(ck.strip()) == 0:
@@ -272,12 +306,34 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 pass
         else:
             add_positions(d, [[ii]*5])
-        tokenize(d, ck, eng)
         res.append(d)
-    return res
+        texts.append(ck)
+        if window and len(res) >= window:
+            tokenize_batch(res, texts)
+            yield res
+            res, texts = [], []
+    if res:
+        tokenize_batch(res, texts)
+        yield res
+
+
+def tokenize_chunks(chunks, doc, eng, pdf_parser=None, head=None, lazy=False):
+    """
+    The chunk documents of the texts, after `head` if given. With `lazy`, a LazyChunks cropping and
+    tokenizing TOKENIZE_WINDOW texts at a time as it is iterated; otherwise a list.
+    """
+    head = head if head is not None else []
+    if lazy:
+        def build():
+            for window in _tokenize_chunks(chunks, doc, eng, pdf_parser, TOKENIZE_WINDOW):
+                yield from window
+        return LazyChunks(head, chunks, build)
+    for window in _tokenize_chunks(chunks, doc, eng, pdf_parser):
+        head.extend(window)
+    return head
 
 def tokenize_chunks_with_images(chunks, doc, eng, images):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ii, (ck, image) in enumerate(zip(chunks, images)):
         if len(ck.strip()) == 0:
@@ -286,8 +342,9 @@ def tokenize_chunks_with_images(chunks, doc, eng, images):
         d = copy.deepcopy(doc)
         d["image"] = image
         add_positions(d, [[ii]*5])
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts)
     return res
 
 def tokenize_table(tbls, doc, eng, batch_size=10):
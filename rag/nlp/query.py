@@ -16,12 +16,73 @@
 
 import logging
 import json
+import os
 import re
-from collections import defaultdict
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xxhash
 
 from rag.utils.doc_store_conn import MatchTextExpr
 from rag.nlp import rag_tokenizer, term_weight, synonym
 
+RERANK_VOCAB_SIZE = int(os.environ.get("RERANK_VOCAB_SIZE", 2_000_000))
+RERANK_CHUNK_CACHE_SIZE = int(os.environ.get("RERANK_CHUNK_CACHE_SIZE", 100_000))
+
+
+class TokenVectorCache:
+    """
+    Shared token vocabulary plus an LRU of per-chunk token id vectors keyed by the hash of the chunk tokens,
+    so the chunks that come back request after request are split and mapped only once.
+    Both are dropped together once the vocabulary is full.
+    """
+
+    def __init__(self, max_vocab=RERANK_VOCAB_SIZE, max_chunks=RERANK_CHUNK_CACHE_SIZE):
+        self.max_vocab = max_vocab
+        self.max_chunks = max_chunks
+        self.vocab = {}
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _ids(self, tks):
+        vocab = self.vocab
+        ids = []
+        for t in tks:
+            i = vocab.get(t)
+            if i is None:
+                i = vocab[t] = len(vocab)
+            ids.append(i)
+        return np.unique(np.array(ids, dtype=np.int64))
+
+    def encode(self, qtks, btkss):
+        """
+        Map the query tokens and every chunk's token set onto the shared vocabulary.
+        Returns (query ids, chunk ids concatenated, row offsets of the chunks).
+        """
+        keys = [xxhash.xxh64_intdigest("\x1f".join(tks).encode("utf-8")) for tks in btkss]
+        with self._lock:
+            if len(self.vocab) > self.max_vocab:
+                self.vocab.clear()
+                self._chunks.clear()
+            rows = []
+            for k, tks in zip(keys, btkss):
+                ids = self._chunks.get(k)
+                if ids is None:
+                    ids = self._chunks[k] = self._ids(tks)
+                    if len(self._chunks) > self.max_chunks:
+                        self._chunks.popitem(last=False)
+                else:
+                    self._chunks.move_to_end(k)
+                rows.append(ids)
+            qids = np.array([self.vocab.setdefault(t, len(self.vocab)) for t in qtks], dtype=np.int64)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in rows], out=offsets[1:])
+        return qids, np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64), offsets
+
+
+TOKEN_VECTOR_CACHE = TokenVectorCache()
+
 
 class FulltextQueryer:
     def __init__(self):
@@ -217,28 +278,38 @@ class FulltextQueryer:
         return None, keywords
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3, vtweight=0.7):
-        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-
-        sims = CosineSimilarity([avec], bvecs)
+        avec = np.asarray(avec, dtype=np.float64)
+        bvecs = np.asarray(bvecs, dtype=np.float64).reshape(-1, len(avec))
+        norms = np.linalg.norm(bvecs, axis=1) * np.linalg.norm(avec)
+        sims = np.divide(bvecs @ avec, norms, out=np.zeros(len(bvecs)), where=norms > 0)
         tksim = self.token_similarity(atks, btkss)
-        if np.sum(sims[0]) == 0:
-            return np.array(tksim), tksim, sims[0]
-        return np.array(sims[0]) * vtweight + np.array(tksim) * tkweight, tksim, sims[0]
+        if np.sum(sims) == 0:
+            return np.array(tksim), tksim, sims
+        return sims * vtweight + np.array(tksim) * tkweight, tksim, sims
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            if isinstance(tks, str):
-                tks = tks.split()
-            d = defaultdict(int)
-            wts = self.tw.weights(tks, preprocess=False)
-            for i, (t, c) in enumerate(wts):
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+        """
+        Weighted share of the query tokens found in each chunk, i.e. `similarity` for every chunk at once.
+        Only the query tokens are weighted, the chunks are reduced to token id sets of the shared vocabulary.
+        """
+        if isinstance(atks, str):
+            atks = atks.split()
+        btkss = [tks.split() if isinstance(tks, str) else tks for tks in btkss]
+        if not btkss:
+            return []
+        wts = self.tw.weights(atks, preprocess=False)
+        qids, bids, offsets = TOKEN_VECTOR_CACHE.encode([t for t, _ in wts], btkss)
+        qwts = np.array([c for _, c in wts], dtype=np.float64)
+
+        # Accumulate the weights of repeated query tokens on sorted unique ids.
+        uqids, inv = np.unique(qids, return_inverse=True)
+        uqwts = np.bincount(inv, weights=qwts, minlength=len(uqids)) if len(uqids) else np.zeros(0)
+        pos = np.searchsorted(uqids, bids)
+        hit = pos < len(uqids)
+        hit[hit] = uqids[pos[hit]] == bids[hit]
+        rows = np.repeat(np.arange(len(btkss)), np.diff(offsets))
+        s = np.bincount(rows[hit], weights=uqwts[pos[hit]], minlength=len(btkss))
+        return list((s + 1e-9) / (qwts.sum() + 1e-9))
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
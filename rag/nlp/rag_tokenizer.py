@@ -15,25 +15,43 @@
 #
 
 import logging
-import copy
 import datrie
+import functools
 import math
+import multiprocessing
 import os
 import re
 import string
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.startup_report import timed_load
+
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", 200000))
+TOKENIZER_PROCESSES = int(os.environ.get("TOKENIZER_PROCESSES", 0))
+TOKENIZER_BATCH_SIZE = int(os.environ.get("TOKENIZER_BATCH_SIZE", 64))
+
+
+@functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)
+def _key(line):
+    return str(line.lower().encode("utf-8"))[2:-1]
+
+
+@functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)
+def _rkey(line):
+    return str(("DD" + (line[::-1].lower())).encode("utf-8"))[2:-1]
 
 
 class RagTokenizer:
     def key_(self, line):
-        return str(line.lower().encode("utf-8"))[2:-1]
+        return _key(line)
 
     def rkey_(self, line):
-        return str(("DD" + (line[::-1].lower())).encode("utf-8"))[2:-1]
+        return _rkey(line)
 
     def loadDict_(self, fnm):
         logging.info(f"[HUQIE]:Build trie from {fnm}")
@@ -67,7 +85,29 @@ class RagTokenizer:
         self.lemmatizer = WordNetLemmatizer()
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
-
+        self._split_re = re.compile(self.SPLIT_CHAR)
+
+        self._trie = None
+        self._trie_lock = threading.Lock()
+        # Worker processes of tokenize_batch load the default dictionary only.
+        self._default_dict = True
+        self._reset_caches()
+
+    @property
+    def trie_(self):
+        # The dictionary is loaded on first use, so importing the tokenizer stays cheap.
+        if self._trie is None:
+            with self._trie_lock:
+                if self._trie is None:
+                    with timed_load("huqie trie"):
+                        self._load_trie()
+        return self._trie
+
+    @trie_.setter
+    def trie_(self, trie):
+        self._trie = trie
+
+    def _load_trie(self):
         trie_file_name = self.DIR_ + ".txt.trie"
         # check if trie file existence
         if os.path.exists(trie_file_name):
@@ -88,6 +128,8 @@ class RagTokenizer:
         self.loadDict_(self.DIR_ + ".txt")
 
     def loadUserDict(self, fnm):
+        self._reset_caches()
+        self._default_dict = False
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -96,8 +138,23 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        self._reset_caches()
+        self._default_dict = False
         self.loadDict_(fnm)
 
+    def _reset_caches(self):
+        """
+        Memoize the segmentation of text pieces that recur across chunks and queries (Chinese runs,
+        English words, fine-grained tokens). The results only depend on the dictionary, so the caches are
+        rebuilt whenever it changes.
+        """
+        self._segment = functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)(self._segment_)
+        self._fine_grained = functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)(self._fine_grained_)
+        self._en_normalize = functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)(
+            lambda t: self.stemmer.stem(self.lemmatizer.lemmatize(t)))
+        self._en_tokenize = functools.lru_cache(maxsize=TOKENIZER_CACHE_SIZE)(
+            lambda L: tuple(self._en_normalize(t) for t in word_tokenize(L)))
+
     def _strQ2B(self, ustring):
         """Convert full-width characters to half-width characters"""
         rstring = ""
@@ -122,10 +179,8 @@ class RagTokenizer:
         MAX_DEPTH = 10
         if _depth > MAX_DEPTH:
             if s < len(chars):
-                copy_pretks = copy.deepcopy(preTks)
                 remaining = "".join(chars[s:])
-                copy_pretks.append((remaining, (-12, '')))
-                tkslist.append(copy_pretks)
+                tkslist.append(preTks + [(remaining, (-12, ''))])
             return s
     
         state_key = (s, tuple(tk[0] for tk in preTks)) if preTks else (s, None)
@@ -151,11 +206,10 @@ class RagTokenizer:
                 mid = s + min(10, end - s)
                 t = "".join(chars[s:mid])
                 k = self.key_(t)
-                copy_pretks = copy.deepcopy(preTks)
                 if k in self.trie_:
-                    copy_pretks.append((t, self.trie_[k]))
+                    copy_pretks = preTks + [(t, self.trie_[k])]
                 else:
-                    copy_pretks.append((t, (-12, '')))
+                    copy_pretks = preTks + [(t, (-12, ''))]
                 next_res = self.dfs_(chars, mid, copy_pretks, tkslist, _depth + 1, _memo)
                 res = max(res, next_res)
                 _memo[state_key] = res
@@ -178,8 +232,7 @@ class RagTokenizer:
             if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
                 break
             if k in self.trie_:
-                pretks = copy.deepcopy(preTks)
-                pretks.append((t, self.trie_[k]))
+                pretks = preTks + [(t, self.trie_[k])]
                 res = max(res, self.dfs_(chars, e, pretks, tkslist, _depth + 1, _memo))
         
         if res > s:
@@ -188,20 +241,19 @@ class RagTokenizer:
     
         t = "".join(chars[s:s + 1])
         k = self.key_(t)
-        copy_pretks = copy.deepcopy(preTks)
         if k in self.trie_:
-            copy_pretks.append((t, self.trie_[k]))
+            copy_pretks = preTks + [(t, self.trie_[k])]
         else:
-            copy_pretks.append((t, (-12, '')))
+            copy_pretks = preTks + [(t, (-12, ''))]
         result = self.dfs_(chars, s + 1, copy_pretks, tkslist, _depth + 1, _memo)
         _memo[state_key] = result
         return result
 
     def freq(self, tk):
-        k = self.key_(tk)
-        if k not in self.trie_:
+        v = self.trie_.get(self.key_(tk))
+        if v is None:
             return 0
-        return int(math.exp(self.trie_[k][0]) * self.DENOMINATOR + 0.5)
+        return int(math.exp(v[0]) * self.DENOMINATOR + 0.5)
 
     def tag(self, tk):
         k = self.key_(tk)
@@ -218,7 +270,7 @@ class RagTokenizer:
             tks.append(tk)
         #F /= len(tks)
         L /= len(tks)
-        logging.debug("[SC] {} {} {} {} {}".format(tks, len(tks), L, F, B / len(tks) + L + F))
+        logging.debug("[SC] %s %s %s %s %s", tks, len(tks), L, F, B / len(tks) + L + F)
         return tks, B / len(tks) + L + F
 
     def sortTks_(self, tkslist):
@@ -232,14 +284,18 @@ class RagTokenizer:
         # if split chars is part of token
         res = []
         tks = re.sub(r"[ ]+", " ", tks).split()
+        has_split = [self._split_re.search(tk) is not None for tk in tks]
         s = 0
         while True:
             if s >= len(tks):
                 break
             E = s + 1
+            # SPLIT_CHAR matches single characters, so it matches the joined tokens iff it matches one of them.
+            split = has_split[s]
             for e in range(s + 2, min(len(tks) + 2, s + 6)):
-                tk = "".join(tks[s:e])
-                if re.search(self.SPLIT_CHAR, tk) and self.freq(tk):
+                if e <= len(tks):
+                    split = split or has_split[e - 1]
+                if split and self.freq("".join(tks[s:e])):
                     E = e
             res.append("".join(tks[s:E]))
             s = E
@@ -247,54 +303,49 @@ class RagTokenizer:
         return " ".join(res)
 
     def maxForward_(self, line):
+        trie, key = self.trie_, self.key_
         res = []
         s = 0
         while s < len(line):
             e = s + 1
             t = line[s:e]
-            while e < len(line) and self.trie_.has_keys_with_prefix(
-                    self.key_(t)):
+            while e < len(line) and trie.has_keys_with_prefix(key(t)):
                 e += 1
                 t = line[s:e]
 
-            while e - 1 > s and self.key_(t) not in self.trie_:
+            while e - 1 > s and key(t) not in trie:
                 e -= 1
                 t = line[s:e]
 
-            if self.key_(t) in self.trie_:
-                res.append((t, self.trie_[self.key_(t)]))
-            else:
-                res.append((t, (0, '')))
+            res.append((t, trie.get(key(t), (0, ''))))
 
             s = e
 
         return self.score_(res)
 
     def maxBackward_(self, line):
+        trie, key = self.trie_, self.key_
         res = []
         s = len(line) - 1
         while s >= 0:
             e = s + 1
             t = line[s:e]
-            while s > 0 and self.trie_.has_keys_with_prefix(self.rkey_(t)):
+            while s > 0 and trie.has_keys_with_prefix(self.rkey_(t)):
                 s -= 1
                 t = line[s:e]
 
-            while s + 1 < e and self.key_(t) not in self.trie_:
+            while s + 1 < e and key(t) not in trie:
                 s += 1
                 t = line[s:e]
 
-            if self.key_(t) in self.trie_:
-                res.append((t, self.trie_[self.key_(t)]))
-            else:
-                res.append((t, (0, '')))
+            res.append((t, trie.get(key(t), (0, ''))))
 
             s -= 1
 
         return self.score_(res[::-1])
 
     def english_normalize_(self, tks):
-        return [self.stemmer.stem(self.lemmatizer.lemmatize(t)) if re.match(r"[a-zA-Z_-]+$", t) else t for t in tks]
+        return [self._en_normalize(t) if re.match(r"[a-zA-Z_-]+$", t) else t for t in tks]
 
     def _split_by_lang(self, line):
         txt_lang_pairs = []
@@ -328,68 +379,88 @@ class RagTokenizer:
         res = []
         for L,lang in arr:
             if not lang:
-                res.extend([self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(L)])
+                res.extend(self._en_tokenize(L))
                 continue
             if len(L) < 2 or re.match(
                     r"[a-z\.-]+$", L) or re.match(r"[0-9\.-]+$", L):
                 res.append(L)
                 continue
+            res.extend(self._segment(L))
 
-            # use maxforward for the first time
-            tks, s = self.maxForward_(L)
-            tks1, s1 = self.maxBackward_(L)
-            if self.DEBUG:
-                logging.debug("[FW] {} {}".format(tks, s))
-                logging.debug("[BW] {} {}".format(tks1, s1))
+        res = self.merge_(" ".join(res))
+        logging.debug("[TKS] %s", res)
+        return res
 
-            i, j, _i, _j = 0, 0, 0, 0
-            same = 0
+    def _segment_(self, L):
+        res = []
+        # use maxforward for the first time
+        tks, s = self.maxForward_(L)
+        tks1, s1 = self.maxBackward_(L)
+        if self.DEBUG:
+            logging.debug("[FW] {} {}".format(tks, s))
+            logging.debug("[BW] {} {}".format(tks1, s1))
+
+        i, j, _i, _j = 0, 0, 0, 0
+        same = 0
+        while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
+            same += 1
+        if same > 0:
+            res.append(" ".join(tks[j: j + same]))
+        _i = i + same
+        _j = j + same
+        j = _j + 1
+        i = _i + 1
+
+        while i < len(tks1) and j < len(tks):
+            tk1, tk = "".join(tks1[_i:i]), "".join(tks[_j:j])
+            if tk1 != tk:
+                if len(tk1) > len(tk):
+                    j += 1
+                else:
+                    i += 1
+                continue
+
+            if tks1[i] != tks[j]:
+                i += 1
+                j += 1
+                continue
+            # backward tokens from_i to i are different from forward tokens from _j to j.
+            tkslist = []
+            self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
+            res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+
+            same = 1
             while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
                 same += 1
-            if same > 0:
-                res.append(" ".join(tks[j: j + same]))
+            res.append(" ".join(tks[j: j + same]))
             _i = i + same
             _j = j + same
             j = _j + 1
             i = _i + 1
 
-            while i < len(tks1) and j < len(tks):
-                tk1, tk = "".join(tks1[_i:i]), "".join(tks[_j:j])
-                if tk1 != tk:
-                    if len(tk1) > len(tk):
-                        j += 1
-                    else:
-                        i += 1
-                    continue
-
-                if tks1[i] != tks[j]:
-                    i += 1
-                    j += 1
-                    continue
-                # backward tokens from_i to i are different from forward tokens from _j to j.
-                tkslist = []
-                self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-                same = 1
-                while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
-                    same += 1
-                res.append(" ".join(tks[j: j + same]))
-                _i = i + same
-                _j = j + same
-                j = _j + 1
-                i = _i + 1
-
-            if _i < len(tks1):
-                assert _j < len(tks)
-                assert "".join(tks1[_i:]) == "".join(tks[_j:])
-                tkslist = []
-                self.dfs_("".join(tks[_j:]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-        res = " ".join(res)
-        logging.debug("[TKS] {}".format(self.merge_(res)))
-        return self.merge_(res)
+        if _i < len(tks1):
+            assert _j < len(tks)
+            assert "".join(tks1[_i:]) == "".join(tks[_j:])
+            tkslist = []
+            self.dfs_("".join(tks[_j:]), 0, [], tkslist)
+            res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+        return tuple(res)
+
+    def tokenize_batch(self, lines, fine_grained=False):
+        """
+        Tokenize many lines, fanning them out to TOKENIZER_PROCESSES worker processes when configured.
+        With `fine_grained`, (tokens, fine grained tokens) pairs are returned.
+        Workers are spawned, not forked, since the caller is usually multi-threaded; they tokenize with
+        the default dictionary, so a tokenizer with a user dictionary keeps the work in process.
+        """
+        global _pool
+        if TOKENIZER_PROCESSES > 1 and len(lines) > TOKENIZER_BATCH_SIZE and self._default_dict:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=TOKENIZER_PROCESSES,
+                                            mp_context=multiprocessing.get_context("spawn"))
+            batches = [lines[i:i + TOKENIZER_BATCH_SIZE] for i in range(0, len(lines), TOKENIZER_BATCH_SIZE)]
+            return [r for rs in _pool.map(_tokenize_lines, batches, [fine_grained] * len(batches)) for r in rs]
+        return _tokenize_lines(lines, fine_grained, self)
 
     def fine_grained_tokenize(self, tks):
         tks = tks.split()
@@ -400,36 +471,33 @@ class RagTokenizer:
                 res.extend(tk.split("/"))
             return " ".join(res)
 
-        res = []
-        for tk in tks:
-            if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
-                res.append(tk)
-                continue
-            tkslist = []
-            if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
-                res.append(tk)
-                continue
-            stk = self.sortTks_(tkslist)[1][0]
-            if len(stk) == len(tk):
-                stk = tk
-            else:
-                if re.match(r"[a-z\.-]+$", tk):
-                    for t in stk:
-                        if len(t) < 3:
-                            stk = tk
-                            break
-                    else:
-                        stk = " ".join(stk)
+        res = [self._fine_grained(tk) for tk in tks]
+        return " ".join(self.english_normalize_(res))
+
+    def _fine_grained_(self, tk):
+        if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
+            return tk
+        tkslist = []
+        if len(tk) > 10:
+            tkslist.append(tk)
+        else:
+            self.dfs_(tk, 0, [], tkslist)
+        if len(tkslist) < 2:
+            return tk
+        stk = self.sortTks_(tkslist)[1][0]
+        if len(stk) == len(tk):
+            stk = tk
+        else:
+            if re.match(r"[a-z\.-]+$", tk):
+                for t in stk:
+                    if len(t) < 3:
+                        stk = tk
+                        break
                 else:
                     stk = " ".join(stk)
-
-            res.append(stk)
-
-        return " ".join(self.english_normalize_(res))
+            else:
+                stk = " ".join(stk)
+        return stk
 
 
 def is_chinese(s):
@@ -464,8 +532,21 @@ def naiveQie(txt):
     return tks
 
 
+def _tokenize_lines(lines, fine_grained=False, tknzr=None):
+    tknzr = tknzr or tokenizer
+    if not fine_grained:
+        return [tknzr.tokenize(line) for line in lines]
+    res = []
+    for line in lines:
+        tks = tknzr.tokenize(line)
+        res.append((tks, tknzr.fine_grained_tokenize(tks)))
+    return res
+
+
+_pool = None
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
+tokenize_batch = tokenizer.tokenize_batch
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
 tag = tokenizer.tag
 freq = tokenizer.freq
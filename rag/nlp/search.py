@@ -16,6 +16,7 @@
 import logging
 import re
 import math
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
 from dataclasses import dataclass
 
@@ -24,12 +25,18 @@ from rag.utils import rmSpace, get_float
 from rag.nlp import rag_tokenizer, query
 import numpy as np
 from rag.utils.doc_store_conn import DocStoreConnection, MatchDenseExpr, FusionExpr, OrderByExpr
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE, RETRIEVAL_CACHE_ENABLED
 
 
 def index_name(uid): return f"ragflow_{uid}"
 
 
 class Dealer:
+    DEFAULT_FIELDS = ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd", "position_int",
+                      "doc_id", "page_num_int", "top_int", "create_timestamp_flt", "knowledge_graph_kwd",
+                      "question_kwd", "question_tks", "doc_type_kwd",
+                      "available_int", "content_with_weight", PAGERANK_FLD, TAG_FLD]
+
     def __init__(self, dataStore: DocStoreConnection):
         self.qryr = query.FulltextQueryer()
         self.dataStore = dataStore
@@ -47,6 +54,10 @@ class Dealer:
 
     def get_vector(self, txt, emb_mdl, topk=10, similarity=0.1):
         qv, _ = emb_mdl.encode_queries(txt)
+        return self.dense_expr(qv, topk, similarity)
+
+    @staticmethod
+    def dense_expr(qv, topk=10, similarity=0.1):
         shape = np.array(qv).shape
         if len(shape) > 1:
             raise Exception(
@@ -80,12 +91,8 @@ class Dealer:
         ps = int(req.get("size", topk))
         offset, limit = pg * ps, ps
 
-        src = req.get("fields",
-                      ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd", "position_int",
-                       "doc_id", "page_num_int", "top_int", "create_timestamp_flt", "knowledge_graph_kwd",
-                       "question_kwd", "question_tks", "doc_type_kwd",
-                       "available_int", "content_with_weight", PAGERANK_FLD, TAG_FLD])
-        kwds = set([])
+        src = list(req.get("fields", self.DEFAULT_FIELDS))
+        keywords = []
 
         qst = req.get("question", "")
         q_vec = []
@@ -133,16 +140,68 @@ class Dealer:
                         total = self.dataStore.getTotal(res)
                         logging.debug("Dealer.search 2 TOTAL: {}".format(total))
 
-            for k in keywords:
-                kwds.add(k)
-                for kk in rag_tokenizer.fine_grained_tokenize(k).split():
-                    if len(kk) < 2:
-                        continue
-                    if kk in kwds:
-                        continue
-                    kwds.add(kk)
-
         logging.debug(f"TOTAL: {total}")
+        return self._search_result(res, total, src, q_vec, keywords)
+
+    def search_many(self, reqs: list[dict], idx_names: str | list[str],
+                    kb_ids: list[str],
+                    emb_mdl,
+                    highlight=False,
+                    rank_feature: dict | None = None
+                    ):
+        """
+        Hybrid search of several questions at once: the questions are embedded in one batch and sent
+        to the doc store in one multi-search. Questions without any hit are retried one by one with `search`.
+        """
+        if hasattr(emb_mdl, "encode_queries_many"):
+            qvs, _ = emb_mdl.encode_queries_many([req["question"] for req in reqs])
+        else:
+            qvs = [emb_mdl.encode_queries(req["question"])[0] for req in reqs]
+
+        searches, plans = [], []
+        for req, qv in zip(reqs, qvs):
+            filters = self.get_filters(req)
+            pg = int(req.get("page", 1)) - 1
+            topk = int(req.get("topk", 1024))
+            ps = int(req.get("size", topk))
+            src = list(req.get("fields", self.DEFAULT_FIELDS))
+            matchText, keywords = self.qryr.question(req["question"], min_match=0.3)
+            matchDense = self.dense_expr(qv, topk, req.get("similarity", 0.1))
+            q_vec = matchDense.embedding_data
+            src.append(f"q_{len(q_vec)}_vec")
+            fusionExpr = FusionExpr("weighted_sum", topk, {"weights": "0.05, 0.95"})
+            searches.append({"selectFields": src,
+                             "highlightFields": ["content_ltks", "title_tks"] if highlight else [],
+                             "condition": filters,
+                             "matchExprs": [matchText, matchDense, fusionExpr],
+                             "orderBy": OrderByExpr(),
+                             "offset": pg * ps,
+                             "limit": ps,
+                             "indexNames": idx_names,
+                             "knowledgebaseIds": kb_ids,
+                             "rank_feature": rank_feature})
+            plans.append((req, src, q_vec, keywords))
+
+        sress = []
+        for (req, src, q_vec, keywords), res in zip(plans, self.dataStore.search_many(searches)):
+            total = self.dataStore.getTotal(res)
+            if total == 0:
+                sress.append(self.search(req, idx_names, kb_ids, emb_mdl, highlight, rank_feature=rank_feature))
+                continue
+            sress.append(self._search_result(res, total, src, q_vec, keywords))
+        return sress
+
+    def _search_result(self, res, total, src, q_vec, keywords):
+        kwds = set([])
+        for k in keywords:
+            kwds.add(k)
+            for kk in rag_tokenizer.fine_grained_tokenize(k).split():
+                if len(kk) < 2:
+                    continue
+                if kk in kwds:
+                    continue
+                kwds.add(kk)
+
         ids = self.dataStore.getChunkIds(res)
         keywords = list(kwds)
         highlight = self.dataStore.getHighlight(res, keywords, "content_with_weight")
@@ -345,39 +404,62 @@ class Dealer:
                                            rag_tokenizer.tokenize(ans).split(),
                                            rag_tokenizer.tokenize(inst).split())
 
-    def retrieval(self, question, embd_mdl, tenant_ids, kb_ids, page, page_size, similarity_threshold=0.2,
-                  vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True,
-                  rerank_mdl=None, highlight=False,
-                  rank_feature: dict | None = {PAGERANK_FLD: 10}):
-        ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
-        if not question:
-            return ranks
+    def _retrieval_cache_key(self, question, embd_mdl, tenant_ids, kb_ids, page, page_size, similarity_threshold,
+                             vector_similarity_weight, top, doc_ids, aggs, rerank_mdl, highlight, rank_feature):
+        if not RETRIEVAL_CACHE_ENABLED:
+            return None
+        return RETRIEVAL_CACHE.key(question, kb_ids,
+                                   tenant_ids=sorted(tenant_ids.split(",") if isinstance(tenant_ids, str) else tenant_ids),
+                                   doc_ids=sorted(doc_ids) if doc_ids else None,
+                                   page=page, page_size=page_size, top=top, aggs=aggs, highlight=highlight,
+                                   similarity_threshold=similarity_threshold,
+                                   vector_similarity_weight=vector_similarity_weight,
+                                   rank_feature=rank_feature,
+                                   embd_mdl=getattr(embd_mdl, "cache_model_key", getattr(embd_mdl, "llm_name", None)),
+                                   rerank_mdl=getattr(rerank_mdl, "cache_model_key", getattr(rerank_mdl, "llm_name", None)))
+
+    def _cached_retrieval(self, *args):
+        try:
+            cache_key = self._retrieval_cache_key(*args)
+            if cache_key:
+                return cache_key, RETRIEVAL_CACHE.get(cache_key)
+        except Exception:
+            logging.exception("Dealer.retrieval cache lookup got exception")
+        return None, None
+
+    @staticmethod
+    def _cache_retrieval(cache_key, ranks):
+        if not cache_key:
+            return
+        try:
+            RETRIEVAL_CACHE.set(cache_key, ranks)
+        except Exception:
+            logging.exception("Dealer.retrieval cache store got exception")
 
+    @staticmethod
+    def _retrieval_req(question, kb_ids, doc_ids, page, page_size, similarity_threshold, top):
         RERANK_LIMIT = 64
         RERANK_LIMIT = int(RERANK_LIMIT//page_size + ((RERANK_LIMIT%page_size)/(page_size*1.) + 0.5)) * page_size if page_size>1 else 1
         if RERANK_LIMIT < 1: ## when page_size is very large the RERANK_LIMIT will be 0.
             RERANK_LIMIT = 1
-        req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "page": math.ceil(page_size*page/RERANK_LIMIT), "size": RERANK_LIMIT,
-               "question": question, "vector": True, "topk": top,
-               "similarity": similarity_threshold,
-               "available_int": 1}
-
-
-        if isinstance(tenant_ids, str):
-            tenant_ids = tenant_ids.split(",")
-
-        sres = self.search(req, [index_name(tid) for tid in tenant_ids],
-                           kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
+        return {"kb_ids": kb_ids, "doc_ids": doc_ids, "page": math.ceil(page_size*page/RERANK_LIMIT), "size": RERANK_LIMIT,
+                "question": question, "vector": True, "topk": top,
+                "similarity": similarity_threshold,
+                "available_int": 1}
 
+    def _similarity(self, sres, question, rerank_mdl, vector_similarity_weight, rank_feature):
         if rerank_mdl and sres.total > 0:
-            sim, tsim, vsim = self.rerank_by_model(rerank_mdl,
-                                                   sres, question, 1 - vector_similarity_weight,
-                                                   vector_similarity_weight,
-                                                   rank_feature=rank_feature)
-        else:
-            sim, tsim, vsim = self.rerank(
-                sres, question, 1 - vector_similarity_weight, vector_similarity_weight,
-                rank_feature=rank_feature)
+            return self.rerank_by_model(rerank_mdl,
+                                        sres, question, 1 - vector_similarity_weight,
+                                        vector_similarity_weight,
+                                        rank_feature=rank_feature)
+        return self.rerank(
+            sres, question, 1 - vector_similarity_weight, vector_similarity_weight,
+            rank_feature=rank_feature)
+
+    @staticmethod
+    def _ranks(sres, sim, tsim, vsim, page, page_size, similarity_threshold, doc_ids, aggs, highlight):
+        ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
         # Already paginated in search function
         idx = np.argsort(sim * -1)[(page - 1) * page_size:page * page_size]
         dim = len(sres.query_vector)
@@ -431,9 +513,79 @@ class Dealer:
                                                        v in sorted(ranks["doc_aggs"].items(),
                                                                    key=lambda x: x[1]["count"] * -1)]
         ranks["chunks"] = ranks["chunks"][:page_size]
+        return ranks
+
+    def retrieval(self, question, embd_mdl, tenant_ids, kb_ids, page, page_size, similarity_threshold=0.2,
+                  vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True,
+                  rerank_mdl=None, highlight=False,
+                  rank_feature: dict | None = {PAGERANK_FLD: 10}):
+        if not question:
+            return {"total": 0, "chunks": [], "doc_aggs": {}}
+
+        cache_key, cached = self._cached_retrieval(question, embd_mdl, tenant_ids, kb_ids, page, page_size,
+                                                   similarity_threshold, vector_similarity_weight, top, doc_ids,
+                                                   aggs, rerank_mdl, highlight, rank_feature)
+        if cached is not None:
+            return cached
+
+        req = self._retrieval_req(question, kb_ids, doc_ids, page, page_size, similarity_threshold, top)
 
+        if isinstance(tenant_ids, str):
+            tenant_ids = tenant_ids.split(",")
+
+        sres = self.search(req, [index_name(tid) for tid in tenant_ids],
+                           kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
+
+        sim, tsim, vsim = self._similarity(sres, question, rerank_mdl, vector_similarity_weight, rank_feature)
+        ranks = self._ranks(sres, sim, tsim, vsim, page, page_size, similarity_threshold, doc_ids, aggs, highlight)
+        self._cache_retrieval(cache_key, ranks)
         return ranks
 
+    def retrieval_many(self, questions: list[str], embd_mdl, tenant_ids, kb_ids, page, page_size,
+                       similarity_threshold=0.2, vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True,
+                       rerank_mdl=None, highlight=False,
+                       rank_feature: dict | None = {PAGERANK_FLD: 10}) -> list[dict]:
+        """
+        Same as `retrieval` for several questions against the same knowledge bases.
+        The uncached questions are embedded in one batch and searched with one multi-search request,
+        the results come back aligned with `questions`.
+        """
+        results = [None] * len(questions)
+        cache_keys = [None] * len(questions)
+        for i, question in enumerate(questions):
+            if not question:
+                results[i] = {"total": 0, "chunks": [], "doc_aggs": {}}
+                continue
+            cache_keys[i], results[i] = self._cached_retrieval(question, embd_mdl, tenant_ids, kb_ids, page, page_size,
+                                                               similarity_threshold, vector_similarity_weight, top,
+                                                               doc_ids, aggs, rerank_mdl, highlight, rank_feature)
+        todo = [i for i, r in enumerate(results) if r is None]
+        if not todo:
+            return results
+
+        if isinstance(tenant_ids, str):
+            tenant_ids = tenant_ids.split(",")
+        reqs = [self._retrieval_req(questions[i], kb_ids, doc_ids, page, page_size, similarity_threshold, top) for i in todo]
+        sress = self.search_many(reqs, [index_name(tid) for tid in tenant_ids],
+                                 kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
+
+        def similarity(j):
+            return self._similarity(sress[j], questions[todo[j]], rerank_mdl, vector_similarity_weight, rank_feature)
+
+        if rerank_mdl and len(todo) > 1:
+            # Rerank providers take one query per call, so the calls are issued concurrently.
+            with ThreadPoolExecutor(max_workers=min(len(todo), 8)) as executor:
+                sims = list(executor.map(similarity, range(len(todo))))
+        else:
+            sims = [similarity(j) for j in range(len(todo))]
+
+        for j, i in enumerate(todo):
+            sim, tsim, vsim = sims[j]
+            results[i] = self._ranks(sress[j], sim, tsim, vsim, page, page_size, similarity_threshold,
+                                     doc_ids, aggs, highlight)
+            self._cache_retrieval(cache_keys[i], results[i])
+        return results
+
     def sql_retrieval(self, sql, fetch_size=128, format="json"):
         tbl = self.dataStore.sql(sql, fetch_size, format)
         return tbl
@@ -19,8 +19,10 @@ import json
 import os
 import time
 import re
+import threading
 from nltk.corpus import wordnet
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.startup_report import timed_load
 
 
 class Dealer:
@@ -28,22 +30,36 @@ class Dealer:
 
         self.lookup_num = 100000000
         self.load_tm = time.time() - 1000000
-        self.dictionary = None
-        path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
-        try:
-            self.dictionary = json.load(open(path, 'r'))
-        except Exception:
-            logging.warning("Missing synonym.json")
-            self.dictionary = {}
+        self._dictionary = None
+        self._lock = threading.Lock()
 
         if not redis:
             logging.warning(
                 "Realtime synonym is disabled, since no redis connection.")
-        if not len(self.dictionary.keys()):
-            logging.warning("Fail to load synonym")
 
         self.redis = redis
-        self.load()
+
+    @property
+    def dictionary(self):
+        # Loaded on first lookup, so that importing the NLP modules stays cheap.
+        if self._dictionary is None:
+            with self._lock:
+                if self._dictionary is None:
+                    path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
+                    with timed_load("synonym.json"):
+                        try:
+                            dictionary = json.load(open(path, 'r'))
+                        except Exception:
+                            logging.warning("Missing synonym.json")
+                            dictionary = {}
+                    if not len(dictionary.keys()):
+                        logging.warning("Fail to load synonym")
+                    self._dictionary = dictionary
+        return self._dictionary
+
+    @dictionary.setter
+    def dictionary(self, dictionary):
+        self._dictionary = dictionary
 
     def load(self):
         if not self.redis:
@@ -19,9 +19,12 @@ import math
 import json
 import re
 import os
+import threading
 import numpy as np
 from rag.nlp import rag_tokenizer
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.mmap_dict import MmapDict
+from rag.utils.startup_report import timed_load
 
 
 class Dealer:
@@ -58,36 +61,60 @@ class Dealer:
                                "啥",
                                "相关"])
 
-        def load_dict(fnm):
-            res = {}
-            f = open(fnm, "r")
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-                arr = line.replace("\n", "").split("\t")
-                if len(arr) < 2:
-                    res[arr[0]] = 0
-                else:
-                    res[arr[0]] = int(arr[1])
+        self._ne, self._df = None, None
+        self._lock = threading.Lock()
 
-            c = 0
-            for _, v in res.items():
-                c += v
-            if c == 0:
-                return set(res.keys())
-            return res
+    @staticmethod
+    def load_dict(fnm):
+        res = {}
+        f = open(fnm, "r")
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            arr = line.replace("\n", "").split("\t")
+            if len(arr) < 2:
+                res[arr[0]] = 0
+            else:
+                res[arr[0]] = int(arr[1])
+
+        c = 0
+        for _, v in res.items():
+            c += v
+        if c == 0:
+            return set(res.keys())
+        return res
+
+    @staticmethod
+    def _load(name, parse):
+        # Shared by all the processes on the host through a memory-mapped artifact next to the source file.
+        fnm = os.path.join(get_project_base_directory(), "rag/res", name)
+        with timed_load(name):
+            return MmapDict.load(fnm, os.path.join(get_project_base_directory(), "rag/res", "compiled", name), parse)
+
+    @property
+    def ne(self):
+        if self._ne is None:
+            with self._lock:
+                if self._ne is None:
+                    try:
+                        self._ne = self._load("ner.json", lambda fnm: json.load(open(fnm, "r")))
+                    except Exception:
+                        logging.warning("Load ner.json FAIL!")
+                        self._ne = {}
+        return self._ne
 
-        fnm = os.path.join(get_project_base_directory(), "rag/res")
-        self.ne, self.df = {}, {}
-        try:
-            self.ne = json.load(open(os.path.join(fnm, "ner.json"), "r"))
-        except Exception:
-            logging.warning("Load ner.json FAIL!")
-        try:
-            self.df = load_dict(os.path.join(fnm, "term.freq"))
-        except Exception:
-            logging.warning("Load term.freq FAIL!")
+    @property
+    def df(self):
+        if self._df is None:
+            with self._lock:
+                if self._df is None:
+                    try:
+                        self._df = self._load("term.freq", self.load_dict)
+                    except Exception:
+                        logging.warning("Load term.freq FAIL!")
+                        self._df = {}
+        return self._df
 
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
@@ -0,0 +1,107 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Golden-output check of the tokenizer.
+
+Record the output of a known good tokenizer on a corpus (one text per line), then verify that the current
+one, through both `tokenize` and `tokenize_batch`, still gives exactly the same tokens:
+
+    python -m rag.nlp.tokenizer_golden record corpus.txt golden.jsonl
+    python -m rag.nlp.tokenizer_golden verify corpus.txt golden.jsonl
+
+`--dict` tokenizes with another dictionary (same "word frequency tag" lines as huqie.txt) instead of the
+default one. test/unit_test/data holds a small corpus, dictionary and golden file checked by the unit tests.
+"""
+import argparse
+import json
+import sys
+import time
+
+from rag.nlp import rag_tokenizer
+
+
+def load_corpus(fnm):
+    with open(fnm, "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def load_tokenizer(dict_fnm=None):
+    if not dict_fnm:
+        return rag_tokenizer.tokenizer
+    tknzr = rag_tokenizer.RagTokenizer()
+    tknzr.loadUserDict(dict_fnm)
+    return tknzr
+
+
+def record(lines, golden, tknzr=None):
+    tknzr = tknzr or rag_tokenizer.tokenizer
+    start = time.perf_counter()
+    with open(golden, "w", encoding="utf-8") as f:
+        for line in lines:
+            tks = tknzr.tokenize(line)
+            f.write(json.dumps({"tks": tks, "sm_tks": tknzr.fine_grained_tokenize(tks)}, ensure_ascii=False) + "\n")
+    print(f"Recorded {len(lines)} lines in {time.perf_counter() - start:.2f}s")
+
+
+def verify(lines, golden, tknzr=None):
+    tknzr = tknzr or rag_tokenizer.tokenizer
+    with open(golden, "r", encoding="utf-8") as f:
+        expected = [json.loads(line) for line in f]
+    if len(expected) != len(lines):
+        print(f"Golden file has {len(expected)} lines, the corpus {len(lines)}")
+        return 1
+
+    start = time.perf_counter()
+    got = []
+    for line in lines:
+        tks = tknzr.tokenize(line)
+        got.append((tks, tknzr.fine_grained_tokenize(tks)))
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = tknzr.tokenize_batch(lines, fine_grained=True)
+    batch_elapsed = time.perf_counter() - start
+
+    mismatches = 0
+    for no, (line, exp, one, many) in enumerate(zip(lines, expected, got, batch)):
+        for res in (one, many):
+            if res != (exp["tks"], exp["sm_tks"]):
+                mismatches += 1
+                print(f"Line {no + 1} differs: {line[:80]}\n  expected: {exp}\n  got: {res}")
+                break
+    print(f"{len(lines)} lines, {mismatches} mismatches; tokenize {elapsed:.2f}s, "
+          f"tokenize_batch {batch_elapsed:.2f}s (second pass, memoized)")
+    return 1 if mismatches else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Golden-output check of rag_tokenizer")
+    parser.add_argument("action", choices=["record", "verify"])
+    parser.add_argument("corpus", help="text file, one text per line")
+    parser.add_argument("golden", help="golden output file (jsonl)")
+    parser.add_argument("--dict", help="dictionary to use instead of the default one")
+    args = parser.parse_args()
+
+    lines = load_corpus(args.corpus)
+    tknzr = load_tokenizer(args.dict)
+    if args.action == "record":
+        record(lines, args.golden, tknzr)
+        return 0
+    return verify(lines, args.golden, tknzr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,26 +13,30 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
 import logging
 import re
-import umap
 import numpy as np
-from sklearn.mixture import GaussianMixture
 import trio
+import xxhash
 
 from graphrag.utils import (
     get_llm_cache,
-    get_embed_cache,
+    get_embed_cache_many,
     set_embed_cache,
     set_llm_cache,
     chat_limiter,
 )
+from rag.raptor_clustering import cluster_layer_async
+from rag.settings import EMBEDDING_BATCH_SIZE, RAPTOR_TASK_LLM_CONCURRENCY
 from rag.utils import truncate
+from rag.utils.redis_conn import REDIS_CONN
 
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
     def __init__(
-        self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1
+        self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1,
+        max_concurrency=RAPTOR_TASK_LLM_CONCURRENCY
     ):
         self._max_cluster = max_cluster
         self._llm_model = llm_model
@@ -40,9 +44,11 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         self._threshold = threshold
         self._prompt = prompt
         self._max_token = max_token
+        # Summaries of this task in flight, on top of the limit shared by all tasks
+        self._task_limiter = trio.CapacityLimiter(max(1, max_concurrency))
 
     async def _chat(self, system, history, gen_conf):
-        response = get_llm_cache(self._llm_model.llm_name, system, history, gen_conf)
+        response = get_llm_cache(self._llm_model.llm_name, system, history, gen_conf, namespace="raptor")
         if response:
             return response
         response = await trio.to_thread.run_sync(
@@ -51,40 +57,55 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         response = re.sub(r"^.*</think>", "", response, flags=re.DOTALL)
         if response.find("**ERROR**") >= 0:
             raise Exception(response)
-        set_llm_cache(self._llm_model.llm_name, system, response, history, gen_conf)
+        set_llm_cache(self._llm_model.llm_name, system, response, history, gen_conf, namespace="raptor")
         return response
 
-    async def _embedding_encode(self, txt):
-        response = get_embed_cache(self._embd_model.llm_name, txt)
-        if response is not None:
-            return response
-        embds, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txt]))
-        if len(embds) < 1 or len(embds[0]) < 1:
-            raise Exception("Embedding error: ")
-        embds = embds[0]
-        set_embed_cache(self._embd_model.llm_name, txt, embds)
-        return embds
+    async def _embedding_encode_many(self, txts):
+        embds = await trio.to_thread.run_sync(lambda: get_embed_cache_many(self._embd_model.llm_name, txts))
+        missing = [i for i, e in enumerate(embds) if e is None]
+        for s in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[s:s + EMBEDDING_BATCH_SIZE]
+            vts, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txts[i] for i in batch]))
+            if len(vts) != len(batch) or any(len(v) < 1 for v in vts):
+                raise Exception("Embedding error: ")
+            for i, v in zip(batch, vts):
+                embds[i] = v
+                set_embed_cache(self._embd_model.llm_name, txts[i], v)
+        return [np.array(e) for e in embds]
 
-    def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
-        max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
+    def _checkpoint_key(self, resume_key, chunks, random_state):
+        hasher = xxhash.xxh64()
+        for v in [resume_key, self._llm_model.llm_name, self._embd_model.llm_name, self._max_cluster,
+                  self._prompt, self._max_token, self._threshold, random_state]:
+            hasher.update(str(v).encode("utf-8"))
+        for t, _ in chunks:
+            hasher.update(t.encode("utf-8"))
+        return f"raptor_layers_{hasher.hexdigest()}"
 
-    async def __call__(self, chunks, random_state, callback=None):
+    async def __call__(self, chunks, random_state, callback=None, resume_key=None):
+        """
+        With `resume_key` (the task's document), the summaries are saved in Redis after each layer, and a
+        run on the same chunks and settings, after a crash, resumes from the last layer completed. The
+        chunks are hashed and clustered in the order given, which has to be stable across runs.
+        """
         if len(chunks) <= 1:
             return []
         chunks = [(s, a) for s, a in chunks if s and len(a) > 0]
+        original_length = len(chunks)
         layers = [(0, len(chunks))]
         start, end = 0, len(chunks)
 
-        async def summarize(ck_idx: list[int]):
-            nonlocal chunks
+        checkpoint = self._checkpoint_key(resume_key, chunks, random_state) if resume_key else None
+        state = REDIS_CONN.get(checkpoint) if checkpoint else None
+        if state:
+            state = json.loads(state)
+            chunks.extend((t, np.array(v)) for t, v in state["summaries"])
+            layers = [tuple(layer) for layer in state["layers"]]
+            start, end = layers[-1]
+            if callback:
+                callback(msg=f"Resume from layer {len(layers) - 1}: {len(state['summaries'])} summaries already made")
+
+        async def summarize(ck_idx: list[int], summaries: dict, c: int):
             texts = [chunks[i][0] for i in ck_idx]
             len_per_chunk = int(
                 (self._llm_model.max_length - self._max_token) / len(texts)
@@ -92,7 +113,7 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
             cluster_content = "\n".join(
                 [truncate(t, max(1, len_per_chunk)) for t in texts]
             )
-            async with chat_limiter:
+            async with self._task_limiter, chat_limiter:
                 # 调用大模型
                 cnt = await self._chat(
                     "You're a helpful assistant.",
@@ -112,53 +133,36 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
                 cnt,
             )
             logging.debug(f"SUM: {cnt}")
-            embds = await self._embedding_encode(cnt)
-            chunks.append((cnt, embds))
+            summaries[c] = cnt
+
+        async def summarize_layer(clusters: list[list[int]]):
+            summaries = {}
+            async with trio.open_nursery() as nursery:
+                for c, ck_idx in enumerate(clusters):
+                    nursery.start_soon(summarize, ck_idx, summaries, c)
+            txts = [summaries[c] for c in range(len(clusters))]
+            embds = await self._embedding_encode_many(txts)
+            chunks.extend(zip(txts, embds))
 
         labels = []
         while end - start > 1:
             embeddings = [embd for _, embd in chunks[start:end]]
             if len(embeddings) == 2:
-                await summarize([start, start + 1])
-                if callback:
-                    callback(
-                        msg="Cluster one layer: {} -> {}".format(
-                            end - start, len(chunks) - end
-                        )
-                    )
-                labels.extend([0, 0])
-                layers.append((end, len(chunks)))
-                start = end
-                end = len(chunks)
-                continue
-
-            n_neighbors = int((len(embeddings) - 1) ** 0.8)
-            reduced_embeddings = umap.UMAP(
-                n_neighbors=max(2, n_neighbors),
-                n_components=min(12, len(embeddings) - 2),
-                metric="cosine",
-            ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
-            if n_clusters == 1:
-                lbls = [0 for _ in range(len(reduced_embeddings))]
+                await summarize_layer([[start, start + 1]])
+                lbls = [0, 0]
             else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
-                probs = gm.predict_proba(reduced_embeddings)
-                lbls = [np.where(prob > self._threshold)[0] for prob in probs]
-                lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
-
-            async with trio.open_nursery() as nursery:
-                for c in range(n_clusters):
-                    ck_idx = [i + start for i in range(len(lbls)) if lbls[i] == c]
-                    assert len(ck_idx) > 0
-                    nursery.start_soon(summarize, ck_idx)
-
-            assert len(chunks) - end == n_clusters, "{} vs. {}".format(
-                len(chunks) - end, n_clusters
-            )
+                n_clusters, lbls = await cluster_layer_async(embeddings, self._max_cluster, self._threshold, random_state)
+                await summarize_layer([[i + start for i in range(len(lbls)) if lbls[i] == c] for c in range(n_clusters)])
+                assert len(chunks) - end == n_clusters, "{} vs. {}".format(
+                    len(chunks) - end, n_clusters
+                )
             labels.extend(lbls)
             layers.append((end, len(chunks)))
+            if checkpoint:
+                REDIS_CONN.set(checkpoint, json.dumps({
+                    "layers": layers,
+                    "summaries": [(t, np.asarray(v, dtype=float).tolist()) for t, v in chunks[original_length:]],
+                }), 24 * 3600)
             if callback:
                 callback(
                     msg="Cluster one layer: {} -> {}".format(
@@ -0,0 +1,201 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Clustering of one RAPTOR layer: UMAP reduction, then the number of Gaussian mixture components with the
+lowest BIC, searched coarse-to-fine instead of fitting every number up to max_cluster.
+
+Benchmark on synthetic embeddings, against the exhaustive search for the sizes where it is affordable:
+
+    python -m rag.raptor_clustering --sizes 1000 10000 50000 --baseline-max 10000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import trio
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.mixture import GaussianMixture
+
+from rag.settings import RAPTOR_CLUSTER_PROCESSES, RAPTOR_KMEANS_MIN_SIZE, RAPTOR_SEARCH_SAMPLE
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _warm_means(X, fitted, k):
+    """Means of the fitted mixture, plus the points farthest from them, to start a k-component fit."""
+    means = list(fitted.means_)
+    dist = np.min(((X[:, None, :] - fitted.means_[None, :, :]) ** 2).sum(axis=2), axis=1)
+    while len(means) < k:
+        i = int(np.argmax(dist))
+        means.append(X[i])
+        dist = np.minimum(dist, ((X - X[i]) ** 2).sum(axis=1))
+    return np.array(means)
+
+
+def optimal_clusters(X, max_clusters, random_state, patience=2):
+    """
+    The number of components in [1, max_clusters) with the lowest BIC, and its fitted mixture. Numbers are
+    tried on a doubling grid until the BIC stops improving `patience` times, then the bracket around the
+    best one is narrowed by ternary search, every fit starting from the means of the closest smaller fit.
+    """
+    max_clusters = max(2, min(max_clusters, len(X)))
+    fits, bics = {}, {}
+
+    def bic(k):
+        if k not in bics:
+            smaller = [j for j in fits if j < k]
+            means_init = _warm_means(X, fits[max(smaller)], k) if smaller else None
+            gm = GaussianMixture(n_components=k, random_state=random_state, means_init=means_init)
+            gm.fit(X)
+            fits[k], bics[k] = gm, gm.bic(X)
+        return bics[k]
+
+    grid = sorted({1, max_clusters - 1} | {2 ** i for i in range(1, 32) if 2 ** i < max_clusters - 1})
+    best, worse = 0, 0
+    bic(grid[0])
+    for i in range(1, len(grid)):
+        if bic(grid[i]) < bic(grid[best]):
+            best, worse = i, 0
+        else:
+            worse += 1
+            if worse >= patience:
+                break
+    # The grid neighbours of the best number were both fitted, unless it is the last one.
+    lo, hi = grid[max(0, best - 1)], grid[min(len(grid) - 1, best + 1)]
+    while hi - lo > 2:
+        m1, m2 = lo + (hi - lo) // 3, hi - (hi - lo) // 3
+        if bic(m1) <= bic(m2):
+            hi = m2
+        else:
+            lo = m1
+    k = min(range(lo, hi + 1), key=bic)
+    return k, fits[k]
+
+
+def exhaustive_optimal_clusters(X, max_clusters, random_state):
+    """The former search, fitting every number of components: kept as the benchmark baseline."""
+    max_clusters = min(max_clusters, len(X))
+    n_clusters = np.arange(1, max_clusters)
+    bics = []
+    for n in n_clusters:
+        gm = GaussianMixture(n_components=n, random_state=random_state)
+        gm.fit(X)
+        bics.append(gm.bic(X))
+    return int(n_clusters[np.argmin(bics)])
+
+
+def cluster(X, max_clusters, threshold, random_state):
+    """
+    (number of clusters, label of each point). Large layers are searched on a sample, and above
+    RAPTOR_KMEANS_MIN_SIZE points labelled by mini-batch k-means started from the sample's mixture.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    sample = X
+    if len(X) > RAPTOR_SEARCH_SAMPLE:
+        rng = np.random.RandomState(random_state)
+        sample = X[rng.choice(len(X), RAPTOR_SEARCH_SAMPLE, replace=False)]
+    k, gm = optimal_clusters(sample, max_clusters, random_state)
+    if k == 1:
+        return 1, [0] * len(X)
+
+    if len(X) >= RAPTOR_KMEANS_MIN_SIZE:
+        km = MiniBatchKMeans(n_clusters=k, init=gm.means_, n_init=1, random_state=random_state, batch_size=4096)
+        lbls = km.fit_predict(X)
+    else:
+        if sample is not X:
+            gm = GaussianMixture(n_components=k, random_state=random_state, means_init=gm.means_)
+            gm.fit(X)
+        probs = gm.predict_proba(X)
+        lbls = [np.where(prob > threshold)[0] for prob in probs]
+        lbls = [lbl[0] if len(lbl) else int(np.argmax(prob)) for lbl, prob in zip(lbls, probs)]
+    # Components left without any point are dropped, the others renumbered from 0.
+    ids = {c: i for i, c in enumerate(sorted(set(int(c) for c in lbls)))}
+    return len(ids), [ids[int(c)] for c in lbls]
+
+
+def cluster_layer(embeddings, max_clusters, threshold, random_state):
+    """UMAP reduction of the embeddings of a layer, then `cluster`."""
+    import umap
+
+    n_neighbors = int((len(embeddings) - 1) ** 0.8)
+    reduced = umap.UMAP(
+        n_neighbors=max(2, n_neighbors),
+        n_components=min(12, len(embeddings) - 2),
+        metric="cosine",
+    ).fit_transform(embeddings)
+    return cluster(reduced, max_clusters, threshold, random_state)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=RAPTOR_CLUSTER_PROCESSES,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+async def cluster_layer_async(embeddings, max_clusters, threshold, random_state):
+    """cluster_layer off the trio thread: in the worker processes if RAPTOR_CLUSTER_PROCESSES > 0, else a thread."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if RAPTOR_CLUSTER_PROCESSES > 0:
+        future = _get_pool().submit(cluster_layer, embeddings, max_clusters, threshold, random_state)
+        return await trio.to_thread.run_sync(future.result)
+    return await trio.to_thread.run_sync(cluster_layer, embeddings, max_clusters, threshold, random_state)
+
+
+def synthetic_embeddings(n, k, dim=12, seed=0):
+    """n points around k centers, in the dimension UMAP reduces layers to, and their true labels."""
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(scale=8, size=(k, dim))
+    labels = rng.randint(0, k, n)
+    return centers[labels] + rng.normal(size=(n, dim)), labels
+
+
+def main():
+    from sklearn.metrics import adjusted_rand_score
+
+    parser = argparse.ArgumentParser(description="RAPTOR layer clustering benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--true-clusters", type=int, default=24)
+    parser.add_argument("--max-cluster", type=int, default=64)
+    parser.add_argument("--baseline-max", type=int, default=10000, help="largest size the exhaustive search runs on")
+    args = parser.parse_args()
+
+    report = []
+    for n in args.sizes:
+        X, truth = synthetic_embeddings(n, args.true_clusters)
+        row = {"chunks": n}
+        start = time.perf_counter()
+        k, lbls = cluster(X, args.max_cluster, 0.1, 0)
+        row.update({"k": k, "seconds": round(time.perf_counter() - start, 2), "ari": round(adjusted_rand_score(truth, lbls), 3)})
+        if n <= args.baseline_max:
+            start = time.perf_counter()
+            row["baseline_k"] = exhaustive_optimal_clusters(X, args.max_cluster, 0)
+            row["baseline_search_seconds"] = round(time.perf_counter() - start, 2)
+        logging.info(json.dumps(row))
+        report.append(row)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+CPU time of Dealer.rerank per query on synthetic candidate sets, without any doc store or model.
+
+    python -m rag.rerank_benchmark [--corpus some.txt] [--sizes 64 256 1024] [--queries 20]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from rag.nlp import rag_tokenizer
+from rag.nlp.search import Dealer
+from rag.utils.doc_store_conn import DocStoreConnection
+
+SAMPLE = """Retrieval-augmented generation combines a retriever with a large language model.
+The retriever finds relevant chunks in a knowledge base by full text and vector search,
+then the chunks are reranked and handed to the model as context for answering the question.
+检索增强生成把检索器和大语言模型结合起来，先在知识库中召回相关的文本块，再进行重排序，最后交给模型生成答案。
+Documents are parsed, split into chunks, embedded and indexed before they can be searched."""
+
+
+class NoDocStore(DocStoreConnection):
+    """Dealer only searches through its doc store, which rerank never does."""
+
+
+# Nothing of the doc store is called: let it be instantiated without implementing it.
+NoDocStore.__abstractmethods__ = frozenset()
+
+
+def build_candidates(sentences, n, dim, rng):
+    ids, field = [], {}
+    for i in range(n):
+        content = " ".join(rng.choice(sentences) for _ in range(rng.randint(3, 12)))
+        chunk_id = f"chunk_{i}"
+        ids.append(chunk_id)
+        field[chunk_id] = {
+            "content_ltks": rag_tokenizer.tokenize(content),
+            "title_tks": rag_tokenizer.tokenize(rng.choice(sentences)[:32]),
+            "important_kwd": [],
+            f"q_{dim}_vec": np.random.rand(dim).tolist(),
+        }
+    return ids, field
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dealer.rerank CPU time per query")
+    parser.add_argument("--corpus", default="", help="text file to sample chunk sentences from")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 256, 1024], help="candidate set sizes")
+    parser.add_argument("--queries", type=int, default=20, help="queries per candidate set size")
+    parser.add_argument("--dim", type=int, default=1024, help="embedding dimension")
+    args = parser.parse_args()
+
+    text = open(args.corpus, encoding="utf-8").read() if args.corpus else SAMPLE
+    sentences = [s.strip() for s in text.replace("。", "\n").replace(". ", "\n").split("\n") if s.strip()]
+    rng = random.Random(0)
+    dealer = Dealer(NoDocStore())
+
+    print(f"{'candidates':>10} {'cold ms/query':>14} {'warm ms/query':>14}")
+    for n in args.sizes:
+        ids, field = build_candidates(sentences, n, args.dim, rng)
+        queries = [rng.choice(sentences) for _ in range(args.queries)]
+        timings = []
+        for _ in range(2):
+            start = time.process_time()
+            for q in queries:
+                sres = Dealer.SearchResult(total=n, ids=ids, field=field,
+                                           query_vector=np.random.rand(args.dim).tolist())
+                dealer.rerank(sres, q)
+            timings.append((time.process_time() - start) * 1000 / len(queries))
+        print(f"{n:>10} {timings[0]:>14.2f} {timings[1]:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
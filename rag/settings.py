@@ -65,8 +65,39 @@ elif STORAGE_IMPL_TYPE == 'LOCAL':
 REDIS = get_base_config("redis", {})
 
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
-DOC_BULK_SIZE = int(os.environ.get("DOC_BULK_SIZE", 4))
 EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+# Bulk writes to the doc store: payload bytes per bulk request, requests in flight, retries of failed items
+DOC_BULK_BYTES = int(os.environ.get("DOC_BULK_BYTES", 4 * 1024 * 1024))
+DOC_BULK_INFLIGHT = int(os.environ.get("DOC_BULK_INFLIGHT", 4))
+DOC_BULK_RETRIES = int(os.environ.get("DOC_BULK_RETRIES", 3))
+# Page-sharded PDF parsing: number of worker processes (0/1 disables it) and pages per job
+PDF_PARSER_PROCESSES = int(os.environ.get("PDF_PARSER_PROCESSES", 0))
+PDF_PARSER_PAGES_PER_SHARD = int(os.environ.get("PDF_PARSER_PAGES_PER_SHARD", 8))
+# Cross-page batched ONNX inference: batch sizes, how long a request waits for company (0, the default,
+# disables coalescing) and how many pages of a PDF are OCRed at once on CPU (1, the default, keeps the
+# sequential path; raise both together to let concurrent pages share batches)
+ONNX_BATCH_SIZE = int(os.environ.get("ONNX_BATCH_SIZE", 16))
+ONNX_BATCH_WAIT_MS = int(os.environ.get("ONNX_BATCH_WAIT_MS", 0))
+OCR_DET_BATCH_SIZE = int(os.environ.get("OCR_DET_BATCH_SIZE", 4))
+OCR_PAGE_CONCURRENCY = int(os.environ.get("OCR_PAGE_CONCURRENCY", 1))
+# RAPTOR layer clustering: worker processes (0 runs it in a thread), points the number of clusters is
+# searched on, and layer size from which points are labelled by mini-batch k-means
+RAPTOR_CLUSTER_PROCESSES = int(os.environ.get("RAPTOR_CLUSTER_PROCESSES", 1))
+RAPTOR_SEARCH_SAMPLE = int(os.environ.get("RAPTOR_SEARCH_SAMPLE", 2000))
+RAPTOR_KMEANS_MIN_SIZE = int(os.environ.get("RAPTOR_KMEANS_MIN_SIZE", 5000))
+# Cluster summaries a RAPTOR task asks the LLM for at once, within the global MAX_CONCURRENT_CHATS
+RAPTOR_TASK_LLM_CONCURRENCY = int(os.environ.get("RAPTOR_TASK_LLM_CONCURRENCY", 4))
+# Parsing copies vectors and LLM enrichments of unchanged chunks; the previous parsing's chunks are kept that long at most
+CHUNK_REUSE_ENABLED = int(os.environ.get("CHUNK_REUSE_ENABLED", 1))
+CHUNK_REUSE_TTL = int(os.environ.get("CHUNK_REUSE_TTL", 7 * 24 * 3600))
+# Hash of a chunk's content and enrichment settings, to find a chunk to copy from anywhere in the knowledge base
+CHUNK_REUSE_FLD = "reuse_hash_kwd"
+# Seconds between two writes of the buffered task progress of an executor
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 2))
+# Task queue consumers: how long a read waits for new tasks, and how long a task stays unacknowledged without
+# its executor touching it before another executor claims it
+QUEUE_BLOCK_MS = int(os.environ.get("QUEUE_BLOCK_MS", 2000))
+QUEUE_CLAIM_IDLE_MS = int(os.environ.get("QUEUE_CLAIM_IDLE_MS", 5 * 60 * 1000))
 SVR_QUEUE_NAME = "rag_flow_svr_queue"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_task_broker"
 PAGERANK_FLD = "pagerank_fea"
@@ -85,6 +116,9 @@ except Exception:
 
 def print_rag_settings():
     logging.info(f"MAX_CONTENT_LENGTH: {DOC_MAXIMUM_SIZE}")
+    if "DOC_BULK_SIZE" in os.environ:
+        logging.warning("DOC_BULK_SIZE is no longer used: bulk writes are sized by DOC_BULK_BYTES, "
+                        "see also DOC_BULK_INFLIGHT and DOC_BULK_RETRIES")
     logging.info(f"MAX_FILE_COUNT_PER_USER: {int(os.environ.get('MAX_FILE_NUM_PER_USER', 0))}")
     msg = f"****STORAGE_IMPL_TYPE: USING {STORAGE_IMPL_TYPE} STORAGE ****"
     logging.info(msg)
@@ -0,0 +1,156 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import threading
+import time
+
+from api.db.db_models import close_connection
+from api.db.services.document_service import TASK_CANCEL_CHANNEL, DocumentService, doc_cancel_key
+from api.db.services.task_service import TaskService
+from rag.settings import PROGRESS_FLUSH_INTERVAL
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class ProgressReporter:
+    """
+    Progress of the tasks of a task executor, buffered in memory and written every PROGRESS_FLUSH_INTERVAL
+    seconds in one batch: successive progress values of a task coalesce into the last one (or -1), and its
+    messages into one append. Final values (1 or -1) are written at once.
+
+    Cancellation is learnt from the documents published on TASK_CANCEL_CHANNEL, see publish_doc_cancel,
+    and from their cancel keys, checked when a task starts and at every flush in case a message was missed.
+    Every flush also asks the database for the documents canceled or failed meanwhile (DocumentService.do_cancel),
+    which nothing publishes.
+    """
+
+    def __init__(self, interval=PROGRESS_FLUSH_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._docs = {}
+        self._canceled = set()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._flush_loop, name="progress_flush", daemon=True).start()
+        threading.Thread(target=self._listen, name="progress_cancel", daemon=True).start()
+
+    def track(self, task):
+        with self._lock:
+            self._docs[task["id"]] = task["doc_id"]
+        if REDIS_CONN.get(doc_cancel_key(task["doc_id"])):
+            with self._lock:
+                self._canceled.add(task["doc_id"])
+
+    def untrack(self, task_id):
+        self.flush([task_id])
+        with self._lock:
+            doc_id = self._docs.pop(task_id, None)
+            if doc_id not in self._docs.values():
+                self._canceled.discard(doc_id)
+
+    def is_canceled(self, task_id):
+        with self._lock:
+            doc_id = self._docs.get(task_id)
+            if doc_id is not None:
+                return doc_id in self._canceled
+        # Not a task of this executor: ask the database.
+        return TaskService.do_cancel(task_id)
+
+    def report(self, task_id, prog=None, msg=""):
+        with self._lock:
+            p = self._pending.setdefault(task_id, {"progress_msg": []})
+            if msg:
+                p["progress_msg"].append(msg)
+            if prog is not None and p.get("progress") != -1:
+                p["progress"] = prog if prog == -1 else max(prog, p.get("progress", prog))
+        if prog is not None and (prog < 0 or prog >= 1):
+            self.flush([task_id])
+
+    def flush(self, task_ids=None):
+        with self._lock:
+            if task_ids is None:
+                task_ids = list(self._pending.keys())
+            pending = {i: self._pending.pop(i) for i in task_ids if i in self._pending}
+        if not pending:
+            return
+        updates = {}
+        for task_id, p in pending.items():
+            info = {"progress_msg": "\n".join(p["progress_msg"])}
+            if "progress" in p:
+                info["progress"] = p["progress"]
+            updates[task_id] = info
+        try:
+            TaskService.update_progress_batch(updates)
+        except Exception:
+            logging.exception(f"ProgressReporter.flush of {len(updates)} tasks got exception")
+        finally:
+            close_connection()
+
+    def _check_canceled(self):
+        with self._lock:
+            doc_ids = list(set(self._docs.values()) - self._canceled)
+        if not doc_ids:
+            return
+        canceled = [d for d, v in zip(doc_ids, REDIS_CONN.mget([doc_cancel_key(d) for d in doc_ids])) if v]
+        try:
+            canceled.extend(DocumentService.get_canceled_ids(list(set(doc_ids) - set(canceled))))
+        finally:
+            close_connection()
+        if canceled:
+            with self._lock:
+                self._canceled.update(canceled)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                self._check_canceled()
+            except Exception:
+                logging.exception("ProgressReporter flush loop got exception")
+
+    def _listen(self):
+        while True:
+            pubsub = REDIS_CONN.subscribe(TASK_CANCEL_CHANNEL)
+            if pubsub is None:
+                time.sleep(1)
+                continue
+            try:
+                # Poll rather than listen(): the blocking read would hit the socket timeout of the client.
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    doc_id = message.get("data")
+                    with self._lock:
+                        if doc_id in self._docs.values():
+                            self._canceled.add(doc_id)
+            except Exception as e:
+                logging.warning("ProgressReporter cancel subscription got exception: " + str(e))
+                time.sleep(1)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+PROGRESS = ProgressReporter()
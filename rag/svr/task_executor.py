@@ -49,19 +49,20 @@ from peewee import DoesNotExist
 from api.db import LLMType, ParserType, TaskStatus
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
-from api.db.services.task_service import TaskService
+from api.db.services.task_service import TaskService, split_task_for_idle_peers
 from api.db.services.file2document_service import File2DocumentService
 from api import settings
 from api.versions import get_ragflow_version
-from api.db.db_models import close_connection
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio, \
     email, tag, mdchapter
 from rag.nlp import search, rag_tokenizer
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
-from rag.settings import DOC_MAXIMUM_SIZE, DOC_BULK_SIZE, EMBEDDING_BATCH_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
+from rag.settings import CHUNK_REUSE_ENABLED, CHUNK_REUSE_FLD, DOC_MAXIMUM_SIZE, EMBEDDING_BATCH_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string, truncate
-from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock, RedisQueueConsumer
 from rag.utils.storage_factory import STORAGE_IMPL
+from rag.svr.progress import PROGRESS
+from rag.utils.startup_report import log_startup_report
 from graphrag.utils import chat_limiter
 
 BATCH_SIZE = 64
@@ -86,10 +87,10 @@ FACTORY = {
     ParserType.MDCHAPTER.value: mdchapter
 }
 
-UNACKED_ITERATOR = None
 
 CONSUMER_NO = "0" if len(sys.argv) < 2 else sys.argv[1]
 CONSUMER_NAME = "task_executor_" + CONSUMER_NO
+TASK_QUEUE = RedisQueueConsumer(get_svr_queue_names(), SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME)
 BOOT_AT = datetime.now().astimezone().isoformat(timespec="milliseconds")
 PENDING_TASKS = 0
 LAG_TASKS = 0
@@ -101,7 +102,11 @@ CURRENT_TASKS = {}
 MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', "5"))
 MAX_CONCURRENT_CHUNK_BUILDERS = int(os.environ.get('MAX_CONCURRENT_CHUNK_BUILDERS', "1"))
 MAX_CONCURRENT_MINIO = int(os.environ.get('MAX_CONCURRENT_MINIO', '10'))
+MAX_PIPELINE_BUFFER = int(os.environ.get('MAX_PIPELINE_BUFFER', '2'))
 task_limiter = trio.Semaphore(MAX_CONCURRENT_TASKS)
+collect_lock = trio.Lock()
+# Task fetches failed in a row, for the back-off of collect
+FETCH_FAILURES = 0
 chunk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
 minio_limiter = trio.CapacityLimiter(MAX_CONCURRENT_MINIO)
 kg_limiter = trio.CapacityLimiter(2)
@@ -157,7 +162,7 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     try:
         if prog is not None and prog < 0:
             msg = "[ERROR]" + msg
-        cancel = TaskService.do_cancel(task_id)
+        cancel = PROGRESS.is_canceled(task_id)
 
         if cancel:
             msg += " [Canceled]"
@@ -169,13 +174,7 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
                     msg = f"Page({from_page + 1}~{to_page + 1}): " + msg
         if msg:
             msg = datetime.now().strftime("%H:%M:%S") + " " + msg
-        d = {"progress_msg": msg}
-        if prog is not None:
-            d["progress"] = prog
-
-        TaskService.update_progress(task_id, d)
-
-        close_connection()
+        PROGRESS.report(task_id, prog, msg)
         if cancel:
             raise TaskCanceledException(msg)
         logging.info(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}")
@@ -185,23 +184,19 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
         logging.exception(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}, got exception")
 
 async def collect():
-    global CONSUMER_NAME, DONE_TASKS, FAILED_TASKS
-    global UNACKED_ITERATOR
-
-    svr_queue_names = get_svr_queue_names()
-    try:
-        if not UNACKED_ITERATOR:
-            UNACKED_ITERATOR = REDIS_CONN.get_unacked_iterator(svr_queue_names, SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME)
+    global CONSUMER_NAME, DONE_TASKS, FAILED_TASKS, FETCH_FAILURES
+    async with collect_lock:
         try:
-            redis_msg = next(UNACKED_ITERATOR)
-        except StopIteration:
-            for svr_queue_name in svr_queue_names:
-                redis_msg = REDIS_CONN.queue_consumer(svr_queue_name, SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME)
-                if redis_msg:
-                    break
-    except Exception:
-        logging.exception("collect got exception")
-        return None, None
+            # Prefetch a task for every free slot, the current one included.
+            redis_msg = await trio.to_thread.run_sync(TASK_QUEUE.fetch, task_limiter.value + 1)
+            FETCH_FAILURES = 0
+        except Exception as e:
+            # Back off while Redis is unavailable; holding the lock makes every slot wait.
+            FETCH_FAILURES += 1
+            backoff = min(2 ** FETCH_FAILURES, 60)
+            logging.warning(f"collect got exception: {e}, retrying in {backoff}s")
+            await trio.sleep(backoff)
+            return None, None
 
     if not redis_msg:
         return None, None
@@ -230,56 +225,97 @@ async def get_storage_binary(bucket, name):
     return await trio.to_thread.run_sync(lambda: STORAGE_IMPL.get(bucket, name))
 
 
-async def build_chunks(task, progress_callback):
-    if task["size"] > DOC_MAXIMUM_SIZE:
-        set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
-                                              (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
-        return []
-
-    chunker = FACTORY[task["parser_id"].lower()]
-    try:
-        st = timer()
-        bucket, name = File2DocumentService.get_storage_address(doc_id=task["doc_id"])
-        binary = await get_storage_binary(bucket, name)
-        logging.info("From minio({}) {}/{}".format(timer() - st, task["location"], task["name"]))
-    except TimeoutError:
-        progress_callback(-1, "Internal server error: Fetch file from minio timeout. Could you try it again.")
-        logging.exception(
-            "Minio {}/{} got timeout: Fetch file from minio timeout.".format(task["location"], task["name"]))
-        raise
-    except Exception as e:
-        if re.search("(No such file|not found)", str(e)):
-            progress_callback(-1, "Can not find file <%s> from minio. Could you try it again?" % task["name"])
-        else:
-            progress_callback(-1, "Get file from minio: %s" % str(e).replace("'", ""))
-        logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
-        raise
+async def build_chunks(task, progress_callback, send_channel, on_total=None):
+    """
+    Run the chunker of the task and stream its output to `send_channel` in batches of BATCH_SIZE.
+    Chunkers are asked for a lazy result (naive, book, laws, manual and paper build their chunks window by
+    window, see rag.nlp.LazyChunks), consumed as the pipeline downstream takes the batches, so that the
+    chunk images of a document are not all alive at once. `on_total` is called with the number of chunks
+    expected as soon as the chunker knows it.
+    Returns the number of chunks produced, or None if the document can't be chunked.
+    """
+    async with send_channel:
+        if task["size"] > DOC_MAXIMUM_SIZE:
+            set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
+                                                  (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
+            return None
+
+        chunker = FACTORY[task["parser_id"].lower()]
+        try:
+            st = timer()
+            bucket, name = File2DocumentService.get_storage_address(doc_id=task["doc_id"])
+            binary = await get_storage_binary(bucket, name)
+            logging.info("From minio({}) {}/{}".format(timer() - st, task["location"], task["name"]))
+        except TimeoutError:
+            progress_callback(-1, "Internal server error: Fetch file from minio timeout. Could you try it again.")
+            logging.exception(
+                "Minio {}/{} got timeout: Fetch file from minio timeout.".format(task["location"], task["name"]))
+            raise
+        except Exception as e:
+            if re.search("(No such file|not found)", str(e)):
+                progress_callback(-1, "Can not find file <%s> from minio. Could you try it again?" % task["name"])
+            else:
+                progress_callback(-1, "Get file from minio: %s" % str(e).replace("'", ""))
+            logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
+            raise
 
-    try:
-        async with chunk_limiter:
-            cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
+        def send_batches(cks):
+            total, batch = 0, []
+            for ck in cks:
+                batch.append(ck)
+                total += 1
+                if len(batch) >= BATCH_SIZE:
+                    trio.from_thread.run(send_channel.send, batch)
+                    batch = []
+            if batch:
+                trio.from_thread.run(send_channel.send, batch)
+            return total
+
+        def chunk():
+            cks = chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
                                 to_page=task["to_page"], lang=task["language"], callback=progress_callback,
-                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
-        logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
-    except TaskCanceledException:
-        raise
-    except Exception as e:
-        progress_callback(-1, "Internal server error while chunking: %s" % str(e).replace("'", ""))
-        logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
-        raise
+                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"],
+                                split_units=True, stream=True)
+            if on_total and hasattr(cks, "__len__"):
+                trio.from_thread.run_sync(on_total, len(cks))
+            if isinstance(cks, list):
+                return cks
+            return send_batches(cks)
+
+        def drain(cks):
+            # Chunkers without a lazy result: pop from the tail so that forwarded chunks are released by the list.
+            cks.reverse()
+            while cks:
+                yield cks.pop()
+
+        try:
+            async with chunk_limiter:
+                cks = await trio.to_thread.run_sync(chunk)
+            total = cks if isinstance(cks, int) else await trio.to_thread.run_sync(lambda: send_batches(drain(cks)))
+            logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
+        except (TaskCanceledException, trio.BrokenResourceError):
+            # A stage downstream failed and closed its channel, the failure is its own to report.
+            raise
+        except Exception as e:
+            progress_callback(-1, "Internal server error while chunking: %s" % str(e).replace("'", ""))
+            logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
+            raise
+        return total
+
 
-    docs = []
+async def upload_chunks(task, cks):
     doc = {
         "doc_id": task["doc_id"],
         "kb_id": str(task["kb_id"])
     }
     if task["pagerank"]:
         doc[PAGERANK_FLD] = int(task["pagerank"])
+    docs = [None] * len(cks)
     st = timer()
 
-    async def upload_to_minio(document, chunk):
+    async def upload_to_minio(i, chunk):
         try:
-            d = copy.deepcopy(document)
+            d = copy.deepcopy(doc)
             d.update(chunk)
             d["id"] = xxhash.xxh64((chunk["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
             d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
@@ -287,7 +323,7 @@ async def build_chunks(task, progress_callback):
             if not d.get("image"):
                 _ = d.pop("image", None)
                 d["img_id"] = ""
-                docs.append(d)
+                docs[i] = d
                 return
 
             output_buffer = BytesIO()
@@ -299,105 +335,210 @@ async def build_chunks(task, progress_callback):
                 await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
             d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
             del d["image"]
-            docs.append(d)
+            docs[i] = d
         except Exception:
             logging.exception(
                 "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
             raise
 
     async with trio.open_nursery() as nursery:
-        for ck in cks:
-            nursery.start_soon(upload_to_minio, doc, ck)
-
-    el = timer() - st
-    logging.info("MINIO PUT({}) cost {:.3f} s".format(task["name"], el))
-
-    if task["parser_config"].get("auto_keywords", 0):
-        st = timer()
-        progress_callback(msg="Start to generate keywords for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        async def doc_keyword_extraction(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn})
-            if not cached:
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "keywords", {"topn": topn})
-            if cached:
-                d["important_kwd"] = cached.split(",")
-                d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
-            return
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(doc_keyword_extraction, chat_mdl, d, task["parser_config"]["auto_keywords"])
-        progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+        for i, ck in enumerate(cks):
+            nursery.start_soon(upload_to_minio, i, ck)
 
-    if task["parser_config"].get("auto_questions", 0):
-        st = timer()
-        progress_callback(msg="Start to generate questions for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        async def doc_question_proposal(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn})
-            if not cached:
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "question", {"topn": topn})
-            if cached:
-                d["question_kwd"] = cached.split("\n")
-                d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(doc_question_proposal, chat_mdl, d, task["parser_config"]["auto_questions"])
-        progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
-
-    if task["kb_parser_config"].get("tag_kb_ids", []):
-        progress_callback(msg="Start to tag for every chunk ...")
-        kb_ids = task["kb_parser_config"]["tag_kb_ids"]
-        tenant_id = task["tenant_id"]
-        topn_tags = task["kb_parser_config"].get("topn_tags", 3)
-        S = 1000
-        st = timer()
-        examples = []
-        all_tags = get_tags_from_cache(kb_ids)
-        if not all_tags:
-            all_tags = settings.retrievaler.all_tags_in_portion(tenant_id, kb_ids, S)
-            set_tags_to_cache(kb_ids, all_tags)
-        else:
-            all_tags = json.loads(all_tags)
+    logging.info("MINIO PUT({}) {} chunks cost {:.3f} s".format(task["name"], len(docs), timer() - st))
+    return docs
 
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
 
-        docs_to_tag = []
-        for d in docs:
-            task_canceled = TaskService.do_cancel(task["id"])
-            if task_canceled:
-                progress_callback(-1, msg="Task has been canceled.")
+class ChunkEnricher:
+    """
+    LLM enrichment (keywords, questions and tags) applied batch by batch as chunks stream through the pipeline.
+    """
+
+    def __init__(self, task, progress_callback):
+        self.task = task
+        self.progress_callback = progress_callback
+        self.chat_mdl = None
+        self.all_tags = None
+        self.examples = []
+
+    def _chat_mdl(self):
+        if self.chat_mdl is None:
+            self.chat_mdl = LLMBundle(self.task["tenant_id"], LLMType.CHAT, llm_name=self.task["llm_id"], lang=self.task["language"])
+        return self.chat_mdl
+
+    async def __call__(self, docs):
+        task = self.task
+        if task["parser_config"].get("auto_keywords", 0):
+            st = timer()
+            chat_mdl = self._chat_mdl()
+
+            async def doc_keyword_extraction(chat_mdl, d, topn):
+                cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn}, namespace="keywords")
+                if not cached:
+                    async with chat_limiter:
+                        cached = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, d["content_with_weight"], topn))
+                    set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "keywords", {"topn": topn}, namespace="keywords")
+                if cached:
+                    d["important_kwd"] = cached.split(",")
+                    d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
                 return
-            if settings.retrievaler.tag_content(tenant_id, kb_ids, d, all_tags, topn_tags=topn_tags, S=S) and len(d[TAG_FLD]) > 0:
-                examples.append({"content": d["content_with_weight"], TAG_FLD: d[TAG_FLD]})
-            else:
-                docs_to_tag.append(d)
-
-        async def doc_content_tagging(chat_mdl, d, topn_tags):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags})
-            if not cached:
-                picked_examples = random.choices(examples, k=2) if len(examples)>2 else examples
-                if not picked_examples:
-                    picked_examples.append({"content": "This is an example", TAG_FLD: {'example': 1}})
-                async with chat_limiter:
-                    cached = await trio.to_thread.run_sync(lambda: content_tagging(chat_mdl, d["content_with_weight"], all_tags, picked_examples, topn=topn_tags))
+            async with trio.open_nursery() as nursery:
+                for d in docs:
+                    nursery.start_soon(doc_keyword_extraction, chat_mdl, d, task["parser_config"]["auto_keywords"])
+            self.progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+
+        if task["parser_config"].get("auto_questions", 0):
+            st = timer()
+            chat_mdl = self._chat_mdl()
+
+            async def doc_question_proposal(chat_mdl, d, topn):
+                cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn}, namespace="question")
+                if not cached:
+                    async with chat_limiter:
+                        cached = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, d["content_with_weight"], topn))
+                    set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "question", {"topn": topn}, namespace="question")
                 if cached:
-                    cached = json.dumps(cached)
-            if cached:
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags})
-                d[TAG_FLD] = json.loads(cached)
-        async with trio.open_nursery() as nursery:
-            for d in docs_to_tag:
-                nursery.start_soon(doc_content_tagging, chat_mdl, d, topn_tags)
-        progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+                    d["question_kwd"] = cached.split("\n")
+                    d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
+            async with trio.open_nursery() as nursery:
+                for d in docs:
+                    nursery.start_soon(doc_question_proposal, chat_mdl, d, task["parser_config"]["auto_questions"])
+            self.progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+
+        if task["kb_parser_config"].get("tag_kb_ids", []):
+            kb_ids = task["kb_parser_config"]["tag_kb_ids"]
+            tenant_id = task["tenant_id"]
+            topn_tags = task["kb_parser_config"].get("topn_tags", 3)
+            S = 1000
+            st = timer()
+            if self.all_tags is None:
+                all_tags = get_tags_from_cache(kb_ids)
+                if not all_tags:
+                    all_tags = settings.retrievaler.all_tags_in_portion(tenant_id, kb_ids, S)
+                    set_tags_to_cache(kb_ids, all_tags)
+                else:
+                    all_tags = json.loads(all_tags)
+                self.all_tags = all_tags
+            all_tags = self.all_tags
+            examples = self.examples
+            chat_mdl = self._chat_mdl()
+
+            docs_to_tag = []
+            for d in docs:
+                if PROGRESS.is_canceled(task["id"]):
+                    self.progress_callback(-1, msg="Task has been canceled.")
+                    return None
+                if settings.retrievaler.tag_content(tenant_id, kb_ids, d, all_tags, topn_tags=topn_tags, S=S) and len(d[TAG_FLD]) > 0:
+                    examples.append({"content": d["content_with_weight"], TAG_FLD: d[TAG_FLD]})
+                else:
+                    docs_to_tag.append(d)
+
+            async def doc_content_tagging(chat_mdl, d, topn_tags):
+                cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags}, namespace="tagging")
+                if not cached:
+                    picked_examples = random.choices(examples, k=2) if len(examples)>2 else examples
+                    if not picked_examples:
+                        picked_examples.append({"content": "This is an example", TAG_FLD: {'example': 1}})
+                    async with chat_limiter:
+                        cached = await trio.to_thread.run_sync(lambda: content_tagging(chat_mdl, d["content_with_weight"], all_tags, picked_examples, topn=topn_tags))
+                    if cached:
+                        cached = json.dumps(cached)
+                        set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags}, namespace="tagging")
+                if cached:
+                    d[TAG_FLD] = json.loads(cached)
+            async with trio.open_nursery() as nursery:
+                for d in docs_to_tag:
+                    nursery.start_soon(doc_content_tagging, chat_mdl, d, topn_tags)
+            self.progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+
+        return docs
+
+
+def chunk_enrichment_digest(task):
+    """
+    Digest of the settings a chunk's vector and LLM enrichments depend on, besides its content and, for the
+    vector, the document name.
+    """
+    hasher = xxhash.xxh64()
+    parser_config, kb_parser_config = task["parser_config"], task.get("kb_parser_config") or {}
+    for v in [task["embd_id"], task["llm_id"], task["language"],
+              parser_config.get("auto_keywords", 0), parser_config.get("auto_questions", 0),
+              parser_config.get("filename_embd_weight", 0.1),
+              sorted(kb_parser_config.get("tag_kb_ids", [])), kb_parser_config.get("topn_tags", 3)]:
+        hasher.update(str(v).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class ChunkReuser:
+    """
+    Copies the LLM enrichments of an earlier chunk of the knowledge base with the same content, made with the
+    same enrichment settings, and its vector too if it belongs to a document of the same name: the chunks of
+    the previous parsing of the document, kept until this one finishes (see keep_chunks_for_reuse), or those
+    of another document, e.g. a former version of an edited file. Only the other chunks are then enriched
+    and embedded. Each chunk records the hash of its content and enrichment settings to be found this way.
+    """
+
+    FIELDS = ["important_kwd", "important_tks", "question_kwd", "question_tks", TAG_FLD]
+
+    def __init__(self, task, vector_size):
+        self.task = task
+        self.vector_field = "q_%d_vec" % vector_size
+        self.digest = chunk_enrichment_digest(task)
+        self.enriched = set()
+        self.reused = set()
+
+    def reuse_hash(self, d):
+        return xxhash.xxh64((d["content_with_weight"] + self.digest).encode("utf-8")).hexdigest()
+
+    def unenriched(self, docs):
+        return [d for d in docs if d["id"] not in self.enriched]
+
+    def fresh(self, docs):
+        return [d for d in docs if d["id"] not in self.reused]
+
+    async def __call__(self, docs):
+        for d in docs:
+            d[CHUNK_REUSE_FLD] = self.reuse_hash(d)
+        if not CHUNK_REUSE_ENABLED or not docs:
+            return docs
+        hashes = list(set(d[CHUNK_REUSE_FLD] for d in docs))
+        fields = self.FIELDS + ["content_with_weight", "docnm_kwd", self.vector_field]
+
+        def fetch():
+            # The hash covers the enrichment settings: a chunk with the same content is made with the same.
+            found = {}
+            for rows in settings.docStoreConn.scan(fields, {CHUNK_REUSE_FLD: hashes}, search.index_name(self.task["tenant_id"]),
+                                                   [self.task["kb_id"]]):
+                for row in rows.values():
+                    prev = found.get(row.get("content_with_weight"))
+                    if prev is None or (not self._has_vector(prev) and self._has_vector(row)):
+                        found[row.get("content_with_weight")] = row
+            return found
 
-    return docs
+        try:
+            found = await trio.to_thread.run_sync(fetch)
+        except Exception:
+            logging.exception("ChunkReuser fetching earlier chunks got exception")
+            return docs
+        for d in docs:
+            prev = found.get(d["content_with_weight"])
+            if not prev:
+                continue
+            for f in self.FIELDS:
+                v = prev.get(f)
+                if f == TAG_FLD and isinstance(v, str):
+                    v = json.loads(v)
+                if v:
+                    d[f] = v
+            self.enriched.add(d["id"])
+            if self._has_vector(prev) and prev.get("docnm_kwd") == self.task["name"]:
+                d[self.vector_field] = [float(x) for x in prev[self.vector_field]]
+                self.reused.add(d["id"])
+        return docs
+
+    def _has_vector(self, row):
+        v = row.get(self.vector_field)
+        return v is not None and len(v) > 0
 
 
 def init_kb(row, vector_size: int):
@@ -405,7 +546,11 @@ def init_kb(row, vector_size: int):
     return settings.docStoreConn.createIdx(idxnm, row.get("kb_id", ""), vector_size)
 
 
-async def embedding(docs, mdl, parser_config=None, callback=None):
+async def embedding(docs, mdl, parser_config=None, callback=None, title_vectors=None):
+    """
+    Set the vector of the docs, a mix of their title's and content's. `title_vectors`, kept across calls
+    for the batches of a same document, saves encoding its title again.
+    """
     if parser_config is None:
         parser_config = {}
     tts, cnts = [], []
@@ -421,9 +566,15 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
 
     tk_count = 0
     if len(tts) == len(cnts):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
+        title = tts[0]
+        if title_vectors is not None and title in title_vectors:
+            vts = title_vectors[title]
+        else:
+            vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
+            tk_count += c
+            if title_vectors is not None:
+                title_vectors[title] = vts
         tts = np.concatenate([vts for _ in range(len(tts))], axis=0)
-        tk_count += c
 
     cnts_ = np.array([])
     for i in range(0, len(cnts), EMBEDDING_BATCH_SIZE):
@@ -433,7 +584,8 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
         else:
             cnts_ = np.concatenate((cnts_, vts), axis=0)
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
+        if callback:
+            callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
     cnts = cnts_
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
@@ -452,8 +604,9 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
 async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
     chunks = []
     vctr_nm = "q_%d_vec"%vector_size
-    for d in settings.retrievaler.chunk_list(row["doc_id"], row["tenant_id"], [str(row["kb_id"])],
-                                             fields=["content_with_weight", vctr_nm]):
+    # The doc store lists chunks in no given order, sort them so that a rerun clusters (and resumes) the same way.
+    for d in sorted(settings.retrievaler.chunk_list(row["doc_id"], row["tenant_id"], [str(row["kb_id"])],
+                                                    fields=["content_with_weight", vctr_nm]), key=lambda d: d["id"]):
         chunks.append((d["content_with_weight"], np.array(d[vctr_nm])))
 
     raptor = Raptor(
@@ -465,7 +618,7 @@ async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
         row["parser_config"]["raptor"]["threshold"]
     )
     original_length = len(chunks)
-    chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback)
+    chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback, resume_key=row["doc_id"])
     doc = {
         "doc_id": row["doc_id"],
         "kb_id": [str(row["kb_id"])],
@@ -490,7 +643,158 @@ async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
     return res, tk_count
 
 
+async def delete_image(task, chunk_id):
+    try:
+        async with minio_limiter:
+            STORAGE_IMPL.delete(task["kb_id"], chunk_id)
+    except Exception:
+        logging.exception(
+            "Deleting image of chunk {}/{}/{} got exception".format(task["location"], task["name"], chunk_id))
+        raise
+
+
+async def insert_chunks(task, chunks, chunk_ids, progress_callback, total=None, writer=None):
+    """
+    Insert `chunks` into the doc store and record the ids of the inserted ones on the task.
+    `chunk_ids` accumulates the ids inserted so far by this task.
+    With a `writer` shared by successive calls the bulk requests keep running in the background, so only the
+    chunks whose request already finished are recorded; the caller flushes by passing no chunks at the end.
+    Returns False if the task was canceled or removed meanwhile.
+    """
+    task_id = task["id"]
+    tenant_id = task["tenant_id"]
+    kb_id = task["kb_id"]
+    own_writer = writer is None
+    if own_writer:
+        writer = settings.docStoreConn.bulk_writer(search.index_name(tenant_id), kb_id)
+    try:
+        await trio.to_thread.run_sync(lambda: writer.extend(chunks))
+        if own_writer or not chunks:
+            inserted, errors = await trio.to_thread.run_sync(writer.flush)
+        else:
+            inserted, errors = writer.completed()
+    finally:
+        if own_writer:
+            writer.close()
+    task_canceled = PROGRESS.is_canceled(task_id)
+    if task_canceled:
+        progress_callback(-1, msg="Task has been canceled.")
+        return False
+    if errors:
+        error_message = f"Insert chunk error: {errors}, please check log file and Elasticsearch/Infinity status!"
+        progress_callback(-1, msg=error_message)
+        raise Exception(error_message)
+    if not inserted:
+        return True
+    chunk_ids.extend([chunk["id"] for chunk in inserted])
+    if total:
+        progress_callback(prog=0.8 + 0.1 * min(1.0, len(chunk_ids) / total), msg="")
+    try:
+        TaskService.update_chunk_ids(task_id, " ".join(chunk_ids))
+    except DoesNotExist:
+        logging.warning(f"do_handle_task update_chunk_ids failed since task {task_id} is unknown.")
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(tenant_id), kb_id))
+        async with trio.open_nursery() as nursery:
+            for chunk_id in chunk_ids:
+                nursery.start_soon(delete_image, task, chunk_id)
+        return False
+    return True
+
+
+async def run_chunk_pipeline(task, embedding_model, vector_size, progress_callback):
+    """
+    Stream chunks from the chunker through image upload, LLM enrichment, embedding and doc store insertion.
+    Stages are connected by bounded channels, so only a few batches are alive at any time and
+    the first chunks become searchable while the rest of the document is still being parsed.
+    Returns (chunk_ids, token_count), or None if chunking failed or the task was aborted.
+    """
+    state = {"total": None, "expected": None, "embedded": 0, "token_count": 0}
+    title_vectors = {}
+    chunk_ids = []
+    aborted = False
+    enrich = ChunkEnricher(task, progress_callback)
+    reuse = ChunkReuser(task, vector_size)
+
+    async def enrich_fresh(docs):
+        nonlocal aborted
+        if await enrich(reuse.unenriched(docs)) is None:
+            aborted = True
+            nursery.cancel_scope.cancel()
+        return docs
+
+    def set_expected(n):
+        state["expected"] = n
+
+    async def chunk_stage(send_channel):
+        state["total"] = await build_chunks(task, progress_callback, send_channel, set_expected)
+
+    async def relay(receive_channel, send_channel, fn):
+        async with receive_channel, send_channel:
+            async for batch in receive_channel:
+                await send_channel.send(await fn(batch))
+
+    async def embed(docs):
+        fresh = reuse.fresh(docs)
+        if not fresh:
+            return docs
+        try:
+            token_count, _ = await embedding(fresh, embedding_model, task["parser_config"], title_vectors=title_vectors)
+        except Exception as e:
+            error_message = "Generate embedding error:{}".format(str(e))
+            progress_callback(-1, error_message)
+            logging.exception(error_message)
+            raise
+        state["token_count"] += token_count
+        state["embedded"] += len(docs)
+        expected = state["total"] or state["expected"]
+        if expected:
+            progress_callback(prog=0.7 + 0.1 * min(1.0, state["embedded"] / expected), msg="")
+        return docs
+
+    async def insert_stage(receive_channel):
+        nonlocal aborted
+        st = timer()
+        # One writer for the whole document, so that bulk requests overlap with the stages upstream.
+        writer = settings.docStoreConn.bulk_writer(search.index_name(task["tenant_id"]), task["kb_id"])
+        try:
+            async with receive_channel:
+                async for docs in receive_channel:
+                    if not await insert_chunks(task, docs, chunk_ids, progress_callback, state["total"] or state["expected"], writer):
+                        aborted = True
+                        nursery.cancel_scope.cancel()
+                        return
+                    progress_callback(msg="Indexed {} chunks ({:.1f} chunks/s)".format(
+                        len(chunk_ids), len(chunk_ids) / max(timer() - st, 1e-6)))
+            if not await insert_chunks(task, [], chunk_ids, progress_callback, state["total"], writer):
+                aborted = True
+                nursery.cancel_scope.cancel()
+        finally:
+            with trio.CancelScope(shield=True):
+                await trio.to_thread.run_sync(writer.close)
+
+    async with trio.open_nursery() as nursery:
+        stages = [partial(upload_chunks, task), reuse, enrich_fresh, embed]
+        send_channel, receive_channel = trio.open_memory_channel(MAX_PIPELINE_BUFFER)
+        nursery.start_soon(chunk_stage, send_channel)
+        for fn in stages:
+            next_send_channel, next_receive_channel = trio.open_memory_channel(MAX_PIPELINE_BUFFER)
+            nursery.start_soon(relay, receive_channel, next_send_channel, fn)
+            receive_channel = next_receive_channel
+        nursery.start_soon(insert_stage, receive_channel)
+
+    if aborted or state["total"] is None:
+        return None
+    if reuse.enriched:
+        progress_callback(msg="Reused the enrichments of {} unchanged chunks, and the vectors of {}".format(
+            len(reuse.enriched), len(reuse.reused)))
+    return chunk_ids, state["token_count"]
+
+
 async def do_handle_task(task):
+    # Share a large range with idle executors before starting on it.
+    rest = await trio.to_thread.run_sync(lambda: split_task_for_idle_peers(task, CONSUMER_NAME))
+    if rest:
+        logging.info(f"Task {task['id']} split, pages/units {rest['from_page']}~{rest['to_page']} queued as task {rest['id']}")
     task_id = task["id"]
     task_from_page = task["from_page"]
     task_to_page = task["to_page"]
@@ -514,7 +818,7 @@ async def do_handle_task(task):
         progress_callback(-1, msg=error_message)
         raise Exception(error_message)
 
-    task_canceled = TaskService.do_cancel(task_id)
+    task_canceled = PROGRESS.is_canceled(task_id)
     if task_canceled:
         progress_callback(-1, msg="Task has been canceled.")
         return
@@ -522,8 +826,7 @@ async def do_handle_task(task):
     try:
         # bind embedding model
         embedding_model = LLMBundle(task_tenant_id, LLMType.EMBEDDING, llm_name=task_embedding_id, lang=task_language)
-        vts, _ = embedding_model.encode(["ok"])
-        vector_size = len(vts[0])
+        vector_size = embedding_model.vector_size()
     except Exception as e:
         error_message = f'Fail to bind embedding model: {str(e)}'
         progress_callback(-1, msg=error_message)
@@ -532,6 +835,7 @@ async def do_handle_task(task):
 
     init_kb(task, vector_size)
 
+    start_ts = timer()
     # Either using RAPTOR or Standard chunking methods
     if task.get("task_type", "") == "raptor":
         # bind LLM for raptor
@@ -539,12 +843,15 @@ async def do_handle_task(task):
         # run RAPTOR
         async with kg_limiter:
             chunks, token_count = await run_raptor(task, chat_model, embedding_model, vector_size, progress_callback)
+        start_ts = timer()
+        chunk_ids = []
+        if not await insert_chunks(task, chunks, chunk_ids, progress_callback, len(chunks)):
+            return
     # Either using graphrag or Standard chunking methods
     elif task.get("task_type", "") == "graphrag":
         if not task_parser_config.get("graphrag", {}).get("use_graphrag", False):
             return
         graphrag_conf = task["kb_parser_config"].get("graphrag", {})
-        start_ts = timer()
         chat_model = LLMBundle(task_tenant_id, LLMType.CHAT, llm_name=task_llm_id, lang=task_language)
         with_resolution = graphrag_conf.get("resolution", False)
         with_community = graphrag_conf.get("community", False)
@@ -553,70 +860,19 @@ async def do_handle_task(task):
         progress_callback(prog=1.0, msg="Knowledge Graph done ({:.2f}s)".format(timer() - start_ts))
         return
     else:
-        # Standard chunking methods
-        start_ts = timer()
-        chunks = await build_chunks(task, progress_callback)
-        logging.info("Build document {}: {:.2f}s".format(task_document_name, timer() - start_ts))
-        if chunks is None:
+        # Standard chunking methods, streamed from the chunker to the doc store
+        res = await run_chunk_pipeline(task, embedding_model, vector_size, progress_callback)
+        if res is None:
             return
-        if not chunks:
+        chunk_ids, token_count = res
+        logging.info("Build document {}: {:.2f}s".format(task_document_name, timer() - start_ts))
+        if not chunk_ids:
             progress_callback(1., msg=f"No chunk built from {task_document_name}")
             return
-        # TODO: exception handler
-        ## set_progress(task["did"], -1, "ERROR: ")
-        progress_callback(msg="Generate {} chunks".format(len(chunks)))
-        start_ts = timer()
-        try:
-            token_count, vector_size = await embedding(chunks, embedding_model, task_parser_config, progress_callback)
-        except Exception as e:
-            error_message = "Generate embedding error:{}".format(str(e))
-            progress_callback(-1, error_message)
-            logging.exception(error_message)
-            token_count = 0
-            raise
-        progress_message = "Embedding chunks ({:.2f}s)".format(timer() - start_ts)
-        logging.info(progress_message)
-        progress_callback(msg=progress_message)
-
-    chunk_count = len(set([chunk["id"] for chunk in chunks]))
-    start_ts = timer()
-    doc_store_result = ""
-
-    async def delete_image(kb_id, chunk_id):
-        try:
-            async with minio_limiter:
-                STORAGE_IMPL.delete(kb_id, chunk_id)
-        except Exception:
-            logging.exception(
-                "Deleting image of chunk {}/{}/{} got exception".format(task["location"], task["name"], chunk_id))
-            raise
 
-    for b in range(0, len(chunks), DOC_BULK_SIZE):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + DOC_BULK_SIZE], search.index_name(task_tenant_id), task_dataset_id))
-        task_canceled = TaskService.do_cancel(task_id)
-        if task_canceled:
-            progress_callback(-1, msg="Task has been canceled.")
-            return
-        if b % 128 == 0:
-            progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            progress_callback(-1, msg=error_message)
-            raise Exception(error_message)
-        chunk_ids = [chunk["id"] for chunk in chunks[:b + DOC_BULK_SIZE]]
-        chunk_ids_str = " ".join(chunk_ids)
-        try:
-            TaskService.update_chunk_ids(task["id"], chunk_ids_str)
-        except DoesNotExist:
-            logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
-            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
-            async with trio.open_nursery() as nursery:
-                for chunk_id in chunk_ids:
-                    nursery.start_soon(delete_image, task_dataset_id, chunk_id)
-            return
-        
+    chunk_count = len(set(chunk_ids))
     logging.info("Indexing doc({}), page({}-{}), chunks({}), elapsed: {:.2f}".format(task_document_name, task_from_page,
-                                                                                     task_to_page, len(chunks),
+                                                                                     task_to_page, len(chunk_ids),
                                                                                      timer() - start_ts))
 
     DocumentService.increment_chunk_num(task_doc_id, task_dataset_id, token_count, chunk_count, 0)
@@ -626,7 +882,7 @@ async def do_handle_task(task):
     progress_callback(prog=1.0, msg="Indexing done ({:.2f}s). Task done ({:.2f}s)".format(time_cost, task_time_cost))
     logging.info(
         "Chunk doc({}), page({}-{}), chunks({}), token({}), elapsed:{:.2f}".format(task_document_name, task_from_page,
-                                                                                   task_to_page, len(chunks),
+                                                                                   task_to_page, len(chunk_ids),
                                                                                    token_count, task_time_cost))
 
 
@@ -634,11 +890,11 @@ async def handle_task():
     global DONE_TASKS, FAILED_TASKS
     redis_msg, task = await collect()
     if not task:
-        await trio.sleep(5)
         return
     try:
         logging.info(f"handle_task begin for task {json.dumps(task)}")
         CURRENT_TASKS[task["id"]] = copy.deepcopy(task)
+        PROGRESS.track(task)
         await do_handle_task(task)
         DONE_TASKS += 1
         CURRENT_TASKS.pop(task["id"], None)
@@ -655,6 +911,7 @@ async def handle_task():
         except Exception:
             pass
         logging.exception(f"handle_task got exception for task {json.dumps(task)}")
+    PROGRESS.untrack(task["id"])
     redis_msg.ack()
 
 
@@ -680,8 +937,16 @@ async def report_status():
                 "done": DONE_TASKS,
                 "failed": FAILED_TASKS,
                 "current": current,
+                "max_tasks": MAX_CONCURRENT_TASKS,
+                "fetched": TASK_QUEUE.fetched(),
             })
             REDIS_CONN.zadd(CONSUMER_NAME, heartbeat, now.timestamp())
+            # Keep the tasks held by this executor from being claimed, and take over those of dead executors.
+            TASK_QUEUE.touch()
+            # Buffer no more tasks than there are free slots.
+            free = task_limiter.value - TASK_QUEUE.fetched()
+            if free > 0:
+                TASK_QUEUE.claim_stale(free)
             logging.info(f"{CONSUMER_NAME} reported heartbeat: {heartbeat}")
 
             expired = REDIS_CONN.zcount(CONSUMER_NAME, 0, now.timestamp() - 60 * 30)
@@ -726,6 +991,7 @@ async def main():
     logging.info(f'TaskExecutor: RAGFlow version: {get_ragflow_version()}')
     settings.init_settings()
     print_rag_settings()
+    log_startup_report(CONSUMER_NAME)
     if sys.platform != "win32":
         signal.signal(signal.SIGUSR1, start_tracemalloc_and_snapshot)
         signal.signal(signal.SIGUSR2, stop_tracemalloc)
@@ -736,6 +1002,7 @@ async def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    PROGRESS.start()
     async with trio.open_nursery() as nursery:
         nursery.start_soon(report_status)
         while not stop_event.is_set():
@@ -14,10 +14,17 @@
 #  limitations under the License.
 #
 
+import json
+import logging
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import numpy as np
 
+from rag.settings import DOC_BULK_BYTES, DOC_BULK_INFLIGHT, DOC_BULK_RETRIES
+
 DEFAULT_MATCH_VECTOR_TOPN = 10
 DEFAULT_MATCH_SPARSE_TOPN = 10
 VEC = list | np.ndarray
@@ -208,6 +215,32 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    def search_many(self, searches: list[dict]) -> list:
+        """
+        Run several searches, each given as the keyword arguments of `search`, and return their results in order.
+        Engines with a multi-search API override this to use a single round-trip, others run the searches concurrently.
+        """
+        if len(searches) < 2:
+            return [self.search(**kwargs) for kwargs in searches]
+        with ThreadPoolExecutor(max_workers=min(len(searches), 8)) as pool:
+            return list(pool.map(lambda kwargs: self.search(**kwargs), searches))
+
+    def scan(self, selectFields: list[str], condition: dict, indexNames: str | list[str], knowledgebaseIds: list[str],
+             batchSize: int = 1024):
+        """
+        Every document matching the condition, yielded batch by batch as getFields dicts keyed by id.
+        Engines bounding offset paging (Elasticsearch/OpenSearch max_result_window) override this to page with a cursor.
+        """
+        offset = 0
+        while True:
+            res = self.search(selectFields, [], condition, [], OrderByExpr(), offset, batchSize, indexNames, knowledgebaseIds)
+            rows = self.getFields(res, selectFields)
+            if rows:
+                yield rows
+            if len(rows) < batchSize:
+                break
+            offset += batchSize
+
     @abstractmethod
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         """
@@ -222,6 +255,27 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    def bulk_insert(self, rows: list[dict], indexName: str, knowledgebaseId: str = None) -> dict[str, tuple[str, bool]]:
+        """
+        Insert rows in a single bulk request and return, by row id, the error of each failed row and
+        whether it is worth retrying. Engines reporting errors per item override this; here any error
+        fails the whole bulk.
+        """
+        errors = self.insert(rows, indexName, knowledgebaseId)
+        if not errors:
+            return {}
+        return {row["id"]: ("; ".join(errors), True) for row in rows}
+
+    def bulk_writer(self, indexName: str, knowledgebaseId: str = None, **kwargs) -> "BulkWriter":
+        return BulkWriter(self, indexName, knowledgebaseId, **kwargs)
+
+    def insert_stream(self, rows, indexName: str, knowledgebaseId: str = None) -> list[str]:
+        """
+        Insert any number of rows through a BulkWriter and return the errors like `insert` does.
+        """
+        with self.bulk_writer(indexName, knowledgebaseId) as writer:
+            return writer.write(rows)
+
     @abstractmethod
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         """
@@ -269,3 +323,105 @@ class DocStoreConnection(ABC):
         Run the sql generated by text-to-sql
         """
         raise NotImplementedError("Not implemented")
+
+
+class BulkWriter:
+    """
+    Streams rows into a doc store index. Rows are grouped into bulk requests of about `max_bytes` of payload
+    rather than of a fixed count, up to `max_inflight` requests run at the same time, and only the rows
+    which failed in a request are retried, at most `max_retries` times.
+
+    `add`/`extend` block while all the request slots are busy. `completed` hands over the rows of the
+    requests finished so far and their errors, `flush` waits for all of them first.
+    """
+
+    def __init__(self, conn: DocStoreConnection, indexName: str, knowledgebaseId: str = None,
+                 max_bytes=DOC_BULK_BYTES, max_inflight=DOC_BULK_INFLIGHT, max_retries=DOC_BULK_RETRIES, max_rows=1024):
+        self.conn = conn
+        self.indexName = indexName
+        self.knowledgebaseId = knowledgebaseId
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.max_retries = max_retries
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_inflight))
+        self._slots = threading.BoundedSemaphore(max(1, max_inflight))
+        self._batch = []
+        self._batch_bytes = 0
+        self._futures = []
+
+    def add(self, row: dict):
+        size = len(json.dumps(row, ensure_ascii=False, default=str).encode("utf-8"))
+        if self._batch and (self._batch_bytes + size > self.max_bytes or len(self._batch) >= self.max_rows):
+            self._send()
+        self._batch.append(row)
+        self._batch_bytes += size
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def _send(self):
+        rows, self._batch, self._batch_bytes = self._batch, [], 0
+        self._slots.acquire()
+        try:
+            fut = self._pool.submit(self._write, rows)
+        except Exception:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(fut)
+
+    def _write(self, rows):
+        pending, errors = rows, {}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 30))
+            try:
+                failed = self.conn.bulk_insert(pending, self.indexName, self.knowledgebaseId)
+            except Exception as e:
+                logging.warning(f"BulkWriter: bulk of {len(pending)} rows into {self.indexName} got exception: {e}")
+                failed = {row["id"]: (str(e), True) for row in pending}
+            for row in pending:
+                errors.pop(row["id"], None)
+            errors.update((i, e) for i, (e, _) in failed.items())
+            pending = [row for row in pending if failed.get(row["id"], ("", False))[1]]
+            if not pending:
+                break
+            if attempt < self.max_retries:
+                logging.warning(f"BulkWriter: retry {len(pending)} rows failed to be inserted into {self.indexName}")
+        written = [row for row in rows if row["id"] not in errors]
+        return written, [f"{i}:{e}" for i, e in errors.items()]
+
+    def completed(self):
+        """The rows of the bulk requests finished since the last call, and the errors of those which failed."""
+        written, errors, running = [], [], []
+        for fut in self._futures:
+            if not fut.done():
+                running.append(fut)
+                continue
+            w, e = fut.result()
+            written.extend(w)
+            errors.extend(e)
+        self._futures = running
+        return written, errors
+
+    def flush(self):
+        if self._batch:
+            self._send()
+        for fut in self._futures:
+            fut.exception()
+        return self.completed()
+
+    def write(self, rows) -> list[str]:
+        """Insert `rows` and wait for them, returning the errors like `DocStoreConnection.insert`."""
+        self.extend(rows)
+        return self.flush()[1]
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
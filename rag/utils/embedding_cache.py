@@ -0,0 +1,135 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+
+EMBEDDING_CACHE_ENABLED = int(os.environ.get("EMBEDDING_CACHE_ENABLED", "1"))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+EMBEDDING_CACHE_LRU_BYTES = int(os.environ.get("EMBEDDING_CACHE_LRU_BYTES", 64 * 1024 * 1024))
+EMBEDDING_CACHE_DTYPE = np.float16 if os.environ.get("EMBEDDING_CACHE_DTYPE", "float32") == "float16" else np.float32
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache: an in-process LRU in front of Redis.
+    Vectors are keyed by (model, kind, normalized text hash) and stored as raw float32/float16 blobs.
+    """
+
+    def __init__(self, lru_bytes=EMBEDDING_CACHE_LRU_BYTES, ttl=EMBEDDING_CACHE_TTL, dtype=EMBEDDING_CACHE_DTYPE):
+        self.lru_bytes = lru_bytes
+        self.ttl = ttl
+        self.dtype = dtype
+        self._lru = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(txt):
+        return re.sub(r"\s+", " ", str(txt)).strip()
+
+    @staticmethod
+    def key(model, txt, kind="doc"):
+        hasher = xxhash.xxh128()
+        hasher.update(EmbeddingCache.normalize(txt).encode("utf-8"))
+        return f"embd:{kind}:{model}:{hasher.hexdigest()}"
+
+    def _lru_get(self, k):
+        with self._lock:
+            v = self._lru.get(k)
+            if v is not None:
+                self._lru.move_to_end(k)
+            return v
+
+    def _lru_put(self, k, v):
+        with self._lock:
+            if k in self._lru:
+                self._size -= self._lru.pop(k).nbytes
+            self._lru[k] = v
+            self._size += v.nbytes
+            while self._size > self.lru_bytes and self._lru:
+                _, old = self._lru.popitem(last=False)
+                self._size -= old.nbytes
+
+    def mget(self, model, texts, kind="doc"):
+        """Return a list aligned with `texts` holding a cached vector or None."""
+        keys = [self.key(model, t, kind) for t in texts]
+        res = [self._lru_get(k) for k in keys]
+        remote = [i for i, v in enumerate(res) if v is None]
+        if remote:
+            for i, blob in zip(remote, REDIS_CONN.mget_bin([keys[i] for i in remote])):
+                if not blob:
+                    continue
+                v = np.frombuffer(blob, dtype=self.dtype).astype(np.float32)
+                self._lru_put(keys[i], v)
+                res[i] = v
+        hits = sum(1 for v in res if v is not None)
+        self.hits += hits
+        self.misses += len(res) - hits
+        return res
+
+    def mset(self, model, texts, vectors, kind="doc"):
+        mapping = {}
+        for t, v in zip(texts, vectors):
+            k = self.key(model, t, kind)
+            v = np.asarray(v, dtype=np.float32)
+            self._lru_put(k, v)
+            mapping[k] = v.astype(self.dtype).tobytes()
+        REDIS_CONN.mset_bin(mapping, self.ttl)
+
+    def get(self, model, txt, kind="doc"):
+        return self.mget(model, [txt], kind)[0]
+
+    def set(self, model, txt, vector, kind="doc"):
+        self.mset(model, [txt], [vector], kind)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / total if total else 0.0,
+                "lru_entries": len(self._lru), "lru_bytes": self._size}
+
+
+def cached_encode(model, texts, encode_fn, kind="doc"):
+    """
+    Encode `texts` with `encode_fn`, sending only cache misses to the model.
+    Returns (embeddings, used_tokens) like the model's own encode.
+    """
+    if not EMBEDDING_CACHE_ENABLED or not texts:
+        return encode_fn(texts)
+    vectors = EMBEDDING_CACHE.mget(model, texts, kind)
+    missed = [i for i, v in enumerate(vectors) if v is None]
+    used_tokens = 0
+    if missed:
+        embds, used_tokens = encode_fn([texts[i] for i in missed])
+        for i, v in zip(missed, embds):
+            vectors[i] = np.asarray(v, dtype=np.float32)
+        try:
+            EMBEDDING_CACHE.mset(model, [texts[i] for i in missed], [vectors[i] for i in missed], kind)
+        except Exception:
+            logging.exception("EmbeddingCache.mset got exception")
+    return np.stack(vectors), used_tokens
+
+
+EMBEDDING_CACHE = EmbeddingCache()
@@ -31,6 +31,7 @@ from api.utils.file_utils import get_project_base_directory
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
     FusionExpr
 from rag.nlp import is_english, rag_tokenizer
+from rag.utils.retrieval_cache import bumps_kb_version
 
 ATTEMPT_TIME = 2
 
@@ -130,7 +131,7 @@ class ESConnection(DocStoreConnection):
     CRUD operations
     """
 
-    def search(
+    def _build_search(
             self, selectFields: list[str],
             highlightFields: list[str],
             condition: dict,
@@ -144,6 +145,7 @@ class ESConnection(DocStoreConnection):
             rank_feature: dict | None = None
     ):
         """
+        Build the request body of a search.
         Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl.html
         """
         if isinstance(indexNames, str):
@@ -236,7 +238,23 @@ class ESConnection(DocStoreConnection):
             s = s[offset:offset + limit]
         q = s.to_dict()
         logger.debug(f"ESConnection.search {str(indexNames)} query: " + json.dumps(q))
+        return indexNames, q
 
+    def search(
+            self, selectFields: list[str],
+            highlightFields: list[str],
+            condition: dict,
+            matchExprs: list[MatchExpr],
+            orderBy: OrderByExpr,
+            offset: int,
+            limit: int,
+            indexNames: str | list[str],
+            knowledgebaseIds: list[str],
+            aggFields: list[str] = [],
+            rank_feature: dict | None = None
+    ):
+        indexNames, q = self._build_search(selectFields, highlightFields, condition, matchExprs, orderBy, offset, limit,
+                                           indexNames, knowledgebaseIds, aggFields, rank_feature)
         for i in range(ATTEMPT_TIME):
             try:
                 #print(json.dumps(q, ensure_ascii=False))
@@ -258,6 +276,69 @@ class ESConnection(DocStoreConnection):
         logger.error("ESConnection.search timeout for 3 times!")
         raise Exception("ESConnection.search timeout.")
 
+    def search_many(self, searches: list[dict]) -> list:
+        """
+        Run several searches in one _msearch round-trip.
+        Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/search-multi-search.html
+        """
+        if len(searches) < 2:
+            return [self.search(**kwargs) for kwargs in searches]
+        body = []
+        for kwargs in searches:
+            indexNames, q = self._build_search(**kwargs)
+            q["track_total_hits"] = True
+            q["timeout"] = "600s"
+            body.append({"index": ",".join(indexNames)})
+            body.append(q)
+
+        for i in range(ATTEMPT_TIME):
+            try:
+                res = self.es.msearch(searches=body)
+                break
+            except Exception as e:
+                logger.exception("ESConnection.search_many got exception")
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        else:
+            logger.error("ESConnection.search_many timeout for 3 times!")
+            raise Exception("ESConnection.search_many timeout.")
+
+        results = []
+        for kwargs, r in zip(searches, res["responses"]):
+            if "error" in r or str(r.get("timed_out", "")).lower() == "true":
+                logger.warning(f"ESConnection.search_many falls back to a single search: {r.get('error', 'timeout')}")
+                r = self.search(**kwargs)
+            results.append(r)
+        return results
+
+    def scan(self, selectFields: list[str], condition: dict, indexNames: str | list[str], knowledgebaseIds: list[str],
+             batchSize: int = 1024):
+        """
+        Page with a scroll rather than offsets, which stop at max_result_window (10000 by default).
+        Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/paginate-search-results.html#scroll-search-results
+        """
+        indexNames, q = self._build_search(selectFields, [], condition, [], OrderByExpr(), 0, batchSize,
+                                           indexNames, knowledgebaseIds)
+        q["sort"] = ["_doc"]
+        res = self.es.search(index=indexNames, body=q, scroll="5m", _source=True)
+        scroll_id = res.get("_scroll_id")
+        try:
+            while True:
+                rows = self.getFields(res, selectFields)
+                if rows:
+                    yield rows
+                if len(res["hits"]["hits"]) < batchSize or not scroll_id:
+                    break
+                res = self.es.scroll(scroll_id=scroll_id, scroll="5m")
+                scroll_id = res.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except Exception as e:
+                    logger.warning("ESConnection.scan clear_scroll got exception: " + str(e))
+
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         for i in range(ATTEMPT_TIME):
             try:
@@ -278,7 +359,8 @@ class ESConnection(DocStoreConnection):
         logger.error("ESConnection.get timeout for 3 times!")
         raise Exception("ESConnection.get timeout.")
 
-    def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
+    @staticmethod
+    def _bulk_operations(documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[dict]:
         # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
         operations = []
         for d in documents:
@@ -290,6 +372,11 @@ class ESConnection(DocStoreConnection):
             operations.append(
                 {"index": {"_index": indexName, "_id": meta_id}})
             operations.append(d_copy)
+        return operations
+
+    @bumps_kb_version
+    def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
+        operations = self._bulk_operations(documents, indexName, knowledgebaseId)
 
         res = []
         for _ in range(ATTEMPT_TIME):
@@ -315,6 +402,22 @@ class ESConnection(DocStoreConnection):
                     continue
         return res
 
+    @bumps_kb_version
+    def bulk_insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> dict[str, tuple[str, bool]]:
+        r = self.es.bulk(index=(indexName), operations=self._bulk_operations(documents, indexName, knowledgebaseId),
+                         refresh=False, timeout="60s")
+        if not r["errors"]:
+            return {}
+        errors = {}
+        for item in r["items"]:
+            for action in ["create", "delete", "index", "update"]:
+                if action in item and "error" in item[action]:
+                    # Rejections because of load are worth retrying, mapping errors and the like aren't.
+                    status = item[action].get("status", 500)
+                    errors[str(item[action]["_id"])] = (str(item[action]["error"]), status == 429 or status >= 500)
+        return errors
+
+    @bumps_kb_version
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -349,6 +452,10 @@ class ESConnection(DocStoreConnection):
             if k == "exists":
                 bqry.filter.append(Q("exists", field=v))
                 continue
+            if k == "id":
+                # chunk ids are the document _id, not a field of the source
+                bqry.filter.append(Q("ids", values=v))
+                continue
             if isinstance(v, list):
                 bqry.filter.append(Q("terms", **{k: v}))
             elif isinstance(v, str) or isinstance(v, int):
@@ -406,6 +513,7 @@ class ESConnection(DocStoreConnection):
                 break
         return False
 
+    @bumps_kb_version
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
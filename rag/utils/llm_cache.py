@@ -0,0 +1,293 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LLM_CACHE_ENABLED = int(os.environ.get("LLM_CACHE_ENABLED", "1"))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Per namespace overrides, e.g. {"graphrag": {"ttl": 2592000, "max_bytes": 2147483648}}
+LLM_CACHE_NAMESPACES = json.loads(os.environ.get("LLM_CACHE_NAMESPACES", "{}"))
+# SQLite file of a local tier in front of Redis, none if empty
+LLM_CACHE_DISK_PATH = os.environ.get("LLM_CACHE_DISK_PATH", "")
+LLM_CACHE_COMPRESS_MIN = 256
+
+_RAW, _ZLIB, _ZSTD = b"r", b"z", b"Z"
+
+
+def compress(txt: str) -> bytes:
+    data = txt.encode("utf-8")
+    if len(data) < LLM_CACHE_COMPRESS_MIN:
+        return _RAW + data
+    if zstandard is not None:
+        return _ZSTD + zstandard.ZstdCompressor(level=3).compress(data)
+    return _ZLIB + zlib.compress(data, 6)
+
+
+def decompress(blob: bytes) -> str:
+    head, data = blob[:1], blob[1:]
+    if head == _ZSTD:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif head == _ZLIB:
+        data = zlib.decompress(data)
+    elif head != _RAW:
+        raise ValueError("unknown LLM cache entry format")
+    return data.decode("utf-8")
+
+
+def canonical(obj) -> str:
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class DiskTier:
+    """Local SQLite copy of the entries, evicted least recently used first per namespace."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (k TEXT PRIMARY KEY, ns TEXT, v BLOB, size INTEGER, expires REAL, accessed REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_ns_accessed ON llm_cache (ns, accessed)")
+
+    def get(self, k):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT v, expires FROM llm_cache WHERE k=?", (k,)).fetchone()
+            if not row:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM llm_cache WHERE k=?", (k,))
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed=? WHERE k=?", (now, k))
+            return row[0]
+
+    def set(self, ns, k, blob, ttl, max_bytes):
+        """Store the entry, and return how many entries of the namespace were evicted to stay within max_bytes."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, ?)", (k, ns, blob, len(blob), now + ttl, now))
+            evicted = self._conn.execute("DELETE FROM llm_cache WHERE ns=? AND expires<?", (ns, now)).rowcount
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache WHERE ns=?", (ns,)).fetchone()[0]
+            while max_bytes and total > max_bytes:
+                rows = self._conn.execute("SELECT k, size FROM llm_cache WHERE ns=? ORDER BY accessed LIMIT 256", (ns,)).fetchall()
+                if not rows:
+                    break
+                drop = []
+                for k_, size in rows:
+                    if total <= max_bytes:
+                        break
+                    drop.append((k_,))
+                    total -= size
+                self._conn.executemany("DELETE FROM llm_cache WHERE k=?", drop)
+                evicted += len(drop)
+            return evicted
+
+
+class LLMCache:
+    """
+    Cache of LLM responses in Redis, split in namespaces (keywords, question, tagging, graphrag, raptor...)
+    with their own TTL and size budget. Keys hash the canonical JSON of (model, system prompt, history,
+    generation config) and values are stored compressed. Each namespace tracks its entries in a sorted set
+    by last access, so that once its bytes exceed max_bytes the least recently used entries are evicted.
+    Hits, misses and bytes are counted per namespace in Redis, hence summed over every process.
+    """
+
+    def __init__(self, namespaces=LLM_CACHE_NAMESPACES, disk_path=LLM_CACHE_DISK_PATH):
+        self.namespaces = namespaces
+        self.disk = DiskTier(disk_path) if disk_path else None
+        self.disk_hits = defaultdict(int)
+
+    def config(self, ns):
+        conf = self.namespaces.get(ns, {})
+        return int(conf.get("ttl", LLM_CACHE_TTL)), int(conf.get("max_bytes", LLM_CACHE_MAX_BYTES))
+
+    @staticmethod
+    def key(ns, llmnm, txt, history, genconf):
+        hasher = xxhash.xxh128()
+        hasher.update(canonical([llmnm, txt, history, genconf]).encode("utf-8"))
+        return f"llmcache:{ns}:{hasher.hexdigest()}"
+
+    @staticmethod
+    def _lru_key(ns):
+        return f"llmcache_lru:{ns}"
+
+    @staticmethod
+    def _bytes_key(ns):
+        return f"llmcache_bytes:{ns}"
+
+    @staticmethod
+    def _stats_key(ns):
+        return f"llmcache_stats:{ns}"
+
+    def get(self, ns, llmnm, txt, history, genconf):
+        if not LLM_CACHE_ENABLED:
+            return None
+        k = self.key(ns, llmnm, txt, history, genconf)
+        blob = None
+        if self.disk:
+            try:
+                blob = self.disk.get(k)
+            except Exception:
+                logging.exception("LLMCache disk tier get got exception")
+            if blob:
+                self.disk_hits[ns] += 1
+        redis = REDIS_CONN.REDIS_BIN
+        try:
+            if not blob:
+                blob = redis.get(k)
+                if blob and self.disk:
+                    ttl, max_bytes = self.config(ns)
+                    self.disk.set(ns, k, blob, ttl, max_bytes)
+            pipe = redis.pipeline(transaction=False)
+            if blob:
+                pipe.zadd(self._lru_key(ns), {f"{k}|{len(blob)}": time.time()}, xx=True)
+                pipe.hincrby(self._stats_key(ns), "hits", 1)
+                pipe.hincrby(self._stats_key(ns), "bytes_read", len(blob))
+            else:
+                pipe.hincrby(self._stats_key(ns), "misses", 1)
+            pipe.execute()
+        except Exception as e:
+            logging.warning("LLMCache.get got exception: " + str(e))
+        if not blob:
+            return None
+        try:
+            return decompress(blob)
+        except Exception:
+            logging.exception("LLMCache.get got a broken entry")
+            return None
+
+    def set(self, ns, llmnm, txt, v, history, genconf):
+        if not LLM_CACHE_ENABLED or not v:
+            return
+        k = self.key(ns, llmnm, txt, history, genconf)
+        blob = compress(v)
+        ttl, max_bytes = self.config(ns)
+        evicted = 0
+        if self.disk:
+            try:
+                evicted += self.disk.set(ns, k, blob, ttl, max_bytes)
+            except Exception:
+                logging.exception("LLMCache disk tier set got exception")
+        try:
+            redis = REDIS_CONN.REDIS_BIN
+            lru, nbytes = self._lru_key(ns), self._bytes_key(ns)
+            pipe = redis.pipeline(transaction=False)
+            pipe.set(k, blob, ex=ttl, get=True)
+            pipe.zadd(lru, {f"{k}|{len(blob)}": time.time()})
+            pipe.hincrby(self._stats_key(ns), "writes", 1)
+            pipe.hincrby(self._stats_key(ns), "bytes_written", len(blob))
+            old, added = pipe.execute()[:2]
+            # Only count bytes an entry did not account for already: rewriting the same entry adds
+            # no member, and an entry rewritten with another size replaces its old member.
+            delta = len(blob) if added else 0
+            if old is not None and len(old) != len(blob) and redis.zrem(lru, f"{k}|{len(old)}"):
+                delta -= len(old)
+            total = redis.incrby(nbytes, delta) if delta else int(redis.get(nbytes) or 0)
+            if max_bytes and total > max_bytes:
+                evicted += self._evict(ns, ttl, max_bytes)
+            if evicted:
+                redis.hincrby(self._stats_key(ns), "evictions", evicted)
+        except Exception as e:
+            logging.warning("LLMCache.set got exception: " + str(e))
+
+    def _evict(self, ns, ttl, max_bytes):
+        """Forget the entries expired meanwhile, then drop the least recently used until 90% of max_bytes."""
+        redis = REDIS_CONN.REDIS_BIN
+        lru, nbytes = self._lru_key(ns), self._bytes_key(ns)
+        members = redis.zrangebyscore(lru, 0, time.time() - ttl)
+        freed = 0
+        if members:
+            pipe = redis.pipeline(transaction=False)
+            for m in members:
+                pipe.zrem(lru, m)
+            for m, removed in zip(members, pipe.execute()):
+                if removed:
+                    freed += int(m.rsplit(b"|", 1)[1])
+        total = redis.decrby(nbytes, freed) if freed else int(redis.get(nbytes) or 0)
+
+        evicted = 0
+        while total > max_bytes * 0.9:
+            oldest = redis.zrange(lru, 0, 31)
+            if not oldest:
+                redis.set(nbytes, 0)
+                break
+            # Drop just enough of the oldest entries, a concurrent eviction may have removed some already.
+            drop, left = [], total
+            for m in oldest:
+                if left <= max_bytes * 0.9:
+                    break
+                drop.append(m)
+                left -= int(m.rsplit(b"|", 1)[1])
+            pipe = redis.pipeline(transaction=False)
+            for m in drop:
+                pipe.zrem(lru, m)
+            removed = [m for m, ok in zip(drop, pipe.execute()) if ok]
+            if removed:
+                redis.delete(*[m.rsplit(b"|", 1)[0] for m in removed])
+                total = redis.decrby(nbytes, sum(int(m.rsplit(b"|", 1)[1]) for m in removed))
+            else:
+                total = int(redis.get(nbytes) or 0)
+            evicted += len(removed)
+        if evicted:
+            logging.info(f"LLMCache evicted {evicted} entries of namespace {ns}, {total} bytes left")
+        return evicted
+
+    def stats(self):
+        res = {}
+        try:
+            redis = REDIS_CONN.REDIS_BIN
+            namespaces = set(self.namespaces.keys()) | set(self.disk_hits.keys())
+            for k in redis.scan_iter(match="llmcache_stats:*", count=100):
+                namespaces.add(k.decode("utf-8").split(":", 1)[1])
+            for ns in sorted(namespaces):
+                counters = {k.decode("utf-8"): int(v) for k, v in redis.hgetall(self._stats_key(ns)).items()}
+                hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+                ttl, max_bytes = self.config(ns)
+                res[ns] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+                    "disk_hits": self.disk_hits.get(ns, 0),
+                    "bytes_read": counters.get("bytes_read", 0),
+                    "bytes_written": counters.get("bytes_written", 0),
+                    "writes": counters.get("writes", 0),
+                    "evictions": counters.get("evictions", 0),
+                    "bytes": int(redis.get(self._bytes_key(ns)) or 0),
+                    "entries": redis.zcard(self._lru_key(ns)),
+                    "ttl": ttl,
+                    "max_bytes": max_bytes,
+                }
+        except Exception as e:
+            logging.warning("LLMCache.stats got exception: " + str(e))
+        return res
+
+
+LLM_CACHE = LLMCache()
@@ -0,0 +1,111 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import logging
+import os
+
+import numpy as np
+
+
+class MmapDict:
+    """
+    Read-only str -> int/str mapping backed by memory-mapped .npy files: sorted fixed-width UTF-8 keys,
+    their values and, for string values, a label table. Every process on the host mapping the same
+    artifact shares its physical pages instead of holding a private dict.
+    """
+
+    def __init__(self, base):
+        self.keys = np.load(base + ".keys.npy", mmap_mode="r")
+        self.vals = np.load(base + ".vals.npy", mmap_mode="r")
+        self.labels = None
+        if os.path.exists(base + ".labels.json"):
+            with open(base + ".labels.json", "r", encoding="utf-8") as f:
+                self.labels = json.load(f)
+
+    @staticmethod
+    def compile(mapping: dict, base):
+        """Write `mapping` as the artifact at `base`, atomically so that concurrent builders don't clash."""
+        items = sorted((k.encode("utf-8"), v) for k, v in mapping.items())
+        keys = np.array([k for k, _ in items] or [b""], dtype=bytes)[:len(items)]
+        labels = None
+        if all(isinstance(v, int) for _, v in items):
+            vals = np.array([v for _, v in items], dtype=np.int64)
+        else:
+            labels = sorted(set(str(v) for _, v in items))
+            codes = {lb: i for i, lb in enumerate(labels)}
+            vals = np.array([codes[str(v)] for _, v in items], dtype=np.int32)
+
+        tmp = f"{base}.{os.getpid()}.tmp"
+        for suffix, arr in ((".keys.npy", keys), (".vals.npy", vals)):
+            with open(tmp, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, base + suffix)
+        if labels is not None:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(labels, f, ensure_ascii=False)
+            os.replace(tmp, base + ".labels.json")
+        elif os.path.exists(base + ".labels.json"):
+            os.remove(base + ".labels.json")
+
+    @classmethod
+    def load(cls, src, base, parse):
+        """
+        Open the artifact at `base`, (re)building it with `parse(src)` when it is missing or older than `src`.
+        Falls back to the parsed object itself when it isn't a dict or the artifact can't be written.
+        """
+        try:
+            if not os.path.exists(base + ".vals.npy") or os.path.getmtime(base + ".vals.npy") < os.path.getmtime(src):
+                parsed = parse(src)
+                if not isinstance(parsed, dict):
+                    return parsed
+                logging.info(f"Compile {src} to {base}")
+                os.makedirs(os.path.dirname(base), exist_ok=True)
+                cls.compile(parsed, base)
+            return cls(base)
+        except OSError:
+            logging.exception(f"Fail to use the memory-mapped artifact of {src}")
+            return parse(src)
+
+    def _index(self, k):
+        if not isinstance(k, str):
+            return -1
+        kb = k.encode("utf-8")
+        if not kb or len(kb) > self.keys.dtype.itemsize:
+            return -1
+        i = int(np.searchsorted(self.keys, kb))
+        if i < len(self.keys) and self.keys[i] == kb:
+            return i
+        return -1
+
+    def _value(self, i):
+        v = self.vals[i]
+        return self.labels[v] if self.labels is not None else int(v)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, k):
+        return self._index(k) >= 0
+
+    def __getitem__(self, k):
+        i = self._index(k)
+        if i < 0:
+            raise KeyError(k)
+        return self._value(i)
+
+    def get(self, k, default=None):
+        i = self._index(k)
+        return default if i < 0 else self._value(i)
@@ -31,6 +31,7 @@ from api.utils.file_utils import get_project_base_directory
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
     FusionExpr
 from rag.nlp import is_english, rag_tokenizer
+from rag.utils.retrieval_cache import bumps_kb_version
 
 ATTEMPT_TIME = 2
 
@@ -128,7 +129,7 @@ class OSConnection(DocStoreConnection):
     CRUD operations
     """
 
-    def search(
+    def _build_search(
             self, selectFields: list[str],
             highlightFields: list[str],
             condition: dict,
@@ -142,6 +143,7 @@ class OSConnection(DocStoreConnection):
             rank_feature: dict | None = None
     ):
         """
+        Build the request body of a search.
         Refers to https://github.com/opensearch-project/opensearch-py/blob/main/guides/dsl.md
         """
         use_knn = False
@@ -244,7 +246,23 @@ class OSConnection(DocStoreConnection):
         if use_knn:
             del q["query"]
             q["query"] = {"knn" : knn_query}
+        return indexNames, q
 
+    def search(
+            self, selectFields: list[str],
+            highlightFields: list[str],
+            condition: dict,
+            matchExprs: list[MatchExpr],
+            orderBy: OrderByExpr,
+            offset: int,
+            limit: int,
+            indexNames: str | list[str],
+            knowledgebaseIds: list[str],
+            aggFields: list[str] = [],
+            rank_feature: dict | None = None
+    ):
+        indexNames, q = self._build_search(selectFields, highlightFields, condition, matchExprs, orderBy, offset, limit,
+                                           indexNames, knowledgebaseIds, aggFields, rank_feature)
         for i in range(ATTEMPT_TIME):
             try:
                 res = self.os.search(index=indexNames,
@@ -265,6 +283,69 @@ class OSConnection(DocStoreConnection):
         logger.error("OSConnection.search timeout for 3 times!")
         raise Exception("OSConnection.search timeout.")
 
+    def search_many(self, searches: list[dict]) -> list:
+        """
+        Run several searches in one _msearch round-trip.
+        Refers to https://opensearch.org/docs/latest/api-reference/multi-search/
+        """
+        if len(searches) < 2:
+            return [self.search(**kwargs) for kwargs in searches]
+        body = []
+        for kwargs in searches:
+            indexNames, q = self._build_search(**kwargs)
+            q["track_total_hits"] = True
+            q["timeout"] = "600s"
+            body.append({"index": ",".join(indexNames)})
+            body.append(q)
+
+        for i in range(ATTEMPT_TIME):
+            try:
+                res = self.os.msearch(body=body)
+                break
+            except Exception as e:
+                logger.exception("OSConnection.search_many got exception")
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        else:
+            logger.error("OSConnection.search_many timeout for 3 times!")
+            raise Exception("OSConnection.search_many timeout.")
+
+        results = []
+        for kwargs, r in zip(searches, res["responses"]):
+            if "error" in r or str(r.get("timed_out", "")).lower() == "true":
+                logger.warning(f"OSConnection.search_many falls back to a single search: {r.get('error', 'timeout')}")
+                r = self.search(**kwargs)
+            results.append(r)
+        return results
+
+    def scan(self, selectFields: list[str], condition: dict, indexNames: str | list[str], knowledgebaseIds: list[str],
+             batchSize: int = 1024):
+        """
+        Page with a scroll rather than offsets, which stop at max_result_window (10000 by default).
+        Refers to https://opensearch.org/docs/latest/api-reference/scroll/
+        """
+        indexNames, q = self._build_search(selectFields, [], condition, [], OrderByExpr(), 0, batchSize,
+                                           indexNames, knowledgebaseIds)
+        q["sort"] = ["_doc"]
+        res = self.os.search(index=indexNames, body=q, scroll="5m", _source=True)
+        scroll_id = res.get("_scroll_id")
+        try:
+            while True:
+                rows = self.getFields(res, selectFields)
+                if rows:
+                    yield rows
+                if len(res["hits"]["hits"]) < batchSize or not scroll_id:
+                    break
+                res = self.os.scroll(scroll_id=scroll_id, scroll="5m")
+                scroll_id = res.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.os.clear_scroll(scroll_id=scroll_id)
+                except Exception as e:
+                    logger.warning("OSConnection.scan clear_scroll got exception: " + str(e))
+
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         for i in range(ATTEMPT_TIME):
             try:
@@ -285,7 +366,8 @@ class OSConnection(DocStoreConnection):
         logger.error("OSConnection.get timeout for 3 times!")
         raise Exception("OSConnection.get timeout.")
 
-    def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
+    @staticmethod
+    def _bulk_operations(documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[dict]:
         # Refers to https://opensearch.org/docs/latest/api-reference/document-apis/bulk/
         operations = []
         for d in documents:
@@ -296,6 +378,11 @@ class OSConnection(DocStoreConnection):
             operations.append(
                 {"index": {"_index": indexName, "_id": meta_id}})
             operations.append(d_copy)
+        return operations
+
+    @bumps_kb_version
+    def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
+        operations = self._bulk_operations(documents, indexName, knowledgebaseId)
 
         res = []
         for _ in range(ATTEMPT_TIME):
@@ -321,6 +408,22 @@ class OSConnection(DocStoreConnection):
                     continue
         return res
 
+    @bumps_kb_version
+    def bulk_insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> dict[str, tuple[str, bool]]:
+        r = self.os.bulk(index=(indexName), body=self._bulk_operations(documents, indexName, knowledgebaseId),
+                         refresh=False, timeout=60)
+        if not r["errors"]:
+            return {}
+        errors = {}
+        for item in r["items"]:
+            for action in ["create", "delete", "index", "update"]:
+                if action in item and "error" in item[action]:
+                    # Rejections because of load are worth retrying, mapping errors and the like aren't.
+                    status = item[action].get("status", 500)
+                    errors[str(item[action]["_id"])] = (str(item[action]["error"]), status == 429 or status >= 500)
+        return errors
+
+    @bumps_kb_version
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -347,6 +450,10 @@ class OSConnection(DocStoreConnection):
             if k == "exists":
                 bqry.filter.append(Q("exists", field=v))
                 continue
+            if k == "id":
+                # chunk ids are the document _id, not a field of the source
+                bqry.filter.append(Q("ids", values=v))
+                continue
             if isinstance(v, list):
                 bqry.filter.append(Q("terms", **{k: v}))
             elif isinstance(v, str) or isinstance(v, int):
@@ -404,6 +511,7 @@ class OSConnection(DocStoreConnection):
                 break
         return False
 
+    @bumps_kb_version
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
@@ -16,30 +16,39 @@
 
 import logging
 import json
+import threading
 import uuid
 import time
 
 import valkey as redis
 from rag import settings
 from rag.utils import singleton
+from valkey.exceptions import LockError
 from valkey.lock import Lock
 import trio
 
+# Read/write timeout of the Redis clients; blocking commands must return well before it.
+REDIS_SOCKET_TIMEOUT = 5
+
+
 class RedisConnectionError(Exception):
     """Redis连接异常"""
     pass
 
 class RedisMsg:
-    def __init__(self, consumer, queue_name, group_name, msg_id, message):
+    def __init__(self, consumer, queue_name, group_name, msg_id, message, on_ack=None):
         self.__consumer = consumer
         self.__queue_name = queue_name
         self.__group_name = group_name
         self.__msg_id = msg_id
         self.__message = json.loads(message["message"])
+        self.__on_ack = on_ack
 
     def ack(self):
         try:
             self.__consumer.xack(self.__queue_name, self.__group_name, self.__msg_id)
+            if self.__on_ack:
+                self.__on_ack(self)
             return True
         except Exception as e:
             logging.warning("[EXCEPTION]ack" + str(self.__queue_name) + "||" + str(e))
@@ -51,6 +60,9 @@ class RedisMsg:
     def get_msg_id(self):
         return self.__msg_id
 
+    def get_queue_name(self):
+        return self.__queue_name
+
 
 @singleton
 class RedisDB:
@@ -66,6 +78,7 @@ class RedisDB:
 
     def __init__(self):
         self.REDIS = None
+        self.REDIS_BIN = None
         self.config = settings.REDIS
         print('--------settings.REDIS---------')
         print(self.config)
@@ -109,11 +122,24 @@ class RedisDB:
                     password=password,
                     decode_responses=True,
                     socket_connect_timeout=5,  # 连接超时
-                    socket_timeout=5,          # 读写超时
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,  # 读写超时
                     retry_on_timeout=True,     # 超时重试
                     health_check_interval=30   # 健康检查间隔
                 )
                 
+                # 二进制值（如向量缓存）使用不解码响应的独立连接
+                self.REDIS_BIN = redis.StrictRedis(
+                    host=host,
+                    port=port,
+                    db=db,
+                    password=password,
+                    decode_responses=False,
+                    socket_connect_timeout=5,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    retry_on_timeout=True,
+                    health_check_interval=30
+                )
+
                 # 测试连接
                 self.REDIS.ping()
                 logging.info("Redis connection established successfully")
@@ -186,6 +212,48 @@ class RedisDB:
             self.__open__()
         return False
 
+    def mget(self, keys: list[str]) -> list[str | None]:
+        if not self.REDIS or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def incr(self, key: str):
+        try:
+            return self.REDIS.incr(key)
+        except Exception as e:
+            logging.warning("RedisDB.incr " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def mget_bin(self, keys: list[str]) -> list[bytes | None]:
+        if not self.REDIS_BIN or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS_BIN.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget_bin got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset_bin(self, mapping: dict[str, bytes], exp=3600):
+        if not self.REDIS_BIN or not mapping:
+            return False
+        try:
+            pipeline = self.REDIS_BIN.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset_bin got exception: " + str(e))
+            self.__open__()
+        return False
+
     def sadd(self, key: str, member: str):
         try:
             self.REDIS.sadd(key, member)
@@ -253,6 +321,26 @@ class RedisDB:
             self.__open__()
         return None
 
+    def publish(self, channel: str, message: str):
+        try:
+            self.REDIS.publish(channel, message)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.publish " + str(channel) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def subscribe(self, channel: str):
+        """A PubSub subscribed to `channel`, or None if Redis can't be reached."""
+        try:
+            pubsub = self.REDIS.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+            return pubsub
+        except Exception as e:
+            logging.warning("RedisDB.subscribe " + str(channel) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
     def transaction(self, key, value, exp=3600):
         try:
             pipeline = self.REDIS.pipeline(transaction=True)
@@ -312,32 +400,6 @@ class RedisDB:
                 )
         return None
 
-    def get_unacked_iterator(self, queue_names: list[str], group_name, consumer_name):
-        try:
-            for queue_name in queue_names:
-                try:
-                    group_info = self.REDIS.xinfo_groups(queue_name)
-                except Exception as e:
-                    if str(e) == 'no such key':
-                        logging.warning(f"RedisDB.get_unacked_iterator queue {queue_name} doesn't exist")
-                        continue
-                if not any(gi["name"] == group_name for gi in group_info):
-                    logging.warning(f"RedisDB.get_unacked_iterator queue {queue_name} group {group_name} doesn't exist")
-                    continue
-                current_min = 0
-                while True:
-                    payload = self.queue_consumer(queue_name, group_name, consumer_name, current_min)
-                    if not payload:
-                        break
-                    current_min = payload.get_msg_id()
-                    logging.info(f"RedisDB.get_unacked_iterator {queue_name} {consumer_name} {current_min}")
-                    yield payload
-        except Exception:
-            logging.exception(
-                "RedisDB.get_unacked_iterator got exception: "
-            )
-            self.__open__()
-
     def get_pending_msg(self, queue, group_name):
         try:
             messages = self.REDIS.xpending_range(queue, group_name, '-', '+', 10)
@@ -392,6 +454,161 @@ class RedisDB:
 REDIS_CONN = RedisDB()
 
 
+class RedisQueueConsumer:
+    """
+    Consumer of a group over several streams, in priority order. Groups are created once, the streams are
+    read one after the other for as many messages as asked for, which are buffered until taken, and a
+    blocking XREADGROUP over every stream waits when none is queued. Messages left pending by consumers
+    that stopped are taken over with XAUTOCLAIM: a live consumer keeps resetting the idle time of the
+    messages it holds with `touch`, so only those of the dead ones stay idle longer than `claim_idle_ms`.
+    """
+
+    def __init__(self, queue_names: list[str], group_name: str, consumer_name: str,
+                 block_ms=settings.QUEUE_BLOCK_MS, claim_idle_ms=settings.QUEUE_CLAIM_IDLE_MS):
+        self.queue_names = queue_names
+        self.group_name = group_name
+        self.consumer_name = consumer_name
+        # A blocking read outlasting the socket timeout would fail and reconnect instead of returning empty.
+        max_block_ms = (REDIS_SOCKET_TIMEOUT - 1) * 1000
+        if block_ms > max_block_ms:
+            logging.warning(f"RedisQueueConsumer block_ms {block_ms} exceeds the Redis socket timeout, using {max_block_ms}")
+            block_ms = max_block_ms
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self._groups_ready = False
+        # Own pending messages, left by a previous run under the same name, are read first, `count` at
+        # a time from the last id read of each stream, until none is left.
+        self._own_pending = {q: "0" for q in queue_names}
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._held = {}
+
+    @property
+    def redis(self):
+        return REDIS_CONN.REDIS
+
+    def _ensure_groups(self):
+        if self._groups_ready:
+            return
+        for queue_name in self.queue_names:
+            try:
+                self.redis.xgroup_create(queue_name, self.group_name, id="0", mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._groups_ready = True
+
+    def _released(self, msg: RedisMsg):
+        with self._lock:
+            self._held.pop(msg.get_msg_id(), None)
+
+    def _wrap(self, queue_name, msg_id, payload):
+        if not payload:
+            # Deleted from the stream meanwhile.
+            self.redis.xack(queue_name, self.group_name, msg_id)
+            return None
+        msg = RedisMsg(self.redis, queue_name, self.group_name, msg_id, payload, on_ack=self._released)
+        with self._lock:
+            self._held[msg_id] = queue_name
+        return msg
+
+    def _read(self, count, streams, block, last_ids=None):
+        messages = self.redis.xreadgroup(self.group_name, self.consumer_name, streams, count=count, block=block)
+        res = {}
+        for stream, element_list in messages or []:
+            res[stream] = [m for m in (self._wrap(stream, msg_id, payload) for msg_id, payload in element_list) if m]
+            if last_ids is not None and element_list:
+                last_ids[stream] = element_list[-1][0]
+        # Higher priority streams first.
+        return [m for q in self.queue_names for m in res.get(q, [])]
+
+    def _read_own_pending(self, count):
+        msgs = []
+        for queue_name, last_id in list(self._own_pending.items()):
+            if len(msgs) >= count:
+                break
+            last_ids = {}
+            msgs.extend(self._read(count - len(msgs), {queue_name: last_id}, None, last_ids))
+            # A stream without more pending messages is done; the others go on from their last id.
+            if queue_name in last_ids:
+                self._own_pending[queue_name] = last_ids[queue_name]
+            else:
+                del self._own_pending[queue_name]
+        return msgs
+
+    def fetch(self, count=1) -> RedisMsg | None:
+        """
+        The next message, waiting up to block_ms for one. Up to `count` messages in all are fetched at once:
+        XREADGROUP's COUNT applies to each stream, so the streams are read one at a time with what is left.
+        Errors are raised, after reconnecting, for the caller to back off.
+        """
+        count = max(1, count)
+        try:
+            self._ensure_groups()
+            while not self._buffer and self._own_pending:
+                self._extend(self._read_own_pending(count))
+            for queue_name in self.queue_names:
+                left = count - self.fetched()
+                if left <= 0:
+                    break
+                self._extend(self._read(left, {queue_name: ">"}, None))
+            if not self._buffer:
+                # Nothing queued: wait on every stream. A blocked read is served by the stream which woke it up.
+                self._extend(self._read(1, {q: ">" for q in self.queue_names}, self.block_ms))
+        except Exception as e:
+            logging.warning("RedisQueueConsumer.fetch got exception: " + str(e))
+            self._groups_ready = False
+            REDIS_CONN.__open__()
+            raise
+        with self._lock:
+            return self._buffer.pop(0) if self._buffer else None
+
+    def fetched(self) -> int:
+        """Number of messages fetched and not taken yet."""
+        with self._lock:
+            return len(self._buffer)
+
+    def _extend(self, msgs):
+        with self._lock:
+            self._buffer.extend(msgs)
+
+    def touch(self):
+        """Reset the idle time of the messages taken and not acknowledged yet, so nobody claims them."""
+        by_queue = {}
+        with self._lock:
+            held = list(self._held.items())
+        for msg_id, queue_name in held:
+            by_queue.setdefault(queue_name, []).append(msg_id)
+        for queue_name, msg_ids in by_queue.items():
+            try:
+                self.redis.xclaim(queue_name, self.group_name, self.consumer_name, 0, msg_ids, justid=True)
+            except Exception as e:
+                logging.warning("RedisQueueConsumer.touch " + str(queue_name) + " got exception: " + str(e))
+
+    def claim_stale(self, count=1) -> int:
+        """Take over up to `count` messages idle for claim_idle_ms, buffered like fetched ones."""
+        claimed = 0
+        try:
+            self._ensure_groups()
+            for queue_name in self.queue_names:
+                start = "0-0"
+                while claimed < count:
+                    res = self.redis.xautoclaim(queue_name, self.group_name, self.consumer_name, self.claim_idle_ms,
+                                                start_id=start, count=count - claimed)
+                    start, messages = res[0], res[1]
+                    for msg_id, payload in messages:
+                        msg = self._wrap(queue_name, msg_id, payload)
+                        if msg:
+                            logging.info(f"RedisQueueConsumer claimed {queue_name} {msg_id}")
+                            self._extend([msg])
+                            claimed += 1
+                    if start in ("0-0", b"0-0"):
+                        break
+        except Exception as e:
+            logging.warning("RedisQueueConsumer.claim_stale got exception: " + str(e))
+        return claimed
+
+
 class RedisDistributedLock:
     def __init__(self, lock_key, lock_value=None, timeout=10, blocking_timeout=1):
         self.lock_key = lock_key
@@ -402,9 +619,28 @@ class RedisDistributedLock:
         self.timeout = timeout
         self.lock = Lock(REDIS_CONN.REDIS, lock_key, timeout=timeout, blocking_timeout=blocking_timeout)
 
-    def acquire(self):
+    def acquire(self, blocking=None):
         REDIS_CONN.delete_if_equal(self.lock_key, self.lock_value)
-        return self.lock.acquire(token=self.lock_value)
+        return self.lock.acquire(token=self.lock_value, blocking=blocking)
+
+    def extend(self):
+        """Reset the expiry of the lock to its full timeout. False if it is not held anymore, None if Redis failed."""
+        try:
+            return self.lock.extend(self.timeout, replace_ttl=True)
+        except LockError as e:
+            logging.warning(f"RedisDistributedLock.extend {self.lock_key} got exception: {e}")
+            return False
+        except Exception as e:
+            logging.warning(f"RedisDistributedLock.extend {self.lock_key} got exception: {e}")
+            return None
+
+    async def keep_alive(self, interval=None):
+        """Extend the lock every `interval` seconds (a third of its timeout by default) until cancelled."""
+        interval = interval or self.timeout / 3
+        while True:
+            await trio.sleep(interval)
+            if self.extend() is False:
+                raise Exception(f"Lost the lock {self.lock_key}")
 
     async def spin_acquire(self):
         REDIS_CONN.delete_if_equal(self.lock_key, self.lock_value)
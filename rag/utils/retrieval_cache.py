@@ -0,0 +1,147 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+
+import numpy as np
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+
+RETRIEVAL_CACHE_ENABLED = int(os.environ.get("RETRIEVAL_CACHE_ENABLED", "1"))
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", 600))
+# Seconds a write takes to become searchable (ES/OpenSearch refresh_interval defaults to 1s).
+# Retrieval results of a knowledge base written within this window are neither served nor stored.
+RETRIEVAL_CACHE_REFRESH_WINDOW = int(os.environ.get("RETRIEVAL_CACHE_REFRESH_WINDOW", 2))
+
+
+def kb_version_key(kb_id):
+    return f"kb_version:{kb_id}"
+
+
+def kb_written_key(kb_id):
+    return f"kb_written:{kb_id}"
+
+
+def get_kb_versions(kb_ids: list[str]) -> list[int] | None:
+    """
+    Versions of the knowledge bases, or None if any of them was written within the refresh window:
+    a search may not see that write yet, and caching its result under the new version would serve
+    stale chunks until the TTL expires.
+    """
+    if not kb_ids:
+        return []
+    values = REDIS_CONN.mget([kb_version_key(kb_id) for kb_id in kb_ids] + [kb_written_key(kb_id) for kb_id in kb_ids])
+    if any(values[len(kb_ids):]):
+        return None
+    return [int(v) if v else 0 for v in values[:len(kb_ids)]]
+
+
+def bump_kb_version(kb_id):
+    if not kb_id:
+        return
+    for k in (kb_id if isinstance(kb_id, list) else [kb_id]):
+        REDIS_CONN.incr(kb_version_key(k))
+        if RETRIEVAL_CACHE_REFRESH_WINDOW > 0:
+            REDIS_CONN.set(kb_written_key(k), 1, RETRIEVAL_CACHE_REFRESH_WINDOW)
+
+
+def bumps_kb_version(func):
+    """
+    Decorate a DocStoreConnection write so that the version of the affected knowledge base is bumped
+    once the write finished, whatever its outcome. Cached retrieval results of that knowledge base become stale,
+    and none is cached again until the write is searchable.
+    """
+    sig = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            try:
+                bump_kb_version(sig.bind(*args, **kwargs).arguments.get("knowledgebaseId"))
+            except Exception:
+                logging.exception("bump_kb_version got exception")
+    return wrapper
+
+
+def _json_default(o):
+    if isinstance(o, np.integer):
+        return int(o)
+    if isinstance(o, np.floating):
+        return float(o)
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class RetrievalCache:
+    """
+    Cache of Dealer.retrieval results in Redis.
+    The key covers the normalized question, the retrieval settings and the current version of every
+    knowledge base involved, so any chunk insert/update/delete of those knowledge bases invalidates it.
+    While a write is not yet searchable, `key` returns None and the retrieval bypasses the cache.
+    """
+
+    def __init__(self, ttl=RETRIEVAL_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(question):
+        return re.sub(r"\s+", " ", question).strip().lower()
+
+    def key(self, question, kb_ids, **settings):
+        kb_ids = sorted(kb_ids or [])
+        versions = get_kb_versions(kb_ids)
+        if versions is None:
+            return None
+        hasher = xxhash.xxh128()
+        hasher.update(self.normalize(question).encode("utf-8"))
+        hasher.update(json.dumps(kb_ids).encode("utf-8"))
+        hasher.update(json.dumps(versions).encode("utf-8"))
+        hasher.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        return "retrieval:" + hasher.hexdigest()
+
+    def get(self, key):
+        v = REDIS_CONN.get(key)
+        if not v:
+            self.misses += 1
+            return None
+        try:
+            res = json.loads(v)
+        except Exception:
+            logging.exception("RetrievalCache.get got a broken entry")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return res
+
+    def set(self, key, ranks):
+        REDIS_CONN.set(key, json.dumps(ranks, ensure_ascii=False, default=_json_default), self.ttl)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / total if total else 0.0}
+
+
+RETRIEVAL_CACHE = RetrievalCache()
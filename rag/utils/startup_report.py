@@ -0,0 +1,46 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import time
+from contextlib import contextmanager
+
+PROCESS_START = time.time()
+RESOURCE_LOAD_TIMES = {}
+
+
+@contextmanager
+def timed_load(name):
+    """Record how long loading the resource `name` took, for the startup report."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        RESOURCE_LOAD_TIMES[name] = RESOURCE_LOAD_TIMES.get(name, 0) + elapsed
+        logging.info(f"Loaded {name} in {elapsed:.2f}s")
+
+
+def startup_report():
+    return {
+        "uptime": round(time.time() - PROCESS_START, 2),
+        "resources": {k: round(v, 3) for k, v in RESOURCE_LOAD_TIMES.items()},
+    }
+
+
+def log_startup_report(what):
+    report = startup_report()
+    logging.info(f"{what} started in {report['uptime']:.2f}s, resources loaded so far: "
+                 + (", ".join(f"{k} {v:.2f}s" for k, v in report["resources"].items()) or "none (lazy)"))
@@ -0,0 +1,83 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    """In-memory Redis behind REDIS_CONN, with a decoded and a binary client like the real one."""
+    from rag.utils.redis_conn import REDIS_CONN
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(REDIS_CONN, "REDIS", fakeredis.FakeRedis(server=server, decode_responses=True))
+    monkeypatch.setattr(REDIS_CONN, "REDIS_BIN", fakeredis.FakeRedis(server=server))
+    return REDIS_CONN
+
+
+class FakeChunkStore:
+    """Chunks of knowledge bases in memory, with the DocStoreConnection calls of the chunk lifecycle."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def _match(self, id, row, condition, kb_id):
+        if row["kb_id"] != kb_id:
+            return False
+        for k, v in condition.items():
+            vals = v if isinstance(v, list) else [v]
+            got = id if k == "id" else row.get(k)
+            if got not in vals:
+                return False
+        return True
+
+    def indexExist(self, indexName, knowledgebaseId):
+        return True
+
+    def insert(self, rows, indexName, knowledgebaseId=None):
+        for row in rows:
+            row = dict(row, kb_id=knowledgebaseId)
+            self.rows[row.pop("id")] = row
+        return []
+
+    def update(self, condition, newValue, indexName, knowledgebaseId):
+        for id, row in self.rows.items():
+            if self._match(id, row, condition, knowledgebaseId):
+                row.update(newValue)
+        return True
+
+    def delete(self, condition, indexName, knowledgebaseId):
+        ids = [id for id, row in self.rows.items() if self._match(id, row, condition, knowledgebaseId)]
+        for id in ids:
+            del self.rows[id]
+        return len(ids)
+
+    def scan(self, selectFields, condition, indexNames, knowledgebaseIds, batchSize=1024):
+        ids = sorted(id for id, row in self.rows.items()
+                     if any(self._match(id, row, condition, kb_id) for kb_id in knowledgebaseIds))
+        for i in range(0, len(ids), 2):
+            yield {id: {f: self.rows[id][f] for f in selectFields if f in self.rows[id]} for id in ids[i:i + 2]}
+
+
+@pytest.fixture
+def chunk_store(monkeypatch):
+    """A FakeChunkStore as the doc store of the API and the task executors."""
+    from api import settings
+
+    store = FakeChunkStore()
+    monkeypatch.setattr(settings, "docStoreConn", store, raising=False)
+    return store
@@ -0,0 +1,81 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from rag.utils import doc_store_conn
+from rag.utils.doc_store_conn import BulkWriter, DocStoreConnection
+
+
+class FakeConn(DocStoreConnection):
+    """bulk_insert failing the rows given in `failures`, one {id: (error, retryable)} dict or exception per call."""
+
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.calls = []
+
+    def bulk_insert(self, rows, indexName, knowledgebaseId=None):
+        self.calls.append([row["id"] for row in rows])
+        failure = self.failures.pop(0) if self.failures else {}
+        if isinstance(failure, Exception):
+            raise failure
+        return {i: e for i, e in failure.items() if i in self.calls[-1]}
+
+
+# Only bulk_insert is used by the writer.
+FakeConn.__abstractmethods__ = frozenset()
+
+
+def _rows(*ids):
+    return [{"id": i, "content_with_weight": i} for i in ids]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(doc_store_conn.time, "sleep", lambda _: None)
+
+
+class TestBulkWriter:
+    def test_retries_only_the_retryable_failed_rows(self):
+        conn = FakeConn({"b": ("rejected", True), "c": ("mapper_parsing_exception", False)})
+        with BulkWriter(conn, "idx", "kb", max_retries=2) as writer:
+            errors = writer.write(_rows("a", "b", "c"))
+        assert conn.calls == [["a", "b", "c"], ["b"]]
+        assert errors == ["c:mapper_parsing_exception"]
+
+    def test_gives_up_after_max_retries(self):
+        conn = FakeConn(*[{"b": ("rejected", True)}] * 5)
+        with BulkWriter(conn, "idx", "kb", max_retries=2) as writer:
+            writer.extend(_rows("a", "b"))
+            written, errors = writer.flush()
+        assert conn.calls == [["a", "b"], ["b"], ["b"]]
+        assert [row["id"] for row in written] == ["a"]
+        assert errors == ["b:rejected"]
+
+    def test_exception_retries_the_whole_bulk(self):
+        conn = FakeConn(ConnectionError("reset by peer"))
+        with BulkWriter(conn, "idx", "kb", max_retries=1) as writer:
+            writer.extend(_rows("a", "b"))
+            written, errors = writer.flush()
+        assert conn.calls == [["a", "b"], ["a", "b"]]
+        assert [row["id"] for row in written] == ["a", "b"] and errors == []
+
+    def test_bulks_are_cut_by_size_and_count(self):
+        conn = FakeConn()
+        with BulkWriter(conn, "idx", "kb", max_bytes=120, max_rows=2, max_inflight=1) as writer:
+            writer.extend(_rows("a", "b", "c") + [{"id": "d", "content_with_weight": "x" * 200}] + _rows("e"))
+            written, errors = writer.flush()
+        assert conn.calls == [["a", "b"], ["c"], ["d"], ["e"]]
+        assert sorted(row["id"] for row in written) == ["a", "b", "c", "d", "e"] and errors == []
@@ -0,0 +1,65 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+from types import SimpleNamespace
+
+# api.settings imports graphrag.search, which imports graphrag.utils back: load it first.
+from api import settings  # noqa: F401
+from api.db.services import document_service
+from api.db.services.document_service import (clear_chunks_for_reparse, drop_stale_chunks, keep_chunks_for_reuse,
+                                              reusable_chunks_key)
+
+
+def _chunk(content, doc_id="doc1", kb_id="kb", **fields):
+    return {"doc_id": doc_id, "kb_id": kb_id, "content_with_weight": content, **fields}
+
+
+def _available(store):
+    return sorted(id for id, row in store.rows.items() if row.get("available_int", 1))
+
+
+class TestChunkReuseLifecycle:
+    def test_reparse_hides_chunks_until_the_new_parsing_finishes(self, redis, chunk_store):
+        chunk_store.rows = {"a": _chunk("same"), "b": _chunk("changed"), "c": _chunk("gone"),
+                            "x": _chunk("other document", doc_id="doc2")}
+        clear_chunks_for_reparse("doc1", "tenant", "kb")
+        assert set(json.loads(redis.get(reusable_chunks_key("doc1")))["ids"]) == {"a", "b", "c"}
+        assert _available(chunk_store) == ["x"]
+
+        # The new parsing produces "a" again, with the same id, and "d" instead of "b".
+        chunk_store.insert([{"id": "a", "doc_id": "doc1", "content_with_weight": "same"},
+                            {"id": "d", "doc_id": "doc1", "content_with_weight": "changed, edited"}], "idx", "kb")
+        assert _available(chunk_store) == ["a", "d", "x"]
+
+        drop_stale_chunks("doc1", [SimpleNamespace(chunk_ids="a d")])
+        assert sorted(chunk_store.rows) == ["a", "d", "x"]
+        assert _available(chunk_store) == ["a", "d", "x"]
+        assert redis.get(reusable_chunks_key("doc1")) is None
+
+    def test_unfinished_parsing_leftovers_are_still_dropped(self, redis, chunk_store):
+        chunk_store.rows = {"a": _chunk("a"), "b": _chunk("b")}
+        keep_chunks_for_reuse("doc1", "tenant", "kb", ["a"])
+        # Parsed again before the first re-parse was over: it produced "b" only.
+        keep_chunks_for_reuse("doc1", "tenant", "kb", ["b"])
+        drop_stale_chunks("doc1", [SimpleNamespace(chunk_ids="")])
+        assert chunk_store.rows == {}
+
+    def test_reuse_disabled_deletes_up_front(self, redis, chunk_store, monkeypatch):
+        monkeypatch.setattr(document_service, "CHUNK_REUSE_ENABLED", 0)
+        chunk_store.rows = {"a": _chunk("a"), "x": _chunk("x", doc_id="doc2")}
+        clear_chunks_for_reparse("doc1", "tenant", "kb")
+        assert sorted(chunk_store.rows) == ["x"]
+        assert redis.get(reusable_chunks_key("doc1")) is None
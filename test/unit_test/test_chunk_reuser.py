@@ -0,0 +1,79 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import trio
+
+# api.settings imports graphrag.search, which imports graphrag.utils back: load it first.
+from api import settings  # noqa: F401
+from rag.settings import CHUNK_REUSE_FLD
+from rag.svr.task_executor import ChunkReuser
+
+
+def _task(**kw):
+    task = {"tenant_id": "tenant", "kb_id": "kb", "doc_id": "doc1", "name": "report.pdf", "embd_id": "embd",
+            "llm_id": "llm", "language": "English", "parser_config": {"auto_keywords": 3}, "kb_parser_config": {}}
+    task.update(kw)
+    return task
+
+
+def _stored(store, id, content, task, vector, doc_id="doc1", **fields):
+    store.rows[id] = {"doc_id": doc_id, "kb_id": "kb", "docnm_kwd": task["name"], "content_with_weight": content,
+                      CHUNK_REUSE_FLD: ChunkReuser(task, len(vector)).reuse_hash({"content_with_weight": content}),
+                      "q_%d_vec" % len(vector): vector, **fields}
+
+
+def _run(reuser, docs):
+    return trio.run(reuser, docs)
+
+
+class TestChunkReuser:
+    def test_reparse_copies_unchanged_chunks(self, chunk_store):
+        task = _task()
+        _stored(chunk_store, "a", "same", task, [0.1, 0.2], important_kwd=["kw"])
+        _stored(chunk_store, "b", "changed", task, [0.3, 0.4])
+        reuser = ChunkReuser(task, 2)
+        docs = [{"id": "a", "content_with_weight": "same"}, {"id": "d", "content_with_weight": "changed, edited"}]
+        _run(reuser, docs)
+        assert docs[0]["q_2_vec"] == [0.1, 0.2] and docs[0]["important_kwd"] == ["kw"]
+        assert "q_2_vec" not in docs[1]
+        assert [d["id"] for d in reuser.fresh(docs)] == ["d"]
+        assert [d["id"] for d in reuser.unenriched(docs)] == ["d"]
+        assert all(d[CHUNK_REUSE_FLD] for d in docs)
+
+    def test_new_document_of_an_edited_file(self, chunk_store):
+        # The former version was uploaded as another document: its chunks have other ids.
+        _stored(chunk_store, "old", "same", _task(doc_id="doc0"), [0.1, 0.2], doc_id="doc0", question_kwd=["q?"])
+        docs = [{"id": "new", "content_with_weight": "same"}]
+        reuser = ChunkReuser(_task(), 2)
+        _run(reuser, docs)
+        assert docs[0]["q_2_vec"] == [0.1, 0.2] and docs[0]["question_kwd"] == ["q?"]
+        assert reuser.reused == {"new"}
+
+    def test_other_document_name_reuses_enrichments_only(self, chunk_store):
+        # The document name is mixed into the vector, not into the enrichments.
+        _stored(chunk_store, "old", "same", _task(name="draft.pdf"), [0.1, 0.2], doc_id="doc0", important_kwd=["kw"])
+        docs = [{"id": "new", "content_with_weight": "same"}]
+        reuser = ChunkReuser(_task(), 2)
+        _run(reuser, docs)
+        assert docs[0]["important_kwd"] == ["kw"] and "q_2_vec" not in docs[0]
+        assert reuser.unenriched(docs) == [] and reuser.fresh(docs) == docs
+
+    def test_other_enrichment_settings_reuse_nothing(self, chunk_store):
+        _stored(chunk_store, "a", "same", _task(embd_id="another"), [0.1, 0.2], important_kwd=["kw"])
+        docs = [{"id": "a", "content_with_weight": "same"}]
+        reuser = ChunkReuser(_task(), 2)
+        _run(reuser, docs)
+        assert "important_kwd" not in docs[0] and "q_2_vec" not in docs[0]
+        assert reuser.fresh(docs) == docs
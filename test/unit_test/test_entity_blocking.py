@@ -0,0 +1,48 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import random
+
+from graphrag.entity_blocking import EntityBlocker, blocking_recall, is_similarity, synthetic_graph
+
+
+class TestEntityBlocker:
+    def test_recall_on_a_fixed_graph(self):
+        graph = synthetic_graph(1500)
+        nodes = sorted(graph.nodes())
+        subgraph_nodes = set(random.Random(0).sample(nodes, 150))
+        report = blocking_recall(graph, subgraph_nodes, is_similarity)
+        assert report["variant_pairs"] > 20
+        assert report["variant_recall"] >= 0.95
+        # Far fewer candidates than the pairs involving a subgraph node.
+        assert report["candidates"] < len(subgraph_nodes) * len(nodes) / 10
+
+    def test_candidates_involve_a_subgraph_node(self):
+        names = ["ACME HOLDINGS", "ACME HOLDING", "ACME GROUP", "GLOBEX BANK", "GLOBEX BANKS"]
+        pairs = EntityBlocker().candidates(names, {"ACME HOLDINGS"})
+        assert ("ACME HOLDING", "ACME HOLDINGS") in pairs
+        assert all("ACME HOLDINGS" in p and p[0] < p[1] for p in pairs)
+        assert EntityBlocker().candidates(names, set()) == set()
+
+    def test_common_blocks_are_skipped(self):
+        names = [f"{i} INC" for i in range(50)] + ["ZORBLAX INC"]
+        assert EntityBlocker(max_block=10).candidates(names, {"ZORBLAX INC"}) == set()
+        assert len(EntityBlocker(max_block=100).candidates(names, {"ZORBLAX INC"})) == 50
+
+    def test_embedding_neighbors(self):
+        names = ["IBM", "INTERNATIONAL BUSINESS MACHINES", "GLOBEX BANK"]
+        embeddings = {"IBM": [1.0, 0.0], "INTERNATIONAL BUSINESS MACHINES": [0.99, 0.05], "GLOBEX BANK": [0.0, 1.0]}
+        assert EntityBlocker().candidates(names, {"IBM"}) == set()
+        assert EntityBlocker().candidates(names, {"IBM"}, embeddings) == {("IBM", "INTERNATIONAL BUSINESS MACHINES")}
@@ -0,0 +1,131 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+from types import SimpleNamespace
+
+import networkx as nx
+import pytest
+import trio
+
+# api.settings imports graphrag.search, which imports graphrag.utils back: load it first.
+from api import settings
+from graphrag import utils as graph_utils
+from graphrag.utils import GraphChange, apply_graph_change, provisional_pagerank
+
+
+class FakeStore:
+    """Graph rows of one knowledge base, scanned in batches like DocStoreConnection.scan, of at most `page` rows."""
+
+    def __init__(self, rows, page=2):
+        self.rows = rows
+        self.page = page
+
+    def scan(self, selectFields, condition, indexNames, knowledgebaseIds, batchSize=1024):
+        def match(row):
+            for k, v in condition.items():
+                vals = v if isinstance(v, list) else [v]
+                got = row.get(k)
+                got = got if isinstance(got, list) else [got]
+                if not set(vals) & set(got):
+                    return False
+            return True
+
+        hits = {id: row for id, row in self.rows.items() if match(row)}
+        ids = sorted(hits)
+        step = min(batchSize, self.page)
+        for i in range(0, len(ids), step):
+            yield {id: {f: hits[id].get(f) for f in selectFields} for id in ids[i:i + step]}
+
+
+def _entity(name, source_id, **meta):
+    return {"kb_id": "kb", "knowledge_graph_kwd": "entity", "entity_kwd": name, "source_id": source_id,
+            "content_with_weight": json.dumps({"source_id": source_id, **meta})}
+
+
+def _relation(f, t, source_id, **meta):
+    return {"kb_id": "kb", "knowledge_graph_kwd": "relation", "from_entity_kwd": f, "to_entity_kwd": t,
+            "source_id": source_id, "content_with_weight": json.dumps({"source_id": source_id, **meta})}
+
+
+class TestApplyGraphChange:
+    def test_applies_neighborhood_change(self):
+        graph = nx.Graph()
+        graph.add_node("A", description="a")
+        graph.add_node("B", description="b")
+        graph.add_node("C", description="c")
+        graph.add_edge("A", "B", weight=1)
+        graph.add_edge("B", "C", weight=1)
+        graph.graph["source_id"] = ["doc1"]
+
+        partial = nx.Graph()
+        partial.add_node("B", description="b, updated")
+        partial.add_node("D", description="d")
+        partial.add_edge("B", "D", weight=2)
+        partial.graph["source_id"] = ["doc1", "doc2"]
+        change = GraphChange(removed_nodes={"C"}, added_updated_nodes={"B", "D"},
+                             removed_edges={("B", "C")}, added_updated_edges={("B", "D"), ("B", "X")})
+
+        apply_graph_change(graph, partial, change)
+        assert sorted(graph.nodes) == ["A", "B", "D"]
+        assert graph.nodes["B"]["description"] == "b, updated"
+        assert sorted(tuple(sorted(e)) for e in graph.edges) == [("A", "B"), ("B", "D")]
+        assert graph.graph["source_id"] == ["doc1", "doc2"]
+
+
+class TestProvisionalPagerank:
+    def test_new_nodes_rank_among_neighbors(self):
+        graph = nx.Graph()
+        graph.add_node("B", pagerank=0.2)
+        graph.add_node("E", pagerank=0.4)
+        graph.add_node("G", pagerank=0.05)
+        graph.add_node("D")
+        graph.add_node("F")
+        graph.add_edge("D", "B")
+        graph.add_edge("D", "E")
+        provisional_pagerank(graph, {"D", "F", "B", "missing"})
+        assert graph.nodes["D"]["pagerank"] == pytest.approx(0.3)
+        assert graph.nodes["F"]["pagerank"] == pytest.approx(0.05)
+        assert graph.nodes["B"]["pagerank"] == 0.2
+
+
+class TestDeltaOverlay:
+    @pytest.fixture
+    def store(self, monkeypatch):
+        snapshot = nx.Graph()
+        snapshot.add_node("A", description="a", source_id=["doc1"])
+        snapshot.graph["source_id"] = ["doc1"]
+        graph_row = {"removed_kwd": "N", "source_id": ["doc1", "doc2", "doc3"],
+                     "content_with_weight": json.dumps(nx.node_link_data(snapshot, edges="edges"))}
+        rows = {
+            "e-b": _entity("B", ["doc2"], description="b"),
+            "e-a": _entity("A", ["doc1", "doc3"], description="a, updated"),
+            "r-ab": _relation("A", "B", ["doc2"], weight=3),
+            "e-z": _entity("Z", ["doc9"], description="not merged yet"),
+        }
+        rows.update({f"e-{i}": _entity(f"N{i}", ["doc3"], description="") for i in range(5)})
+        store = FakeStore(rows)
+        monkeypatch.setattr(settings, "docStoreConn", store, raising=False)
+        monkeypatch.setattr(settings, "retrievaler", SimpleNamespace(
+            search=lambda conds, idx, kb_ids: SimpleNamespace(total=1, ids=["g"], field={"g": graph_row})), raising=False)
+        return store
+
+    def test_rows_since_snapshot_are_applied(self, store):
+        graph = trio.run(graph_utils.get_graph, "tenant", "kb")
+        assert sorted(graph.nodes) == ["A", "B"] + [f"N{i}" for i in range(5)]
+        assert graph.has_edge("A", "B") and graph.edges["A", "B"]["weight"] == 3
+        # A row from more documents wins over the snapshot.
+        assert graph.nodes["A"]["description"] == "a, updated"
+        assert graph.graph["source_id"] == ["doc1", "doc2", "doc3"]
@@ -0,0 +1,60 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from rag.utils.llm_cache import LLMCache
+
+
+@pytest.fixture
+def cache(redis):
+    return LLMCache(namespaces={"small": {"max_bytes": 1000}})
+
+
+def _bytes(redis, ns):
+    return int(redis.REDIS.get(f"llmcache_bytes:{ns}") or 0)
+
+
+class TestLLMCacheAccounting:
+    def test_hit_and_miss(self, cache, redis):
+        assert cache.get("ns", "m", "q", [], {}) is None
+        cache.set("ns", "m", "q", "answer", [], {})
+        assert cache.get("ns", "m", "q", [], {}) == "answer"
+        stats = cache.stats()["ns"]
+        assert (stats["hits"], stats["misses"], stats["writes"], stats["entries"]) == (1, 1, 1, 1)
+
+    def test_rewrite_same_entry_counts_once(self, cache, redis):
+        for _ in range(5):
+            cache.set("ns", "m", "q", "answer", [], {})
+        assert _bytes(redis, "ns") == len(b"r" + b"answer")
+        assert cache.stats()["ns"]["entries"] == 1
+
+    def test_rewrite_with_other_size_replaces(self, cache, redis):
+        cache.set("ns", "m", "q", "short", [], {})
+        cache.set("ns", "m", "q", "a longer answer", [], {})
+        assert _bytes(redis, "ns") == len(b"r" + b"a longer answer")
+        assert cache.stats()["ns"]["entries"] == 1
+        assert cache.get("ns", "m", "q", [], {}) == "a longer answer"
+
+    def test_eviction_keeps_budget(self, cache, redis):
+        for i in range(40):
+            cache.set("small", "m", f"q{i}", "x" * 100, [], {})
+        stats = cache.stats()["small"]
+        assert stats["bytes"] <= 1000
+        assert stats["evictions"] > 0
+        assert stats["bytes"] == stats["entries"] * len(b"r" + b"x" * 100)
+        # The most recent entry survives, the oldest is gone.
+        assert cache.get("small", "m", "q39", [], {}) == "x" * 100
+        assert cache.get("small", "m", "q0", [], {}) is None
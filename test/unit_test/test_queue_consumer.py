@@ -0,0 +1,77 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+
+import pytest
+
+from rag.utils.redis_conn import REDIS_CONN, RedisQueueConsumer
+
+QUEUES = ["high", "low"]
+
+
+def _consumer(name="c1"):
+    consumer = RedisQueueConsumer(QUEUES, "group", name, block_ms=10)
+    # fakeredis raises its own BUSYGROUP error class: create the groups here.
+    consumer._groups_ready = True
+    return consumer
+
+
+@pytest.fixture
+def queues(redis):
+    for q in QUEUES:
+        redis.REDIS.xgroup_create(q, "group", id="0", mkstream=True)
+    return redis
+
+
+def _produce(redis, queue, *ids):
+    for i in ids:
+        redis.REDIS.xadd(queue, {"message": json.dumps({"id": i})})
+
+
+def _take(consumer, count):
+    msg = consumer.fetch(count)
+    return msg.get_message()["id"] if msg else None
+
+
+class TestRedisQueueConsumer:
+    def test_buffers_no_more_than_asked_across_streams(self, queues):
+        consumer = _consumer()
+        _produce(queues, "high", "h1", "h2")
+        _produce(queues, "low", "l1", "l2")
+        assert _take(consumer, 3) == "h1"
+        assert consumer.fetched() == 2
+        # The rest is still in the stream for the other consumers.
+        assert _take(_consumer("c2"), 1) == "l2"
+
+    def test_reads_own_pending_messages_first(self, queues):
+        consumer = _consumer()
+        _produce(queues, "high", "h1")
+        _produce(queues, "low", "l1", "l2")
+        assert _take(consumer, 3) == "h1"
+        # Restarted under the same name, without acknowledging anything.
+        restarted = _consumer()
+        assert [_take(restarted, 2), _take(restarted, 2), _take(restarted, 2)] == ["h1", "l1", "l2"]
+
+    def test_errors_are_raised(self, queues, monkeypatch):
+        consumer = _consumer()
+
+        def down(*args, **kwargs):
+            raise ConnectionError("Connection refused")
+        monkeypatch.setattr(queues.REDIS, "xreadgroup", down)
+        monkeypatch.setattr(REDIS_CONN, "__open__", lambda: None)
+        with pytest.raises(ConnectionError):
+            consumer.fetch(1)
+        assert not consumer._groups_ready
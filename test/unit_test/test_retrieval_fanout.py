@@ -0,0 +1,125 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+# api.settings imports graphrag.search, which imports graphrag.utils back: load it first.
+from api import settings  # noqa: F401
+from api.db.services import dialog_service
+from api.db.services.dialog_service import RetrievalFanout
+
+
+def _chunks(*names):
+    return {"total": len(names), "chunks": [{"content_with_weight": n} for n in names], "doc_aggs": []}
+
+
+class FakeTavily:
+    delay = 0.0
+    fail = False
+
+    def __init__(self, api_key):
+        pass
+
+    def retrieve_chunks(self, question):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("web down")
+        return _chunks("web")
+
+
+@pytest.fixture
+def fanout(monkeypatch):
+    monkeypatch.setattr(dialog_service, "Tavily", FakeTavily)
+    monkeypatch.setattr(FakeTavily, "delay", 0.0)
+    monkeypatch.setattr(FakeTavily, "fail", False)
+    monkeypatch.setattr(RetrievalFanout, "SOURCES", [("kg", "Knowledge graph", 0.5), ("kb", "Knowledge base", 0),
+                                                     ("web", "Web search", 0.5)])
+    dialog = SimpleNamespace(prompt_config={"use_kg": True, "tavily_api_key": "key"})
+    f = RetrievalFanout(dialog, [], embd_mdl=object(), rerank_mdl=None, attachments=None)
+    f.kb_calls = []
+    f.kg_delay = 0.0
+
+    def kb(question):
+        f.kb_calls.append(question)
+        return _chunks("kb1", "kb2")
+
+    def kg(question):
+        time.sleep(f.kg_delay)
+        return {"content_with_weight": "kg"}
+
+    f._kb, f._kg = kb, kg
+    return f
+
+
+def _contents(kbinfos):
+    return [c["content_with_weight"] for c in kbinfos["chunks"]]
+
+
+class TestRetrievalFanout:
+    def test_merge_order_ignores_completion_order(self, fanout):
+        fanout.kg_delay = 0.2
+        kbinfos = fanout.collect(fanout.start("q"))
+        assert _contents(kbinfos) == ["kg", "kb1", "kb2", "web"]
+        assert set(fanout.timings) == {"Knowledge graph", "Knowledge base", "Web search"}
+
+    def test_optional_sources_past_deadline_are_skipped(self, fanout):
+        fanout.kg_delay = 2
+        FakeTavily.fail = True
+        start = time.perf_counter()
+        kbinfos = fanout.collect(fanout.start("q"))
+        assert time.perf_counter() - start < 1.5
+        assert _contents(kbinfos) == ["kb1", "kb2"]
+        assert fanout.timings["Knowledge graph"].startswith("timeout")
+        assert fanout.timings["Web search"] == "failed"
+
+    def test_deadline_counts_from_execution_start(self, fanout):
+        # One worker: the graph search only starts once the slow knowledge base search is done.
+        fanout._pool = ThreadPoolExecutor(max_workers=1)
+        fanout.kg_delay = 0.3
+
+        def kb(question):
+            time.sleep(0.3)
+            return _chunks("kb")
+        fanout._kb = kb
+        kbinfos = fanout.collect(fanout.start("q"))
+        assert _contents(kbinfos)[:2] == ["kg", "kb"]
+
+    def test_kb_failure_raises(self, fanout):
+        def kb(question):
+            raise RuntimeError("doc store down")
+        fanout._kb = kb
+        with pytest.raises(RuntimeError):
+            fanout.collect(fanout.start("q"))
+
+    def test_kb_deadline_raises(self, fanout, monkeypatch):
+        monkeypatch.setattr(RetrievalFanout, "SOURCES", [("kb", "Knowledge base", 0.1)])
+
+        def kb(question):
+            time.sleep(1)
+            return _chunks("late")
+        fanout._kb = kb
+        with pytest.raises(TimeoutError):
+            fanout.collect(fanout.start("q"))
+
+    def test_speculation_covers_kb_only(self, fanout):
+        speculative = fanout.start("q", sources=["kb"])
+        assert set(speculative[1]) == {"kb"}
+        kbinfos = fanout.collect(fanout.start("q", started=speculative))
+        assert fanout.kb_calls == ["q"]
+        assert _contents(kbinfos) == ["kg", "kb1", "kb2", "web"]
@@ -0,0 +1,113 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import time
+import zipfile
+from io import BytesIO
+
+import pytest
+
+# api.settings imports graphrag.search, which imports graphrag.utils back: load it first.
+from api import settings  # noqa: F401
+from api.db.services.task_service import (
+    OPEN_END,
+    TASK_MIN_UNITS,
+    count_units,
+    idle_task_executors,
+    split_kind,
+    unit_ranges,
+)
+
+
+def _docx(breaks, pages=None):
+    body = "".join('<w:p><w:r><w:t>text</w:t></w:r><w:r><w:lastRenderedPageBreak/></w:r></w:p>' for _ in range(breaks))
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("word/document.xml", f'<w:document><w:body>{body}<w:p><w:r><w:t>end</w:t></w:r></w:p></w:body></w:document>')
+        if pages is not None:
+            z.writestr("docProps/app.xml", f"<Properties><Pages>{pages}</Pages></Properties>")
+    return buf.getvalue()
+
+
+class TestSplitKind:
+    @pytest.mark.parametrize("name, parser_id, kind", [
+        ("report.docx", "naive", "docx"),
+        ("README.MD", "naive", "markdown"),
+        ("notes.txt", "naive", "text"),
+        ("main.py", "naive", "text"),
+        ("report.docx", "book", None),
+        ("slides.pptx", "naive", None),
+        ("paper.pdf", "naive", None),
+    ])
+    def test_kinds(self, name, parser_id, kind):
+        assert split_kind(name, parser_id) == kind
+
+
+class TestUnitRanges:
+    @pytest.mark.parametrize("kind, units", [("pdf", 1), ("pdf", 300), ("docx", 7), ("docx", 900), ("text", 10), ("text", 1000000), ("table", 123456)])
+    def test_ranges_cover_the_document(self, kind, units):
+        ranges = unit_ranges(kind, units)
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == OPEN_END
+        for (_, e), (s, _) in zip(ranges, ranges[1:]):
+            assert e == s
+        for s, e in ranges[:-1]:
+            assert e - s >= TASK_MIN_UNITS[kind]
+
+    def test_small_document_is_one_task(self):
+        assert unit_ranges("text", 10) == [(0, OPEN_END)]
+        assert unit_ranges("docx", 0) == [(0, OPEN_END)]
+
+    def test_large_document_is_balanced(self):
+        ranges = unit_ranges("pdf", 300)
+        size = ranges[0][1] - ranges[0][0]
+        assert len(ranges) > 1
+        assert all(e - s == size for s, e in ranges[:-1])
+        assert 0 < 300 - ranges[-1][0] <= size
+
+
+class TestCountUnits:
+    def test_text_lines(self):
+        assert count_units("text", b"a\nb\nc") == 3
+
+    def test_docx_rendered_pages(self):
+        assert count_units("docx", _docx(9, pages=10)) == 10
+        assert count_units("docx", _docx(9)) == 10
+
+    def test_docx_unreliable_pages(self):
+        # Never laid out: no rendered break, or far fewer than the saved page count.
+        assert count_units("docx", _docx(0, pages=40)) == 0
+        assert count_units("docx", _docx(3, pages=40)) == 0
+        assert count_units("docx", b"not a zip") == 0
+
+
+class TestIdleTaskExecutors:
+    @staticmethod
+    def _beat(redis, name, current, fetched=0, max_tasks=5, age=0):
+        now = time.time() - age
+        redis.sadd("TASKEXE", name)
+        hb = {"name": name, "current": {str(i): {} for i in range(current)}, "fetched": fetched, "max_tasks": max_tasks}
+        redis.zadd(name, json.dumps(hb), now)
+
+    def test_free_slot_means_idle(self, redis):
+        self._beat(redis, "busy", 5)
+        self._beat(redis, "prefetched", 3, fetched=2)
+        self._beat(redis, "idle", 1, fetched=1)
+        self._beat(redis, "stale", 0, age=3600)
+        self._beat(redis, "me", 0)
+        redis.sadd("TASKEXE", "old")
+        redis.zadd("old", json.dumps({"name": "old", "current": {}}), time.time())
+        assert idle_task_executors(exclude="me") == ["idle"]
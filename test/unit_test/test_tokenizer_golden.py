@@ -0,0 +1,53 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import shutil
+
+import pytest
+
+from rag.nlp import rag_tokenizer, tokenizer_golden
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+@pytest.fixture(scope="module")
+def tknzr(tmp_path_factory):
+    # loadUserDict writes a .trie cache next to the dictionary, keep it out of the tree.
+    dict_fnm = str(tmp_path_factory.mktemp("tokenizer") / "tokenizer_dict.txt")
+    shutil.copy(os.path.join(DATA, "tokenizer_dict.txt"), dict_fnm)
+    return tokenizer_golden.load_tokenizer(dict_fnm)
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return tokenizer_golden.load_corpus(os.path.join(DATA, "tokenizer_corpus.txt"))
+
+
+class TestTokenizerGolden:
+    def test_matches_golden(self, tknzr, corpus):
+        assert tokenizer_golden.verify(corpus, os.path.join(DATA, "tokenizer_golden.jsonl"), tknzr) == 0
+
+    def test_memoized_pass_matches(self, tknzr, corpus):
+        # The second pass is served from the segmentation caches.
+        first = tknzr.tokenize_batch(corpus, fine_grained=True)
+        assert tknzr.tokenize_batch(corpus, fine_grained=True) == first
+
+    def test_user_dict_stays_in_process(self, tknzr, corpus, monkeypatch):
+        monkeypatch.setattr(rag_tokenizer, "TOKENIZER_PROCESSES", 4)
+        monkeypatch.setattr(rag_tokenizer, "TOKENIZER_BATCH_SIZE", 2)
+        monkeypatch.setattr(rag_tokenizer, "_pool", None)
+        assert tknzr.tokenize_batch(corpus) == [tknzr.tokenize(line) for line in corpus]
+        assert rag_tokenizer._pool is None